@@ -1,21 +1,63 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, ConversationHandler
-from database import SessionLocal, VideoLesson, BotSettings, User, UserResponse
-from datetime import datetime
+from telegram.helpers import escape_markdown
+from database import (
+    VideoLesson, User, DailyRatingStats, run_db, settings_cache, lesson_cache, count_audience, audience_condition,
+    AUDIENCE_RECENT_DAYS
+)
+from sqlalchemy import func, case, select
+from sqlalchemy.orm import aliased
+import re
+from datetime import datetime, timedelta
 import logging
+import time
+
+import campaign
 
 # Константы для администраторов
 ADMIN_IDS = [354786612, 740144550]
 
 # Состояния для разговоров
 WAITING_VIDEO, WAITING_TITLE, WAITING_DESCRIPTION, WAITING_PAIN_LEVEL, WAITING_HOUR, WAITING_MINUTE = range(6)
+CAMPAIGN_AUDIENCE, CAMPAIGN_MESSAGE, CAMPAIGN_CONFIRM = range(6, 9)
+WAITING_USER_SEARCH = 9
 
 logger = logging.getLogger(__name__)
 
+# Сколько секунд панель администратора показывает закэшированные счетчики
+DASHBOARD_CACHE_SECONDS = 30
+
+# Список пользователей: строк на странице и фильтры (found - результаты поиска по username)
+USER_LIST_PAGE_SIZE = 10
+USER_LIST_FILTERS = {
+    'all': "Все",
+    'active': "Активные",
+    'stopped': "Отключили напоминания",
+    'recent': "Оценивали за 7 дней",
+    'silent': "Не оценивали 7 дней",
+    'low': "Последняя оценка 1-2",
+    'high': "Последняя оценка 4-5",
+}
+# Полосы последней оценки для фильтров low и high: [от, до)
+USER_LIST_RATING_BANDS = {'low': (1, 3), 'high': (4, 6)}
+USERNAME_PREFIX = re.compile(r'^[a-z0-9_]{1,32}$')
+
+_dashboard_cache = {}
+
 def is_admin(user_id: int) -> bool:
     """Проверка, является ли пользователь администратором"""
     return user_id in ADMIN_IDS
 
+async def _cached_db(key, loader):
+    """Результат run_db(loader), закэшированный на DASHBOARD_CACHE_SECONDS"""
+    cached = _dashboard_cache.get(key)
+    now = time.monotonic()
+    if cached and now - cached[0] < DASHBOARD_CACHE_SECONDS:
+        return cached[1]
+    result = await run_db(loader)
+    _dashboard_cache[key] = (now, result)
+    return result
+
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Главная панель администратора"""
     if not is_admin(update.effective_user.id):
@@ -54,6 +96,8 @@ async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TY
         await show_statistics(query, context)
     elif query.data == "manage_users":
         await show_user_management(query, context)
+    elif query.data.startswith("list_"):
+        await show_user_list(query, context)
     elif query.data.startswith("add_video_"):
         pain_level = int(query.data.split("_")[-1])
         context.user_data['pain_level'] = pain_level
@@ -70,6 +114,8 @@ async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TY
         await toggle_reminders(query, context)
     elif query.data == "change_time":
         await change_reminder_time(query, context)
+    elif query.data == "change_window":
+        await change_delivery_window(query, context)
     elif query.data.startswith("delete_video_"):
         pain_level = int(query.data.split("_")[-1])
         await delete_video_lesson(query, context, pain_level)
@@ -100,38 +146,41 @@ async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TY
         time_parts = query.data.split("_")[2:]
         hour, minute = int(time_parts[0]), int(time_parts[1])
         await set_reminder_time(query, context, hour, minute)
+    elif query.data.startswith("set_window_"):
+        window_minutes = int(query.data.split("_")[-1])
+        await set_delivery_window(query, context, window_minutes)
+
+def _get_video_levels(db):
+    """Уровни боли, для которых уже загружены видео-уроки"""
+    return {pain_level for (pain_level,) in db.query(VideoLesson.pain_level).all()}
 
 async def show_video_management(query, context):
     """Показать меню управления видео-уроками"""
-    db = SessionLocal()
-    try:
-        # Получаем существующие видео для каждого уровня боли
-        video_lessons = db.query(VideoLesson).all()
-        video_by_level = {}
-        for video in video_lessons:
-            video_by_level[video.pain_level] = video
-        
-        keyboard = []
-        for level in range(1, 6):
-            if level in video_by_level:
-                text = f"✅ Уровень {level} (есть видео)"
-                callback_data = f"edit_video_{level}"
-            else:
-                text = f"➕ Добавить для уровня {level}"
-                callback_data = f"add_video_{level}"
-            keyboard.append([InlineKeyboardButton(text, callback_data=callback_data)])
-        
-        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        text = (
-            "🎥 *Управление видео-уроками*\n\n"
-            "Выберите уровень боли для настройки:"
-        )
-        
-        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
-    finally:
-        db.close()
+    # Получаем существующие видео для каждого уровня боли
+    video_levels = await run_db(_get_video_levels)
+    
+    keyboard = []
+    for level in range(1, 6):
+        if level in video_levels:
+            text = f"✅ Уровень {level} (есть видео)"
+            callback_data = f"edit_video_{level}"
+        else:
+            text = f"➕ Добавить для уровня {level}"
+            callback_data = f"add_video_{level}"
+        keyboard.append([InlineKeyboardButton(text, callback_data=callback_data)])
+    
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    text = (
+        "🎥 *Управление видео-уроками*\n\n"
+        "Выберите уровень боли для настройки:"
+    )
+    
+    await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+
+def _get_video_lesson(db, pain_level):
+    return db.query(VideoLesson).filter(VideoLesson.pain_level == pain_level).first()
 
 async def show_video_edit_options(query, context, pain_level):
     """Показать опции редактирования для конкретного уровня боли"""
@@ -145,114 +194,301 @@ async def show_video_edit_options(query, context, pain_level):
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     # Получаем информацию о текущем видео
-    db = SessionLocal()
-    try:
-        video = db.query(VideoLesson).filter(VideoLesson.pain_level == pain_level).first()
-        text = f"🎥 *Видео-урок для уровня боли {pain_level}*\n\n"
-        if video:
-            text += f"📝 Название: {video.title or 'Не задано'}\n"
-            text += f"📄 Описание: {video.description or 'Не задано'}\n"
-            if video.duration:
-                minutes = video.duration // 60
-                seconds = video.duration % 60
-                text += f"⏱ Длительность: {minutes}:{seconds:02d}\n"
-            text += f"📅 Создано: {video.created_at.strftime('%d.%m.%Y %H:%M')}"
-        
-        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
-    finally:
-        db.close()
+    video = await run_db(_get_video_lesson, pain_level)
+    text = f"🎥 *Видео-урок для уровня боли {pain_level}*\n\n"
+    if video:
+        text += f"📝 Название: {video.title or 'Не задано'}\n"
+        text += f"📄 Описание: {video.description or 'Не задано'}\n"
+        if video.duration:
+            minutes = video.duration // 60
+            seconds = video.duration % 60
+            text += f"⏱ Длительность: {minutes}:{seconds:02d}\n"
+        text += f"📅 Создано: {video.created_at.strftime('%d.%m.%Y %H:%M')}"
+    
+    await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
 
 async def show_time_settings(query, context):
     """Показать настройки времени отправки напоминаний"""
-    db = SessionLocal()
-    try:
-        hour_setting = db.query(BotSettings).filter(BotSettings.setting_name == 'reminder_hour').first()
-        minute_setting = db.query(BotSettings).filter(BotSettings.setting_name == 'reminder_minute').first()
-        enabled_setting = db.query(BotSettings).filter(BotSettings.setting_name == 'reminder_enabled').first()
-        
-        current_hour = hour_setting.setting_value if hour_setting else "10"
-        current_minute = minute_setting.setting_value if minute_setting else "0"
-        is_enabled = enabled_setting.setting_value == 'true' if enabled_setting else True
-        
-        keyboard = [
-            [InlineKeyboardButton("⏰ Изменить время", callback_data="change_time")],
-            [InlineKeyboardButton(
-                f"{'🔴 Отключить' if is_enabled else '🟢 Включить'} напоминания", 
-                callback_data="toggle_reminders"
-            )],
-            [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        status = "🟢 Включены" if is_enabled else "🔴 Отключены"
-        text = (
-            f"⏰ *Настройки напоминаний*\n\n"
-            f"Текущее время: {current_hour}:{current_minute:0>2}\n"
-            f"Статус: {status}"
+    settings = settings_cache.get()
+    current_hour = settings.hour
+    current_minute = settings.minute
+    is_enabled = settings.enabled
+    
+    keyboard = [
+        [InlineKeyboardButton("⏰ Изменить время", callback_data="change_time")],
+        [InlineKeyboardButton("🪟 Окно доставки", callback_data="change_window")],
+        [InlineKeyboardButton(
+            f"{'🔴 Отключить' if is_enabled else '🟢 Включить'} напоминания", 
+            callback_data="toggle_reminders"
+        )],
+        [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    status = "🟢 Включены" if is_enabled else "🔴 Отключены"
+    if settings.window_minutes:
+        window_end = current_hour * 60 + current_minute + settings.window_minutes
+        window = (
+            f"{current_hour}:{current_minute:0>2}–{window_end // 60 % 24}:{window_end % 60:0>2} "
+            f"({settings.window_minutes} мин)"
         )
-        
-        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
-    finally:
-        db.close()
+    else:
+        window = "нет, все сообщения сразу"
+    text = (
+        f"⏰ *Настройки напоминаний*\n\n"
+        f"Текущее время: {current_hour}:{current_minute:0>2}\n"
+        f"Окно доставки: {window}\n"
+        f"Статус: {status}"
+    )
+    
+    await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+
+def _load_statistics(db):
+    """Общие счетчики и распределение оценок за последние 30 дней"""
+    total_users, active_users = _count_users(db)
+    
+    # Ответы считаем по дневной сводке, а не по всей истории user_responses
+    total_responses = db.query(
+        func.coalesce(func.sum(DailyRatingStats.response_count), 0)
+    ).scalar()
+    
+    # Статистика по уровням боли за последние 30 дней
+    thirty_days_ago = (datetime.utcnow() - timedelta(days=30)).date()
+    pain_stats = {1: 0, 2: 0, 3: 0, 4: 0, 5: 0}
+    rows = db.query(DailyRatingStats.pain_level, func.sum(DailyRatingStats.response_count)).filter(
+        DailyRatingStats.day >= thirty_days_ago
+    ).group_by(DailyRatingStats.pain_level).all()
+    for pain_level, count in rows:
+        pain_stats[pain_level] = count
+    
+    return total_users, active_users, total_responses, pain_stats
 
 async def show_statistics(query, context):
     """Показать статистику бота"""
-    db = SessionLocal()
-    try:
-        total_users = db.query(User).count()
-        active_users = db.query(User).filter(User.is_active == True).count()
-        total_responses = db.query(UserResponse).count()
-        
-        # Статистика по уровням боли за последние 30 дней
-        from datetime import timedelta
-        thirty_days_ago = datetime.utcnow() - timedelta(days=30)
-        recent_responses = db.query(UserResponse).filter(UserResponse.response_date >= thirty_days_ago).all()
-        
-        pain_stats = {1: 0, 2: 0, 3: 0, 4: 0, 5: 0}
-        for response in recent_responses:
-            pain_stats[response.pain_rating] += 1
-        
-        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        text = (
-            f"📊 *Статистика бота*\n\n"
-            f"👥 Всего пользователей: {total_users}\n"
-            f"✅ Активных: {active_users}\n"
-            f"💬 Всего ответов: {total_responses}\n\n"
-            f"📈 *Статистика боли (30 дней):*\n"
-        )
-        
-        for level, count in pain_stats.items():
-            text += f"Уровень {level}: {count} ответов\n"
-        
-        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
-    finally:
-        db.close()
+    total_users, active_users, total_responses, pain_stats = await _cached_db('statistics', _load_statistics)
+    
+    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    text = (
+        f"📊 *Статистика бота*\n\n"
+        f"👥 Всего пользователей: {total_users}\n"
+        f"✅ Активных: {active_users}\n"
+        f"💬 Всего ответов: {total_responses}\n\n"
+        f"📈 *Статистика боли (30 дней):*\n"
+    )
+    
+    for level, count in pain_stats.items():
+        text += f"Уровень {level}: {count} ответов\n"
+    
+    await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+
+def _count_users(db):
+    """Всего и активных пользователей одним агрегирующим запросом"""
+    total_users, active_users = db.query(
+        func.count(User.id),
+        func.coalesce(func.sum(case((User.is_active == True, 1), else_=0)), 0)
+    ).one()
+    return total_users, active_users
 
 async def show_user_management(query, context):
     """Показать управление пользователями"""
-    db = SessionLocal()
-    try:
-        total_users = db.query(User).count()
-        active_users = db.query(User).filter(User.is_active == True).count()
-        
-        keyboard = [
-            [InlineKeyboardButton("📝 Список пользователей", callback_data="list_users")],
-            [InlineKeyboardButton("📢 Рассылка", callback_data="broadcast")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
+    total_users, active_users = await _cached_db('user_counts', _count_users)
+    
+    keyboard = [
+        [InlineKeyboardButton("📝 Список пользователей", callback_data="list_users")],
+        [InlineKeyboardButton("📢 Рассылка", callback_data="broadcast")],
+        [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    text = (
+        f"👥 *Управление пользователями*\n\n"
+        f"Всего пользователей: {total_users}\n"
+        f"Активных: {active_users}"
+    )
+    
+    await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+
+def _user_list_condition(user_filter):
+    """Условие выборки списка пользователей для фильтра, который обходится по id.
+
+    silent читает индекс (is_active, id) и отбрасывает оценивавших недавно:
+    таких обычно меньшинство, поэтому страница набирается за несколько
+    десятков строк индекса. Если почти все пользователи оценивали на этой
+    неделе, страница silent читает их всех.
+    """
+    if user_filter == 'active':
+        return User.is_active == True
+    if user_filter == 'stopped':
+        return User.is_active == False
+    if user_filter == 'silent':
+        return audience_condition(user_filter)
+    return None
+
+def _user_list_range(user_filter, search=None):
+    """Для списков, упорядоченных по (ключ, id), а не по id: (ключ, от, до, доп. условие).
+
+    Ключ - функция, строящая выражение сортировки для модели или ее псевдонима;
+    границы - диапазон по индексу (ключ, id): до не включается, None - без границы.
+    """
+    if search:
+        upper = search[:-1] + chr(ord(search[-1]) + 1)
+        return (lambda user: func.lower(user.username)), search, upper, None
+    if user_filter == 'recent':
+        since = datetime.utcnow() - timedelta(days=AUDIENCE_RECENT_DAYS)
+        return (lambda user: user.last_rating_date), since, None, User.is_active == True
+    if user_filter in USER_LIST_RATING_BANDS:
+        low, high = USER_LIST_RATING_BANDS[user_filter]
+        return (lambda user: user.last_pain_rating), low, high, None
+    return None
+
+def _keyset_range(key, low, high, cursor_id=None, backward=False):
+    """Условия страницы по индексу (ключ, id) от low до high.
+
+    Курсор заменяет границу диапазона со своей стороны, поэтому чтение
+    индекса начинается сразу с него, а не с начала результатов.
+    """
+    column = key(User)
+    upper = [column < high] if high is not None else []
+    if cursor_id is None:
+        return [column >= low, *upper]
+    # Ключ строки-курсора - подзапросом по первичному ключу в том же запросе
+    cursor = aliased(User)
+    value = select(key(cursor)).where(cursor.id == cursor_id).scalar_subquery()
+    if backward:
+        return [column >= low, column <= value, (column < value) | (User.id < cursor_id)]
+    return [column >= value, (column > value) | (User.id > cursor_id), *upper]
+
+def _fetch_user_page(db, user_filter, search=None, after=None, before=None):
+    """Страница списка пользователей одним запросом (keyset-пагинация).
+
+    after/before - id последней/первой строки соседней страницы; позиция
+    определяется по ключу сортировки (id; для поиска, recent, low и high -
+    ключ фильтра и id), а не смещением, поэтому стоимость страницы не
+    растет с ее номером.
+    Возвращает (строки, есть ли предыдущая страница, есть ли следующая).
+    """
+    backward = before is not None
+    cursor_id = before if backward else after
+    query = select(
+        User.id, User.telegram_id, User.username, User.first_name,
+        User.is_active, User.last_pain_rating, User.last_rating_date
+    )
+    key_range = _user_list_range(user_filter, search)
+    if key_range is not None:
+        key, low, high, condition = key_range
+        query = query.where(*_keyset_range(key, low, high, cursor_id, backward))
+        order_key = [key(User), User.id]
+    else:
+        condition = _user_list_condition(user_filter)
+        if cursor_id is not None:
+            query = query.where(User.id < cursor_id if backward else User.id > cursor_id)
+        order_key = [User.id]
+    if condition is not None:
+        query = query.where(condition)
+    
+    order = [column.desc() for column in order_key] if backward else order_key
+    rows = db.execute(query.order_by(*order).limit(USER_LIST_PAGE_SIZE + 1)).all()
+    more = len(rows) > USER_LIST_PAGE_SIZE
+    rows = rows[:USER_LIST_PAGE_SIZE]
+    if not backward:
+        return rows, cursor_id is not None, more
+    if len(rows) < USER_LIST_PAGE_SIZE:
+        # Дошли до начала списка: показываем первую страницу целиком
+        return _fetch_user_page(db, user_filter, search)
+    return rows[::-1], more, True
+
+def _render_user_page(user_filter, search, rows, has_prev, has_next):
+    """Текст и клавиатура страницы списка пользователей"""
+    if search:
+        text = f"🔍 *Поиск:* @{escape_markdown(search)}\n\n"
+    else:
+        text = f"📝 *Пользователи:* {USER_LIST_FILTERS[user_filter]}\n\n"
+    
+    for row in rows:
+        name = escape_markdown(row.first_name or "Без имени")
+        if row.username:
+            name += f" @{escape_markdown(row.username)}"
+        if row.last_rating_date:
+            rating = f"оценка {row.last_pain_rating} ({row.last_rating_date:%d.%m.%Y})"
+        else:
+            rating = "оценок нет"
+        text += f"{'✅' if row.is_active else '⏸'} `{row.telegram_id}` {name} - {rating}\n"
+    if not rows:
+        text += "Пользователи не найдены.\n"
+    
+    keyboard = []
+    if not search:
+        filters = [
+            InlineKeyboardButton(f"• {title}" if name == user_filter else title, callback_data=f"list_{name}")
+            for name, title in USER_LIST_FILTERS.items()
         ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        text = (
-            f"👥 *Управление пользователями*\n\n"
-            f"Всего пользователей: {total_users}\n"
-            f"Активных: {active_users}"
+        keyboard += [filters[:2], filters[2:5], filters[5:]]
+    navigation = []
+    list_name = 'found' if search else user_filter
+    # Страница за курсором может оказаться пустой, если пользователей после него удалили
+    if has_prev and rows:
+        navigation.append(InlineKeyboardButton("◀️ Назад", callback_data=f"list_{list_name}_prev_{rows[0].id}"))
+    if has_next:
+        navigation.append(InlineKeyboardButton("Вперед ▶️", callback_data=f"list_{list_name}_next_{rows[-1].id}"))
+    if navigation:
+        keyboard.append(navigation)
+    keyboard.append([
+        InlineKeyboardButton("🔍 Поиск по username", callback_data="list_search"),
+        InlineKeyboardButton("🔙 Назад", callback_data="manage_users")
+    ])
+    return text, InlineKeyboardMarkup(keyboard)
+
+async def show_user_list(query, context):
+    """Страница списка пользователей: list_users, list_<фильтр>[_next|_prev_<id>]"""
+    parts = query.data.split("_")
+    user_filter = parts[1] if parts[1] in USER_LIST_FILTERS or parts[1] == 'found' else 'all'
+    after = int(parts[3]) if len(parts) == 4 and parts[2] == 'next' else None
+    before = int(parts[3]) if len(parts) == 4 and parts[2] == 'prev' else None
+    
+    search = None
+    if user_filter == 'found':
+        search = context.user_data.get('user_search')
+        if search is None:
+            # Результаты поиска из прошлого сеанса: начинаем список сначала
+            user_filter, after, before = 'all', None, None
+    
+    rows, has_prev, has_next = await run_db(_fetch_user_page, user_filter, search, after, before)
+    text, reply_markup = _render_user_page(user_filter, search, rows, has_prev, has_next)
+    await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+
+async def start_user_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Кнопка поиска в списке пользователей: ждем начало username"""
+    query = update.callback_query
+    await query.answer()
+    
+    if not is_admin(query.from_user.id):
+        await query.edit_message_text("У вас нет прав доступа.")
+        return ConversationHandler.END
+    
+    await query.edit_message_text(
+        "Отправьте начало username пользователя (без @).\n/cancel - отмена."
+    )
+    return WAITING_USER_SEARCH
+
+async def receive_user_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Результаты поиска пользователей по началу username"""
+    if not is_admin(update.effective_user.id):
+        return ConversationHandler.END
+    
+    search = update.message.text.strip().lstrip('@').lower()
+    if not USERNAME_PREFIX.match(search):
+        await update.message.reply_text(
+            "Username состоит из латинских букв, цифр и _. Попробуйте еще раз или /cancel."
         )
-        
-        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
-    finally:
-        db.close()
+        return WAITING_USER_SEARCH
+    
+    context.user_data['user_search'] = search
+    rows, has_prev, has_next = await run_db(_fetch_user_page, 'found', search)
+    text, reply_markup = _render_user_page('found', search, rows, has_prev, has_next)
+    await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+    return ConversationHandler.END
 
 async def receive_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Получение видео-урока от администратора"""
@@ -275,6 +511,31 @@ async def receive_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     return WAITING_TITLE
 
+def _update_video_field(db, pain_level, field, value):
+    """Изменить одно поле видео-урока; False если урок не найден"""
+    video = db.query(VideoLesson).filter(VideoLesson.pain_level == pain_level).first()
+    if not video:
+        return False
+    setattr(video, field, value)
+    db.commit()
+    # Видео-уроки изменились - сбрасываем и перечитываем кэш
+    lesson_cache.invalidate()
+    lesson_cache.load(db)
+    return True
+
+def _replace_video_lesson(db, new_video):
+    """Сохранить видео-урок, удалив старый для этого уровня боли"""
+    old_video = db.query(VideoLesson).filter(VideoLesson.pain_level == new_video.pain_level).first()
+    if old_video:
+        db.delete(old_video)
+        # Удаляем до вставки: pain_level уникален
+        db.flush()
+    db.add(new_video)
+    db.commit()
+    # Видео-уроки изменились - сбрасываем и перечитываем кэш
+    lesson_cache.invalidate()
+    lesson_cache.load(db)
+
 async def receive_video_title(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Получение названия для видео-урока"""
     if not is_admin(update.effective_user.id):
@@ -285,21 +546,13 @@ async def receive_video_title(update: Update, context: ContextTypes.DEFAULT_TYPE
     # Проверяем, это редактирование существующего видео или создание нового
     if context.user_data.get('edit_mode') == 'title':
         # Редактируем только название
-        db = SessionLocal()
-        try:
-            pain_level = context.user_data['pain_level']
-            video = db.query(VideoLesson).filter(VideoLesson.pain_level == pain_level).first()
-            
-            if video:
-                video.title = title
-                db.commit()
-                await update.message.reply_text(
-                    f"✅ Название видео-урока для уровня боли {pain_level} обновлено!"
-                )
-            else:
-                await update.message.reply_text("❌ Видео-урок не найден.")
-        finally:
-            db.close()
+        pain_level = context.user_data['pain_level']
+        if await run_db(_update_video_field, pain_level, 'title', title):
+            await update.message.reply_text(
+                f"✅ Название видео-урока для уровня боли {pain_level} обновлено!"
+            )
+        else:
+            await update.message.reply_text("❌ Видео-урок не найден.")
         
         context.user_data.clear()
         return ConversationHandler.END
@@ -321,55 +574,32 @@ async def receive_video_description(update: Update, context: ContextTypes.DEFAUL
     # Проверяем, это редактирование существующего видео или создание нового
     if context.user_data.get('edit_mode') == 'description':
         # Редактируем только описание
-        db = SessionLocal()
-        try:
-            pain_level = context.user_data['pain_level']
-            video = db.query(VideoLesson).filter(VideoLesson.pain_level == pain_level).first()
-            
-            if video:
-                video.description = description
-                db.commit()
-                await update.message.reply_text(
-                    f"✅ Описание видео-урока для уровня боли {pain_level} обновлено!"
-                )
-            else:
-                await update.message.reply_text("❌ Видео-урок не найден.")
-        finally:
-            db.close()
+        pain_level = context.user_data['pain_level']
+        if await run_db(_update_video_field, pain_level, 'description', description):
+            await update.message.reply_text(
+                f"✅ Описание видео-урока для уровня боли {pain_level} обновлено!"
+            )
+        else:
+            await update.message.reply_text("❌ Видео-урок не найден.")
         
         context.user_data.clear()
         return ConversationHandler.END
     else:
         # Создание нового видео
-        db = SessionLocal()
-        try:
-            pain_level = context.user_data['pain_level']
-            video_file_id = context.user_data['video_file_id']
-            video_title = context.user_data.get('video_title')
-            video_duration = context.user_data.get('video_duration')
-            
-            # Удаляем старое видео для этого уровня боли если есть
-            old_video = db.query(VideoLesson).filter(VideoLesson.pain_level == pain_level).first()
-            if old_video:
-                db.delete(old_video)
-            
-            # Создаем новое
-            new_video = VideoLesson(
-                pain_level=pain_level,
-                file_id=video_file_id,
-                title=video_title,
-                description=description,
-                duration=video_duration,
-                created_by_admin=update.effective_user.id
-            )
-            db.add(new_video)
-            db.commit()
-            
-            await update.message.reply_text(
-                f"✅ Видео-урок для уровня боли {pain_level} успешно сохранен!"
-            )
-        finally:
-            db.close()
+        pain_level = context.user_data['pain_level']
+        new_video = VideoLesson(
+            pain_level=pain_level,
+            file_id=context.user_data['video_file_id'],
+            title=context.user_data.get('video_title'),
+            description=description,
+            duration=context.user_data.get('video_duration'),
+            created_by_admin=update.effective_user.id
+        )
+        await run_db(_replace_video_lesson, new_video)
+        
+        await update.message.reply_text(
+            f"✅ Видео-урок для уровня боли {pain_level} успешно сохранен!"
+        )
         
         # Очищаем данные пользователя
         context.user_data.clear()
@@ -400,47 +630,20 @@ async def show_main_admin_panel(query, context):
 
 async def toggle_reminders(query, context):
     """Переключение включения/отключения напоминаний"""
-    db = SessionLocal()
-    try:
-        enabled_setting = db.query(BotSettings).filter(BotSettings.setting_name == 'reminder_enabled').first()
-        
-        if enabled_setting:
-            # Переключаем состояние
-            new_value = 'false' if enabled_setting.setting_value == 'true' else 'true'
-            enabled_setting.setting_value = new_value
-            enabled_setting.updated_by_admin = query.from_user.id
-            enabled_setting.updated_at = datetime.utcnow()
-        else:
-            # Создаем новую настройку
-            new_setting = BotSettings(
-                setting_name='reminder_enabled',
-                setting_value='false',
-                updated_by_admin=query.from_user.id
-            )
-            db.add(new_setting)
-            new_value = 'false'
-        
-        db.commit()
-        
-        status_text = "включены" if new_value == 'true' else "отключены"
-        await query.answer(f"Напоминания {status_text}")
-        
-        # Обновляем планировщик
-        hour_setting = db.query(BotSettings).filter(BotSettings.setting_name == 'reminder_hour').first()
-        minute_setting = db.query(BotSettings).filter(BotSettings.setting_name == 'reminder_minute').first()
-        
-        hour = int(hour_setting.setting_value) if hour_setting else 10
-        minute = int(minute_setting.setting_value) if minute_setting else 0
-        
-        # Обновляем планировщик через контекст приложения
-        if hasattr(context.application, 'spina_bot'):
-            context.application.spina_bot.update_scheduler(hour, minute, new_value == 'true')
-        
-        # Показываем обновленные настройки времени
-        await show_time_settings(query, context)
-        
-    finally:
-        db.close()
+    # Переключаем состояние
+    settings = await run_db(
+        settings_cache.update, query.from_user.id, enabled=not settings_cache.get().enabled
+    )
+    
+    status_text = "включены" if settings.enabled else "отключены"
+    await query.answer(f"Напоминания {status_text}")
+    
+    # Обновляем планировщик через контекст приложения
+    if hasattr(context.application, 'spina_bot'):
+        context.application.spina_bot.update_scheduler(settings.hour, settings.minute, settings.enabled)
+    
+    # Показываем обновленные настройки времени
+    await show_time_settings(query, context)
 
 async def change_reminder_time(query, context):
     """Изменение времени напоминаний"""
@@ -460,69 +663,202 @@ async def change_reminder_time(query, context):
     
     await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
 
+# Варианты окна доставки общей рассылки, минут
+DELIVERY_WINDOW_OPTIONS = (0, 15, 30, 60)
+
+async def change_delivery_window(query, context):
+    """Выбор окна доставки общей рассылки"""
+    keyboard = [
+        [InlineKeyboardButton(
+            f"{minutes} мин" if minutes else "Без окна",
+            callback_data=f"set_window_{minutes}"
+        )]
+        for minutes in DELIVERY_WINDOW_OPTIONS
+    ]
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="manage_time")])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    text = (
+        "🪟 *Окно доставки напоминаний*\n\n"
+        "Рассылка растягивается на выбранное время после начала, "
+        "а темп подстраивается под поток ответов и нагрузку на базу данных."
+    )
+    
+    await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+
+async def set_delivery_window(query, context, window_minutes):
+    """Установка окна доставки общей рассылки"""
+    await run_db(settings_cache.update, query.from_user.id, window_minutes=window_minutes)
+    
+    await query.answer(f"Окно доставки: {window_minutes} мин" if window_minutes else "Окно доставки отключено")
+    
+    # Показываем обновленные настройки времени
+    await show_time_settings(query, context)
+
+def _delete_video_lesson(db, pain_level):
+    """Удалить видео-урок; False если урок не найден"""
+    video = db.query(VideoLesson).filter(VideoLesson.pain_level == pain_level).first()
+    if not video:
+        return False
+    db.delete(video)
+    db.commit()
+    # Видео-уроки изменились - сбрасываем и перечитываем кэш
+    lesson_cache.invalidate()
+    lesson_cache.load(db)
+    return True
+
 async def delete_video_lesson(query, context, pain_level):
     """Удаление видео-урока"""
-    db = SessionLocal()
-    try:
-        video = db.query(VideoLesson).filter(VideoLesson.pain_level == pain_level).first()
-        if video:
-            db.delete(video)
-            db.commit()
-            await query.answer("Видео-урок удален")
-        else:
-            await query.answer("Видео-урок не найден")
-        
-        # Возвращаемся к управлению видео
-        await show_video_management(query, context)
-    finally:
-        db.close()
+    if await run_db(_delete_video_lesson, pain_level):
+        await query.answer("Видео-урок удален")
+    else:
+        await query.answer("Видео-урок не найден")
+    
+    # Возвращаемся к управлению видео
+    await show_video_management(query, context)
 
 async def set_reminder_time(query, context, hour, minute):
     """Установка времени напоминаний"""
-    db = SessionLocal()
-    try:
-        # Обновляем или создаем настройки времени
-        hour_setting = db.query(BotSettings).filter(BotSettings.setting_name == 'reminder_hour').first()
-        minute_setting = db.query(BotSettings).filter(BotSettings.setting_name == 'reminder_minute').first()
-        
-        if hour_setting:
-            hour_setting.setting_value = str(hour)
-            hour_setting.updated_by_admin = query.from_user.id
-            hour_setting.updated_at = datetime.utcnow()
-        else:
-            hour_setting = BotSettings(
-                setting_name='reminder_hour',
-                setting_value=str(hour),
-                updated_by_admin=query.from_user.id
-            )
-            db.add(hour_setting)
-        
-        if minute_setting:
-            minute_setting.setting_value = str(minute)
-            minute_setting.updated_by_admin = query.from_user.id
-            minute_setting.updated_at = datetime.utcnow()
-        else:
-            minute_setting = BotSettings(
-                setting_name='reminder_minute',
-                setting_value=str(minute),
-                updated_by_admin=query.from_user.id
-            )
-            db.add(minute_setting)
-        
-        db.commit()
-        
-        # Проверяем включены ли напоминания
-        enabled_setting = db.query(BotSettings).filter(BotSettings.setting_name == 'reminder_enabled').first()
-        is_enabled = enabled_setting.setting_value == 'true' if enabled_setting else True
-        
-        # Обновляем планировщик через контекст приложения
-        if hasattr(context.application, 'spina_bot'):
-            context.application.spina_bot.update_scheduler(hour, minute, is_enabled)
-        
-        await query.answer(f"Время напоминаний установлено на {hour:02d}:{minute:02d}")
-        
-        # Показываем обновленные настройки времени
-        await show_time_settings(query, context)
-        
-    finally:
-        db.close() 
\ No newline at end of file
+    settings = await run_db(settings_cache.update, query.from_user.id, hour=hour, minute=minute)
+    
+    # Обновляем планировщик через контекст приложения
+    if hasattr(context.application, 'spina_bot'):
+        context.application.spina_bot.update_scheduler(hour, minute, settings.enabled)
+    
+    await query.answer(f"Время напоминаний установлено на {hour:02d}:{minute:02d}")
+    
+    # Показываем обновленные настройки времени
+    await show_time_settings(query, context)
+
+async def start_campaign_dialog(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Кнопка "Рассылка": выбор аудитории или ход уже идущей рассылки"""
+    query = update.callback_query
+    await query.answer()
+    
+    if not is_admin(query.from_user.id):
+        await query.edit_message_text("У вас нет прав доступа.")
+        return ConversationHandler.END
+    
+    active = await campaign.active_campaign()
+    if active is not None:
+        # Вторую рассылку не начинаем: показываем ход текущей с кнопками управления
+        await campaign.show_progress(context.bot, active.id, query.message.chat_id, query.message.message_id)
+        if active.status == 'running':
+            campaign.watch_progress(context.application, active.id, query.message.chat_id, query.message.message_id)
+        return ConversationHandler.END
+    
+    keyboard = [
+        [InlineKeyboardButton(title, callback_data=f"campaign_audience_{audience}")]
+        for audience, title in campaign.AUDIENCES.items()
+    ]
+    keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data="campaign_abort")])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    await query.edit_message_text(
+        "📢 *Рассылка*\n\nКому отправить сообщение?",
+        reply_markup=reply_markup,
+        parse_mode='Markdown'
+    )
+    return CAMPAIGN_AUDIENCE
+
+async def choose_campaign_audience(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Аудитория выбрана: ждем сообщение для рассылки"""
+    query = update.callback_query
+    await query.answer()
+    
+    audience = query.data[len("campaign_audience_"):]
+    if not is_admin(query.from_user.id) or audience not in campaign.AUDIENCES:
+        return ConversationHandler.END
+    
+    context.user_data['campaign_audience'] = audience
+    await query.edit_message_text(
+        f"Аудитория: {campaign.AUDIENCES[audience]}\n\n"
+        "Отправьте текст или видео (с подписью) для рассылки.\n"
+        "Форматирование сообщения сохранится. /cancel - отмена."
+    )
+    return CAMPAIGN_MESSAGE
+
+async def receive_campaign_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Сообщение для рассылки получено: подтверждение с числом получателей"""
+    if not is_admin(update.effective_user.id):
+        return ConversationHandler.END
+    
+    audience = context.user_data.get('campaign_audience')
+    payload = campaign.message_payload(update.message, audience)
+    if audience is None or payload is None:
+        await update.message.reply_text("Пожалуйста, отправьте текст или видео.")
+        return CAMPAIGN_MESSAGE
+    
+    context.user_data['campaign_payload'] = payload
+    recipients = await run_db(count_audience, audience)
+    
+    keyboard = [
+        [InlineKeyboardButton(f"✅ Отправить ({recipients})", callback_data="campaign_confirm")],
+        [InlineKeyboardButton("❌ Отмена", callback_data="campaign_abort")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    await update.message.reply_text(
+        f"Сообщение выше получат: {campaign.AUDIENCES[audience]} - {recipients} польз.\n"
+        "Отправить?",
+        reply_markup=reply_markup
+    )
+    return CAMPAIGN_CONFIRM
+
+async def confirm_campaign(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Запуск рассылки; сообщение с подтверждением становится сообщением о ее ходе"""
+    query = update.callback_query
+    await query.answer()
+    
+    payload = context.user_data.pop('campaign_payload', None)
+    context.user_data.pop('campaign_audience', None)
+    if not is_admin(query.from_user.id) or payload is None:
+        return ConversationHandler.END
+    
+    chat_id, message_id = query.message.chat_id, query.message.message_id
+    run_id = await campaign.start_campaign(context.application, query.from_user.id, payload, chat_id, message_id)
+    if run_id is None:
+        await query.edit_message_text("❌ Уже идет другая рассылка. Дождитесь ее окончания или отмените ее.")
+        active = await campaign.active_campaign()
+        if active is not None:
+            # Ход текущей рассылки с кнопками управления - отдельным сообщением
+            message = await query.message.reply_text("⏳")
+            await campaign.show_progress(context.bot, active.id, chat_id, message.message_id)
+        return ConversationHandler.END
+    
+    await campaign.show_progress(context.bot, run_id, chat_id, message_id)
+    return ConversationHandler.END
+
+async def abort_campaign_dialog(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отмена подготовки рассылки кнопкой"""
+    query = update.callback_query
+    await query.answer()
+    
+    context.user_data.pop('campaign_payload', None)
+    context.user_data.pop('campaign_audience', None)
+    await query.edit_message_text("Рассылка отменена.")
+    return ConversationHandler.END
+
+async def handle_campaign_control(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Кнопки пауза / продолжить / отменить под сообщением о ходе рассылки"""
+    query = update.callback_query
+    
+    if not is_admin(query.from_user.id):
+        await query.answer("У вас нет прав доступа.")
+        return
+    
+    _, action, run_id = query.data.split("_")
+    run_id = int(run_id)
+    chat_id, message_id = query.message.chat_id, query.message.message_id
+    
+    if action == "pause":
+        changed = await campaign.pause_campaign(run_id)
+        await query.answer("Рассылка приостановлена" if changed else "Рассылка не идет")
+    elif action == "resume":
+        changed = await campaign.resume_campaign(context.application, run_id, chat_id, message_id)
+        await query.answer("Рассылка продолжается" if changed else "Рассылка не на паузе")
+    else:
+        changed = await campaign.cancel_campaign(run_id)
+        await query.answer("Рассылка отменена" if changed else "Рассылка уже завершена")
+    
+    await campaign.show_progress(context.bot, run_id, chat_id, message_id)
@@ -0,0 +1,6 @@
+"""
+Бенчмарки Spina Bot.
+
+Запуск из корня проекта: python -m benchmarks.<имя_модуля>
+Каждый бенчмарк работает со своей временной базой данных.
+"""
@@ -0,0 +1,104 @@
+"""
+Конкурентность обработчиков во время медленного запроса к базе.
+
+Запускает один медленный запрос и параллельно много коротких "обработчиков",
+сначала вызывая базу прямо из event loop (как раньше), затем через run_db.
+При прямых вызовах короткие обработчики ждут окончания медленного запроса,
+через run_db их задержка от него не зависит.
+
+    python -m benchmarks.db_concurrency [--handlers 200] [--slow 1.0]
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+_tmp_dir = tempfile.mkdtemp(prefix="spina_bench_")
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_tmp_dir, 'bench.db')}"
+
+from sqlalchemy import text  # noqa: E402
+
+from database import SessionLocal, User, create_tables, run_db  # noqa: E402
+
+
+def _slow_query(db, seconds):
+    """Имитация тяжелого запроса: рекурсивный CTE примерно на seconds секунд"""
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        db.execute(text(
+            "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < 200000) "
+            "SELECT count(*) FROM c"
+        )).scalar()
+
+
+def _fast_query(db, telegram_id):
+    return db.query(User).filter(User.telegram_id == telegram_id).first()
+
+
+def _with_session(func, *args):
+    db = SessionLocal()
+    try:
+        return func(db, *args)
+    finally:
+        db.close()
+
+
+async def _run_scenario(use_executor: bool, handlers: int, slow_seconds: float):
+    latencies = []
+
+    async def handler(i, arrived):
+        # Задержку считаем от момента прихода апдейта, а не от начала обработки
+        if use_executor:
+            await run_db(_fast_query, i)
+        else:
+            _with_session(_fast_query, i)
+        latencies.append(time.perf_counter() - arrived)
+
+    async def slow():
+        if use_executor:
+            await run_db(_slow_query, slow_seconds)
+        else:
+            _with_session(_slow_query, slow_seconds)
+
+    async def delayed_handler(i):
+        # Обработчики приходят, пока медленный запрос уже выполняется
+        await asyncio.sleep(0.01)
+        await handler(i, started + 0.01)
+
+    started = time.perf_counter()
+    await asyncio.gather(slow(), *(delayed_handler(i) for i in range(handlers)))
+    total = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'p50': statistics.median(latencies) * 1000,
+        'p99': latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        'max': latencies[-1] * 1000,
+        'total': total,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--handlers', type=int, default=200, help="число коротких обработчиков")
+    parser.add_argument('--slow', type=float, default=1.0, help="длительность медленного запроса, с")
+    args = parser.parse_args()
+
+    create_tables()
+    db = SessionLocal()
+    db.add_all([User(telegram_id=i) for i in range(args.handlers)])
+    db.commit()
+    db.close()
+
+    print(f"Медленный запрос: {args.slow:.1f} с, коротких обработчиков: {args.handlers}")
+    print(f"{'режим':<22}{'p50, мс':>10}{'p99, мс':>10}{'max, мс':>10}{'всего, с':>10}")
+    for name, use_executor in (("прямо в event loop", False), ("через run_db", True)):
+        result = asyncio.run(_run_scenario(use_executor, args.handlers, args.slow))
+        print(f"{name:<22}{result['p50']:>10.1f}{result['p99']:>10.1f}{result['max']:>10.1f}{result['total']:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
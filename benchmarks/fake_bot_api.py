@@ -0,0 +1,255 @@
+"""
+Локальный поддельный сервер Bot API для нагрузочных тестов.
+
+Заменяет api.telegram.org по HTTP: бот подключается к нему через
+SpinaBot(base_url=...) или переменную TELEGRAM_API_URL
+(http://127.0.0.1:PORT/bot). Реализованы getMe, getUpdates (long polling),
+setWebhook/deleteWebhook (апдейты отправляются POST-запросами на webhook
+бота), sendMessage, sendVideo, editMessageText и answerCallbackQuery.
+
+Поведение Telegram, которое можно включить:
+    rtt             - задержка ответа на каждый вызов, секунд
+    enforce_limits  - 429 с retry_after при превышении ~30 сообщений в секунду
+                      на бота и 1 сообщения в секунду в чат
+    rate_429        - доля вызовов отправки, на которые отвечает 429
+    rate_403        - доля чатов, "заблокировавших бота" (403 навсегда)
+    fail_next()     - ответить ошибкой на ближайшие вызовы метода
+    block()         - пользователь заблокировал бота
+
+Генератор нагрузки с пользователями, отвечающими на напоминания:
+benchmarks/reminder_load.py.
+"""
+
+import asyncio
+import itertools
+import json
+import math
+import random
+import time
+from collections import Counter
+from urllib.parse import parse_qsl
+
+from benchmarks.fake_telegram import BOT_USER
+from benchmarks.http_client import HTTPClient
+from http_server import HTTPServer, Response
+
+SEND_METHODS = ('sendMessage', 'sendVideo')
+METHODS = (
+    'getMe', 'getUpdates', 'setWebhook', 'deleteWebhook', 'getWebhookInfo',
+    'sendMessage', 'sendVideo', 'editMessageText', 'answerCallbackQuery',
+)
+
+# Лимиты, которые сервер применяет при enforce_limits
+GLOBAL_RATE_LIMIT = 30
+PER_CHAT_INTERVAL = 1.0
+
+
+def _error(code: int, description: str, retry_after: int = None) -> Response:
+    payload = {"ok": False, "error_code": code, "description": description}
+    if retry_after is not None:
+        payload["parameters"] = {"retry_after": retry_after}
+    return Response(code, json.dumps(payload).encode(), "application/json")
+
+
+def _parse_params(body: bytes, content_type: str) -> dict:
+    """Параметры вызова: JSON или форма, где сложные значения закодированы в JSON"""
+    if not body:
+        return {}
+    if content_type.startswith('application/json'):
+        return json.loads(body)
+    params = {}
+    for name, value in parse_qsl(body.decode(), keep_blank_values=True):
+        try:
+            params[name] = json.loads(value)
+        except ValueError:
+            params[name] = value
+    return params
+
+
+class FakeBotAPI:
+    """Сервер Bot API в памяти процесса"""
+
+    def __init__(self, token: str, host: str = '127.0.0.1', port: int = 0, rtt: float = 0.0,
+                 enforce_limits: bool = False, rate_429: float = 0.0, rate_403: float = 0.0,
+                 retry_after: int = 1, seed: int = 1):
+        self.token = token
+        self.rtt = rtt
+        self.enforce_limits = enforce_limits
+        self.rate_429 = rate_429
+        self.rate_403 = rate_403
+        self.retry_after = retry_after
+        self.calls = Counter()           # метод -> число вызовов
+        self.errors = Counter()          # (метод, код) -> число ответов с ошибкой
+        self.blocked = set()
+        self.on_send = None              # колбэк on_send(chat_id, message_id, params)
+        self.on_reply = None             # колбэк on_reply(метод, params) для ответов на апдейты
+
+        self._server = HTTPServer(host, port)
+        for method in METHODS:
+            self._server.route('POST', f'/bot{token}/{method}', self._handler(method))
+        self._random = random.Random(seed)
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1000)
+        self._updates = []
+        self._updates_added = asyncio.Event()
+        self._webhook = None             # (HTTPClient, секрет)
+        self._webhook_lock = asyncio.Lock()
+        self._sent_at = []               # время последних отправок для глобального лимита
+        self._chat_sent_at = {}
+        self._pending_failures = {}      # метод -> [(код, число)]
+        self._closing = False
+
+    @property
+    def port(self) -> int:
+        return self._server.port
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self._server.host}:{self.port}/bot"
+
+    @property
+    def webhook_set(self) -> bool:
+        return self._webhook is not None
+
+    async def start(self):
+        await self._server.start()
+
+    async def stop(self):
+        # Отпустить ожидающие getUpdates, чтобы их соединения закрылись
+        self._closing = True
+        self._updates_added.set()
+        await self._server.stop()
+        if self._webhook is not None:
+            await self._webhook[0].close()
+
+    # Управление из теста
+
+    def block(self, chat_id: int):
+        self.blocked.add(chat_id)
+
+    def fail_next(self, method: str, code: int = 429, count: int = 1):
+        """Ответить ошибкой code на ближайшие count вызовов method"""
+        self._pending_failures.setdefault(method, []).append([code, count])
+
+    async def inject(self, update: dict) -> dict:
+        """Апдейт от пользователя: в очередь getUpdates или POST на webhook бота"""
+        update = dict(update, update_id=next(self._update_ids))
+        if self._webhook is None:
+            self._updates.append(update)
+            self._updates_added.set()
+            return update
+        client, secret = self._webhook
+        # Одно соединение: Telegram доставляет апдейты бота по очереди
+        async with self._webhook_lock:
+            await client.post(json.dumps(update).encode(), {'X-Telegram-Bot-Api-Secret-Token': secret})
+        return update
+
+    # Обработка вызовов
+
+    def _handler(self, method):
+        async def handle(request):
+            self.calls[method] += 1
+            params = _parse_params(request.body, request.headers.get('content-type', ''))
+            if method == 'getUpdates':
+                return self._ok(await self._get_updates(params))
+            if self.rtt:
+                await asyncio.sleep(self.rtt)
+            failure = self._failure(method, params)
+            if failure is not None:
+                self.errors[(method, failure.status)] += 1
+                return failure
+            return self._ok(await self._call(method, params))
+        return handle
+
+    @staticmethod
+    def _ok(result) -> Response:
+        return Response(200, json.dumps({"ok": True, "result": result}).encode(), "application/json")
+
+    def _failure(self, method, params):
+        pending = self._pending_failures.get(method)
+        if pending:
+            pending[0][1] -= 1
+            code = pending[0][0]
+            if not pending[0][1]:
+                pending.pop(0)
+            if code == 429:
+                return _error(429, f"Too Many Requests: retry after {self.retry_after}", self.retry_after)
+            return _error(code, "Forbidden: bot was blocked by the user" if code == 403 else "Bad Request")
+
+        if method not in SEND_METHODS:
+            return None
+        chat_id = int(params.get('chat_id', 0) or 0)
+        if chat_id in self.blocked:
+            return _error(403, "Forbidden: bot was blocked by the user")
+        if self.rate_403 and self._random.random() < self.rate_403:
+            self.blocked.add(chat_id)
+            return _error(403, "Forbidden: bot was blocked by the user")
+        if self.rate_429 and self._random.random() < self.rate_429:
+            return _error(429, f"Too Many Requests: retry after {self.retry_after}", self.retry_after)
+        if self.enforce_limits:
+            return self._check_limits(chat_id)
+        return None
+
+    def _check_limits(self, chat_id):
+        now = time.monotonic()
+        self._sent_at = [at for at in self._sent_at if now - at < 1.0]
+        last = self._chat_sent_at.get(chat_id)
+        wait = 0.0
+        if len(self._sent_at) >= GLOBAL_RATE_LIMIT:
+            wait = 1.0 - (now - self._sent_at[0])
+        if last is not None and now - last < PER_CHAT_INTERVAL:
+            wait = max(wait, PER_CHAT_INTERVAL - (now - last))
+        if wait > 0:
+            retry_after = max(1, math.ceil(wait))
+            return _error(429, f"Too Many Requests: retry after {retry_after}", retry_after)
+        self._sent_at.append(now)
+        self._chat_sent_at[chat_id] = now
+        return None
+
+    async def _call(self, method, params):
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'setWebhook':
+            if self._webhook is not None:
+                await self._webhook[0].close()
+            self._webhook = (HTTPClient(params['url']), params.get('secret_token', ''))
+            return True
+        if method == 'deleteWebhook':
+            if self._webhook is not None:
+                await self._webhook[0].close()
+            self._webhook = None
+            return True
+        if method == 'getWebhookInfo':
+            return {"url": "", "has_custom_certificate": False, "pending_update_count": len(self._updates)}
+        if method in ('editMessageText', 'answerCallbackQuery'):
+            if self.on_reply is not None:
+                self.on_reply(method, params)
+            if method == 'answerCallbackQuery':
+                return True
+
+        chat_id = int(params.get('chat_id', 0) or 0)
+        message_id = params.get('message_id') or next(self._message_ids)
+        if method in SEND_METHODS and self.on_send is not None:
+            self.on_send(chat_id, message_id, params)
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": params.get('text', ''),
+        }
+
+    async def _get_updates(self, params):
+        offset = int(params.get('offset', 0) or 0)
+        limit = int(params.get('limit', 100) or 100)
+        timeout = float(params.get('timeout', 0) or 0)
+        # offset подтверждает все апдейты до него
+        self._updates = [update for update in self._updates if update['update_id'] >= offset]
+        if not self._updates and timeout and not self._closing:
+            self._updates_added.clear()
+            try:
+                await asyncio.wait_for(self._updates_added.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        if self.rtt:
+            await asyncio.sleep(self.rtt)
+        return self._updates[:limit]
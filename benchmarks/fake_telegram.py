@@ -0,0 +1,132 @@
+"""
+Поддельный Bot API для замеров: BaseRequest, который отвечает на вызовы бота
+без сети и записывает время каждого вызова.
+
+Сетевая задержка до Telegram эмулируется параметром rtt (секунд на полный
+круг запрос-ответ). getUpdates ведет себя как long polling: ждет апдейты из
+очереди inject() до истечения timeout.
+"""
+
+import asyncio
+import itertools
+import json
+import time
+
+from telegram.request import BaseRequest
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Spina Bench", "username": "spina_bench_bot"}
+
+
+def callback_update(update_id: int, user_id: int, data: str) -> dict:
+    """Апдейт с нажатием inline-кнопки"""
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "text": "Оцените уровень боли от 1 до 5:",
+            },
+        },
+    }
+
+
+def message_update(update_id: int, user_id: int, text: str) -> dict:
+    """Апдейт с текстовым сообщением (команды начинаются с /)"""
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+        "text": text,
+    }
+    if text.startswith('/'):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+def update_key(update: dict):
+    """Ключ, по которому первый ответ бота сопоставляется с апдейтом"""
+    if "callback_query" in update:
+        return ("callback", update["callback_query"]["id"])
+    return ("chat", update["message"]["chat"]["id"])
+
+
+class FakeTelegramRequest(BaseRequest):
+    """Bot API в памяти процесса"""
+
+    def __init__(self, rtt: float = 0.0):
+        self.rtt = rtt
+        self.calls = []                  # (время, метод, параметры)
+        self.first_reply = {}            # ключ апдейта -> время первого ответа бота
+        self._updates = asyncio.Queue()
+        self._message_ids = itertools.count(1000)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def inject(self, update: dict):
+        """Положить апдейт в очередь getUpdates (как будто он пришел в Telegram)"""
+        self._updates.put_nowait(update)
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data is not None else {}
+        now = time.perf_counter()
+        self.calls.append((now, api_method, params))
+
+        if api_method == 'answerCallbackQuery':
+            self.first_reply.setdefault(("callback", str(params.get('callback_query_id'))), now)
+        elif 'chat_id' in params:
+            self.first_reply.setdefault(("chat", int(params['chat_id'])), now)
+
+        if api_method == 'getUpdates':
+            result = await self._get_updates(params)
+        else:
+            # Запрос доходит до Telegram и ответ возвращается за полный круг
+            if self.rtt:
+                await asyncio.sleep(self.rtt)
+            result = self._result(api_method, params)
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    async def _get_updates(self, params):
+        # Запрос идет до Telegram полкруга, ответ с апдейтами - еще полкруга
+        if self.rtt:
+            await asyncio.sleep(self.rtt / 2)
+        timeout = float(params.get('timeout', 0) or 0)
+        updates = []
+        try:
+            updates.append(await asyncio.wait_for(self._updates.get(), timeout) if timeout else self._updates.get_nowait())
+        except (asyncio.TimeoutError, asyncio.QueueEmpty):
+            pass
+        while not self._updates.empty() and len(updates) < int(params.get('limit', 100) or 100):
+            updates.append(self._updates.get_nowait())
+        if self.rtt:
+            await asyncio.sleep(self.rtt / 2)
+        return updates
+
+    def _result(self, api_method, params):
+        if api_method == 'getMe':
+            return BOT_USER
+        if api_method in ('sendMessage', 'sendVideo', 'editMessageText'):
+            chat_id = int(params.get('chat_id', 0) or 0)
+            return {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get('text', ''),
+            }
+        return True
@@ -0,0 +1,186 @@
+"""
+Пропускная способность горячих путей бота.
+
+Поднимает настоящее приложение из main.py с поддельным Bot API
+(benchmarks/fake_telegram.py, задержка --rtt-ms на каждый вызов) и для
+каждого размера базы (--sizes, по умолчанию 1k/10k/100k пользователей)
+замеряет:
+    pain        - нажатие кнопки оценки (handle_pain_rating)
+    /stats      - статистика пользователя (user_stats)
+    view_stats  - экран статистики администратора
+    manage_users - экран управления пользователями
+    reminder    - ежедневная рассылка всем пользователям (send_daily_reminder)
+
+Экраны администратора замеряются дважды: без кэша панели (он сбрасывается
+перед каждым апдейтом, так что замеряются запросы к базе) и с кэшем
+(повторные открытия в пределах DASHBOARD_CACHE_SECONDS, строки "(кэш)").
+
+Апдейты подаются через Application.process_update по одному, так что
+замеряется обработка одного апдейта без параллелизма. Для рассылки лимит
+скорости Telegram снят (BROADCAST_RATE_LIMIT, OUTBOUND_CHAT_INTERVAL), чтобы
+замерять сам бот, а не ограничитель; задержка считается на одно сообщение.
+Ограничение частоты апдейтов пользователя и склейка нажатий (flood_guard.py)
+не действуют: их проверяет очередь апдейтов (update_processor.py), которую
+Application.process_update обходит. Печатает операций в секунду, p50 и p99.
+
+    python -m benchmarks.hot_paths [--sizes 1000,10000,100000] [--updates 2000] [--rtt-ms 0]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import tempfile
+import time
+import warnings
+from types import SimpleNamespace
+
+_tmp_dir = tempfile.mkdtemp(prefix="spina_bench_")
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_tmp_dir, 'bench.db')}"
+os.environ.setdefault('BROADCAST_RATE_LIMIT', '1000000')
+os.environ.setdefault('OUTBOUND_CHAT_INTERVAL', '0')
+os.environ['METRICS_PORT'] = '0'
+
+from sqlalchemy import delete, func, insert, select  # noqa: E402
+
+from benchmarks.fake_telegram import FakeTelegramRequest, callback_update, message_update  # noqa: E402
+from database import BroadcastRun, OutboxMessage, SessionLocal, User, create_tables  # noqa: E402
+
+BENCH_TOKEN = "123456:bench"
+FIRST_USER_ID = 100_000
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def _grow_users(size: int):
+    """Довести число пользователей до size (ID подряд с FIRST_USER_ID)"""
+    db = SessionLocal()
+    try:
+        existing = db.execute(select(func.count(User.id))).scalar()
+        rows = [
+            {'telegram_id': FIRST_USER_ID + i, 'first_name': 'Bench', 'is_active': True}
+            for i in range(existing, size)
+        ]
+        for start in range(0, len(rows), 10_000):
+            db.execute(insert(User), rows[start:start + 10_000])
+        # Каждый размер рассылается заново
+        db.execute(delete(OutboxMessage))
+        db.execute(delete(BroadcastRun))
+        db.commit()
+    finally:
+        db.close()
+
+
+def _clear_dashboard_cache():
+    import admin_handlers
+    admin_handlers._dashboard_cache.clear()
+
+
+async def _updates(application, updates, before=None):
+    """Обработать апдейты по одному; время каждого. before() вызывается перед апдейтом вне замера"""
+    from telegram import Update
+
+    timings = []
+    for data in updates:
+        update = Update.de_json(data, application.bot)
+        if before is not None:
+            before()
+        started = time.perf_counter()
+        await application.process_update(update)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+async def _reminder(application):
+    """Ежедневная рассылка; время отправки каждого сообщения"""
+    from outbox import register_sender
+    from user_handlers import _reminder_sender, send_daily_reminder
+
+    timings = []
+
+    def timed_sender(bot, payload=None):
+        send = _reminder_sender(bot, payload)
+
+        async def timed(chat_id):
+            started = time.perf_counter()
+            try:
+                await send(chat_id)
+            finally:
+                timings.append(time.perf_counter() - started)
+        return timed
+
+    register_sender('reminder', timed_sender)
+    try:
+        with warnings.catch_warnings():
+            # Приложение не запущено (start): задачу доставки ждем сами
+            warnings.filterwarnings('ignore', message="Tasks created via `Application.create_task`")
+            delivery = await send_daily_reminder(SimpleNamespace(application=application))
+        if delivery is not None:
+            await delivery
+    finally:
+        register_sender('reminder', _reminder_sender)
+    return timings
+
+
+async def _run_size(size, updates, rtt):
+    from admin_handlers import ADMIN_IDS
+    from main import SpinaBot
+
+    logging.getLogger().setLevel(logging.ERROR)
+    application = SpinaBot(token=BENCH_TOKEN, request=FakeTelegramRequest(rtt=rtt)).application
+    await application.initialize()
+    random.seed(size)
+    users = [FIRST_USER_ID + random.randrange(size) for _ in range(updates)]
+    admin_id = ADMIN_IDS[0]
+    admin_updates = updates // 10 or 1
+    view_stats = [callback_update(i + 1, admin_id, "view_stats") for i in range(admin_updates)]
+    manage_users = [callback_update(i + 1, admin_id, "manage_users") for i in range(admin_updates)]
+    # (название, апдейты, что сделать перед каждым); сценарий "(кэш)" идет сразу
+    # за своим замером без кэша, последний апдейт которого и заполнил кэш
+    scenarios = [
+        ("pain", [callback_update(i + 1, user, f"pain_{random.randint(1, 5)}") for i, user in enumerate(users)], None),
+        ("/stats", [message_update(i + 1, user, "/stats") for i, user in enumerate(users)], None),
+        ("view_stats", view_stats, _clear_dashboard_cache),
+        ("view_stats (кэш)", view_stats, None),
+        ("manage_users", manage_users, _clear_dashboard_cache),
+        ("manage_users (кэш)", manage_users, None),
+    ]
+    results = []
+    try:
+        for name, batch, before in scenarios:
+            started = time.perf_counter()
+            timings = await _updates(application, batch, before)
+            results.append((name, size, timings, time.perf_counter() - started))
+
+        started = time.perf_counter()
+        timings = await _reminder(application)
+        results.append(("reminder", size, timings, time.perf_counter() - started))
+    finally:
+        await application.shutdown()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default="1000,10000,100000", help="число пользователей через запятую")
+    parser.add_argument('--updates', type=int, default=2000, help="апдейтов на сценарий (админских - в 10 раз меньше)")
+    parser.add_argument('--rtt-ms', type=float, default=0, help="задержка поддельного Bot API на вызов")
+    args = parser.parse_args()
+
+    create_tables()
+    print(f"{'сценарий':<20}{'польз.':>8}{'операций':>10}{'оп/с':>10}{'p50, мс':>10}{'p99, мс':>10}")
+    for size in sorted(int(value) for value in args.sizes.split(',')):
+        _grow_users(size)
+        for name, users, timings, elapsed in asyncio.run(_run_size(size, args.updates, args.rtt_ms / 1000)):
+            print(f"{name:<20}{users:>8}{len(timings):>10}{len(timings) / elapsed:>10.0f}"
+                  f"{_percentile(timings, 0.5) * 1000:>10.2f}{_percentile(timings, 0.99) * 1000:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
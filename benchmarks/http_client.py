@@ -0,0 +1,43 @@
+"""
+Минимальный keep-alive HTTP клиент для замеров (POST апдейтов на webhook)
+"""
+
+import asyncio
+from urllib.parse import urlsplit
+
+
+class HTTPClient:
+    """Минимальный keep-alive клиент для POST на webhook"""
+
+    def __init__(self, url: str):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = parts.path or '/'
+        self._reader = self._writer = None
+
+    async def post(self, body: bytes, headers: dict) -> int:
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        head = f"POST {self.path} HTTP/1.1\r\nHost: {self.host}\r\nContent-Type: application/json\r\n"
+        head += "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+        head += f"Content-Length: {len(body)}\r\n\r\n"
+        self._writer.write(head.encode() + body)
+        await self._writer.drain()
+
+        status_line = await self._reader.readline()
+        length = 0
+        while True:
+            line = await self._reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.decode().partition(":")
+            if name.strip().lower() == 'content-length':
+                length = int(value)
+        if length:
+            await self._reader.readexactly(length)
+        return int(status_line.split()[1])
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
@@ -0,0 +1,118 @@
+"""
+Проверка бюджета SQL-запросов обработчиков.
+
+Прогоняет типичные апдейты (команды пользователя, нажатия кнопок, админка)
+через настоящее приложение с поддельным Bot API (benchmarks/fake_telegram.py)
+и считает запросы каждого апдейта (query_counter.py). Сценарий прогоняется
+дважды: первый проход прогревает кэши и заполняет агрегаты пользователя,
+бюджет проверяется на втором. Кэш экранов администратора (_dashboard_cache)
+сбрасывается перед каждым апдейтом: бюджет ограничивает запросы без кэша.
+Апдейты подаются через Application.process_update, мимо очереди апдейтов
+(update_processor.py), поэтому ограничение частоты и склейка нажатий
+(flood_guard.py) не действуют.
+Печатает число запросов и бюджет по каждому обработчику; код выхода 1,
+если хотя бы один бюджет превышен (HANDLER_QUERY_BUDGETS в query_counter.py).
+
+    python -m benchmarks.query_budget
+
+Тот же сценарий проверяет pytest (tests/test_query_budget.py).
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+
+_tmp_dir = tempfile.mkdtemp(prefix="spina_bench_")
+os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(_tmp_dir, 'bench.db')}")
+os.environ['METRICS_PORT'] = '0'
+
+import query_counter  # noqa: E402
+from benchmarks.fake_telegram import FakeTelegramRequest, callback_update, message_update  # noqa: E402
+
+BENCH_TOKEN = "123456:bench"
+USER_ID = 10_001
+
+
+def _scenario(admin_id: int):
+    """(отправитель, апдейт) в порядке, в котором их отправил бы живой пользователь"""
+    steps = [
+        (USER_ID, "/start"), (USER_ID, "pain_3"), (USER_ID, "pain_4"), (USER_ID, "/stats"),
+        (USER_ID, "/status"), (USER_ID, "/timezone Europe/Moscow"), (USER_ID, "/time 08:30"),
+        (USER_ID, "/stop"), (USER_ID, "/resume"),
+        (admin_id, "/admin"), (admin_id, "manage_time"), (admin_id, "toggle_reminders"),
+        (admin_id, "toggle_reminders"), (admin_id, "change_time"), (admin_id, "set_time_9_0"),
+        (admin_id, "set_time_10_0"), (admin_id, "change_window"), (admin_id, "set_window_15"),
+        (admin_id, "set_window_0"), (admin_id, "view_stats"),
+        (admin_id, "manage_users"), (admin_id, "list_users"), (admin_id, "list_all_next_1"),
+        (admin_id, "list_all_prev_2"), (admin_id, "list_recent"), (admin_id, "list_high"),
+        (admin_id, "list_high_next_1"), (admin_id, "list_high_prev_2"),
+        (admin_id, "manage_video"), (admin_id, "back_to_main"),
+    ]
+    for update_id, (user_id, data) in enumerate(steps, start=1):
+        if data.startswith('/'):
+            yield message_update(update_id, user_id, data)
+        else:
+            yield callback_update(update_id, user_id, data)
+
+
+async def _pass(application, admin_id):
+    import admin_handlers
+    from metrics import update_label
+    from telegram import Update
+
+    results = []
+    for data in _scenario(admin_id):
+        update = Update.de_json(data, application.bot)
+        admin_handlers._dashboard_cache.clear()
+        label = update_label(update)
+        # Внешний учет: обертка обработчика видит его и не открывает свой
+        error = None
+        try:
+            with query_counter.track_update(label) as tally:
+                await application.process_update(update)
+        except query_counter.QueryBudgetExceeded as e:
+            error = e
+        budget = query_counter.HANDLER_QUERY_BUDGETS.get(label, query_counter.DEFAULT_QUERY_BUDGET)
+        results.append((label, tally.count, tally.duration, budget, error))
+    return results
+
+
+async def _run():
+    from admin_handlers import ADMIN_IDS
+    from main import SpinaBot
+
+    # Журнал обработчиков (main настраивает INFO) загромождает таблицу
+    logging.getLogger().setLevel(logging.ERROR)
+    application = SpinaBot(token=BENCH_TOKEN, request=FakeTelegramRequest()).application
+    await application.initialize()
+    try:
+        query_counter.QUERY_BUDGET_MODE = 'off'
+        await _pass(application, ADMIN_IDS[0])
+        query_counter.QUERY_BUDGET_MODE = 'raise'
+        return await _pass(application, ADMIN_IDS[0])
+    finally:
+        await application.shutdown()
+
+
+def main():
+    from database import create_tables, engine
+    from metrics import instrument_engine
+    instrument_engine(engine)
+    create_tables()
+
+    results = asyncio.run(_run())
+    print(f"{'обработчик':<20}{'запросов':>10}{'бюджет':>8}{'мс':>8}")
+    failed = 0
+    for label, count, duration, budget, error in results:
+        mark = "  ПРЕВЫШЕН" if error is not None else ""
+        print(f"{label:<20}{count:>10}{budget:>8}{duration * 1000:>8.1f}{mark}")
+        failed += error is not None
+    if failed:
+        print(f"Бюджет превышен: {failed}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Запись оценок боли: транзакция на каждую оценку против буфера write-behind.
+
+Моделирует утреннюю волну ответов: --ratings оценок от --users пользователей
+поступают с конкурентностью --concurrency. Печатает оценки/с, число коммитов
+и коммиты/с для обоих путей записи.
+
+    python -m benchmarks.rating_writes [--ratings 5000] [--users 1000]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+_tmp_dir = tempfile.mkdtemp(prefix="spina_bench_")
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_tmp_dir, 'bench.db')}"
+
+from sqlalchemy import event  # noqa: E402
+
+from database import SessionLocal, User, create_tables, engine, run_db, save_pain_rating  # noqa: E402
+from write_behind import RatingWriteBuffer  # noqa: E402
+
+_commits = 0
+
+
+@event.listens_for(engine, "commit")
+def _count_commit(conn):
+    global _commits
+    _commits += 1
+
+
+async def _direct(ratings, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def rate(telegram_id, pain_level):
+        async with semaphore:
+            await run_db(save_pain_rating, telegram_id, pain_level)
+
+    await asyncio.gather(*(rate(*rating) for rating in ratings))
+
+
+async def _write_behind(ratings, concurrency, flush_ms, flush_rows):
+    buffer = RatingWriteBuffer(flush_interval_ms=flush_ms, max_rows=flush_rows, enabled=True)
+    await buffer.start()
+    for i, (telegram_id, pain_level) in enumerate(ratings):
+        buffer.add(telegram_id, pain_level)
+        if i % concurrency == 0:
+            # Отдаем управление циклу, как между апдейтами Telegram
+            await asyncio.sleep(0)
+    await buffer.stop()
+
+
+def _measure(name, coroutine):
+    global _commits
+    _commits = 0
+    started = time.perf_counter()
+    asyncio.run(coroutine)
+    elapsed = time.perf_counter() - started
+    return name, elapsed, _commits
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ratings', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--flush-ms', type=int, default=200)
+    parser.add_argument('--flush-rows', type=int, default=500)
+    args = parser.parse_args()
+
+    create_tables()
+    db = SessionLocal()
+    db.add_all([User(telegram_id=i) for i in range(args.users)])
+    db.commit()
+    db.close()
+
+    random.seed(1)
+    ratings = [(random.randrange(args.users), random.randint(1, 5)) for _ in range(args.ratings)]
+
+    results = [
+        _measure("транзакция на оценку", _direct(ratings, args.concurrency)),
+        _measure("write-behind", _write_behind(ratings, args.concurrency, args.flush_ms, args.flush_rows)),
+    ]
+
+    print(f"Оценок: {args.ratings}, пользователей: {args.users}, конкурентность: {args.concurrency}")
+    print(f"{'путь записи':<24}{'время, с':>10}{'оценок/с':>12}{'коммитов':>10}{'коммитов/с':>12}")
+    for name, elapsed, commits in results:
+        print(f"{name:<24}{elapsed:>10.2f}{args.ratings / elapsed:>12.0f}{commits:>10}{commits / elapsed:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
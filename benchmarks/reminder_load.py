@@ -0,0 +1,260 @@
+"""
+Нагрузочный тест от начала до конца: N пользователей отвечают на напоминание.
+
+Поднимает поддельный Bot API (benchmarks/fake_bot_api.py) и бот, который
+ходит в него по HTTP через base_url. Пользователи регистрируются командой
+/start, затем бот рассылает ежедневное напоминание (send_daily_reminder), и
+каждый получивший его пользователь через случайное время (--think-ms в
+среднем) нажимает кнопку оценки. Апдейты приходят через long polling или
+webhook (--mode).
+
+Печатает скорость рассылки, число ответов 429/403 от Bot API, число
+отключенных ботом пользователей и задержку ответа бота на нажатие
+(от появления апдейта до answerCallbackQuery), p50/p99.
+
+С --external бот не запускается: сервер слушает --port, бот запускается
+отдельно с TELEGRAM_API_URL=http://127.0.0.1:PORT/bot и BOT_TOKEN=--token,
+пользователи отвечают на напоминания, которые бот разошлет по расписанию.
+
+    python -m benchmarks.reminder_load [--users 200] [--mode polling|webhook] [--rtt-ms 40]
+        [--enforce-limits] [--rate-429 0.01] [--rate-403 0.02]
+    python -m benchmarks.reminder_load --external --port 8081 --users 50 --duration 600
+"""
+
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import random
+import socket
+import tempfile
+import time
+from types import SimpleNamespace
+
+_tmp_dir = tempfile.mkdtemp(prefix="spina_bench_")
+os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(_tmp_dir, 'bench.db')}")
+os.environ['METRICS_PORT'] = '0'
+
+from benchmarks.fake_bot_api import FakeBotAPI  # noqa: E402
+from benchmarks.fake_telegram import message_update  # noqa: E402
+
+BENCH_TOKEN = "123456:bench"
+FIRST_USER_ID = 200_000
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def _has_pain_keyboard(params) -> bool:
+    markup = params.get('reply_markup') or {}
+    return any(
+        str(button.get('callback_data', '')).startswith('pain_')
+        for row in markup.get('inline_keyboard', []) for button in row
+    )
+
+
+class SimulatedUsers:
+    """Пользователи, которые отвечают на клавиатуру оценки после паузы"""
+
+    def __init__(self, api: FakeBotAPI, count: int, think: float, seed: int = 1):
+        self.api = api
+        self.user_ids = [FIRST_USER_ID + i for i in range(count)]
+        self.think = think
+        self.armed = False               # отвечать только на напоминание, а не на /start
+        self.faults = (0.0, 0.0)         # доли 429 и 403, включаются после регистрации
+        self.reminders = 0
+        self.greeted = set()             # получили ответ на /start
+        self.latencies = []
+        self._random = random.Random(seed)
+        self._callback_ids = itertools.count(1)
+        self._pending = {}               # id callback -> время появления апдейта
+        self._tasks = set()
+        api.on_send = self._on_send
+        api.on_reply = self._on_reply
+
+    async def register(self, concurrency: int = 20):
+        """Каждый пользователь отправляет /start"""
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def start(user_id):
+            async with semaphore:
+                await self.api.inject(message_update(0, user_id, "/start"))
+
+        await asyncio.gather(*(start(user_id) for user_id in self.user_ids))
+
+    @property
+    def waiting(self) -> int:
+        return len(self._pending) + len(self._tasks)
+
+    def arm(self):
+        """Регистрация закончена: включить ошибки Bot API и отвечать на напоминания"""
+        self.api.rate_429, self.api.rate_403 = self.faults
+        self.armed = True
+
+    def _on_send(self, chat_id, message_id, params):
+        if not self.armed:
+            self.greeted.add(chat_id)
+            return
+        if not _has_pain_keyboard(params):
+            return
+        self.reminders += 1
+        task = asyncio.get_running_loop().create_task(self._answer(chat_id, message_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _answer(self, chat_id, message_id):
+        await asyncio.sleep(self._random.expovariate(1 / self.think) if self.think else 0)
+        callback_id = str(next(self._callback_ids))
+        self._pending[callback_id] = time.perf_counter()
+        await self.api.inject({
+            "callback_query": {
+                "id": callback_id,
+                "from": {"id": chat_id, "is_bot": False, "first_name": "Load"},
+                "chat_instance": str(chat_id),
+                "data": f"pain_{self._random.randint(1, 5)}",
+                "message": {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"},
+                    "text": "Оцените уровень боли от 1 до 5:",
+                },
+            },
+        })
+
+    def _on_reply(self, method, params):
+        if method == 'answerCallbackQuery':
+            injected = self._pending.pop(str(params.get('callback_query_id')), None)
+            if injected is not None:
+                self.latencies.append(time.perf_counter() - injected)
+
+
+async def _wait(condition, timeout):
+    deadline = time.perf_counter() + timeout
+    while not condition() and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+
+
+async def _run_bot(api, users, mode):
+    """Бот в этом процессе: регистрация, рассылка, ожидание ответов; длительность рассылки"""
+    from main import ALLOWED_UPDATES, SpinaBot
+    from user_handlers import send_daily_reminder
+    from webhook import WebhookConfig, serve_webhook
+
+    logging.getLogger().setLevel(logging.ERROR)
+    application = SpinaBot(token=BENCH_TOKEN, base_url=api.base_url).application
+    stop = asyncio.Event()
+    server = None
+    if mode == 'webhook':
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        config = WebhookConfig(url=f"http://127.0.0.1:{port}", listen='127.0.0.1', port=port,
+                               path='/telegram', secret='load')
+        server = asyncio.create_task(serve_webhook(application, config, ALLOWED_UPDATES, stop_event=stop))
+        await _wait(lambda: api.webhook_set, 10)
+    else:
+        # Как run_polling: post_init запускает фоновые задачи и бот рассылок
+        await application.initialize()
+        await application.post_init(application)
+        await application.start()
+        await application.updater.start_polling(poll_interval=0, timeout=10, allowed_updates=ALLOWED_UPDATES)
+
+    try:
+        await users.register()
+        await _wait(lambda: len(users.greeted) >= len(users.user_ids), 60)
+        # Ответ на /start может состоять из нескольких сообщений
+        await asyncio.sleep(0.5)
+
+        users.arm()
+        started = time.perf_counter()
+        delivery = await send_daily_reminder(SimpleNamespace(application=application))
+        if delivery is not None:
+            await delivery
+        duration = time.perf_counter() - started
+        await _wait(lambda: users.waiting == 0, 60)
+    finally:
+        if server is not None:
+            stop.set()
+            await server
+        else:
+            await application.updater.stop()
+            await application.stop()
+            await application.shutdown()
+            await application.post_shutdown(application)
+    return duration
+
+
+def _count_inactive():
+    from database import SessionLocal, User
+
+    db = SessionLocal()
+    try:
+        return db.query(User).filter(User.telegram_id >= FIRST_USER_ID, User.is_active.is_(False)).count()
+    finally:
+        db.close()
+
+
+def _report(api, users, duration=None):
+    errors = {f"{method} {code}": count for (method, code), count in sorted(api.errors.items())}
+    print(f"Пользователей: {len(users.user_ids)}, получили напоминание: {users.reminders}")
+    if duration is not None:
+        print(f"Рассылка: {duration:.1f} с, {users.reminders / duration:.1f} сообщений/с")
+    print(f"Ошибки Bot API: {errors or 'нет'}")
+    print(f"Ответов бота на нажатие: {len(users.latencies)}, "
+          f"p50 {_percentile(users.latencies, 0.5) * 1000:.1f} мс, "
+          f"p99 {_percentile(users.latencies, 0.99) * 1000:.1f} мс")
+
+
+async def _main(args):
+    api = FakeBotAPI(args.token, port=args.port if args.external else 0, rtt=args.rtt_ms / 1000,
+                     enforce_limits=args.enforce_limits)
+    await api.start()
+    users = SimulatedUsers(api, args.users, args.think_ms / 1000)
+    users.faults = (args.rate_429, args.rate_403)
+    try:
+        if args.external:
+            print(f"Bot API: TELEGRAM_API_URL={api.base_url} BOT_TOKEN={args.token}")
+            await _wait(lambda: api.calls['getUpdates'] or api.webhook_set, args.duration)
+            await users.register()
+            users.arm()
+            deadline = time.perf_counter() + args.duration
+            while time.perf_counter() < deadline:
+                await asyncio.sleep(min(30, max(0.0, deadline - time.perf_counter())))
+                _report(api, users)
+            return
+
+        duration = await _run_bot(api, users, args.mode)
+        _report(api, users, duration)
+        print(f"Отключено ботом (заблокировали): {_count_inactive()}")
+    finally:
+        await api.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--mode', choices=('polling', 'webhook'), default='polling')
+    parser.add_argument('--think-ms', type=float, default=2000, help="средняя пауза пользователя перед ответом")
+    parser.add_argument('--rtt-ms', type=float, default=40, help="задержка Bot API на вызов")
+    parser.add_argument('--enforce-limits', action='store_true', help="429 при превышении лимитов Telegram")
+    parser.add_argument('--rate-429', type=float, default=0, help="доля отправок с ответом 429")
+    parser.add_argument('--rate-403', type=float, default=0, help="доля пользователей, заблокировавших бота")
+    parser.add_argument('--external', action='store_true', help="не запускать бот, только Bot API и пользователей")
+    parser.add_argument('--port', type=int, default=8081, help="порт Bot API для --external")
+    parser.add_argument('--token', default=BENCH_TOKEN)
+    parser.add_argument('--duration', type=float, default=600, help="сколько работать с --external, секунд")
+    args = parser.parse_args()
+
+    if not args.external:
+        from database import create_tables
+        create_tables()
+    asyncio.run(_main(args))
+
+
+if __name__ == '__main__':
+    main()
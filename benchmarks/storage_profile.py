@@ -0,0 +1,129 @@
+"""
+Профили хранения SQLite: настройки по умолчанию против WAL с подобранными PRAGMA.
+
+Для каждого профиля в отдельном процессе (DATABASE_URL читается при импорте
+database) поднимает временную базу и в течение --seconds секунд параллельно
+пишет оценки (save_pain_rating) и читает /stats (_load_user_stats) через run_db.
+Печатает пропускную способность и p50/p99 задержек записи и чтения.
+
+    python -m benchmarks.storage_profile [--seconds 10] [--writers 20] [--readers 20]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def _load(seconds, writers, readers, users):
+    from database import run_db, save_pain_rating
+    from user_handlers import _load_user_stats
+
+    write_latencies = []
+    read_latencies = []
+    errors = 0
+    deadline = time.perf_counter() + seconds
+
+    async def writer():
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                await run_db(save_pain_rating, random.randrange(users), random.randint(1, 5))
+            except Exception:
+                errors += 1
+                continue
+            write_latencies.append(time.perf_counter() - started)
+
+    async def reader():
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                await run_db(_load_user_stats, random.randrange(users))
+            except Exception:
+                errors += 1
+                continue
+            read_latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*[writer() for _ in range(writers)], *[reader() for _ in range(readers)])
+    return write_latencies, read_latencies, errors
+
+
+def _child(profile, args):
+    tmp_dir = tempfile.mkdtemp(prefix="spina_bench_")
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tmp_dir, 'bench.db')}?profile={profile}"
+
+    from database import SessionLocal, User, create_tables, save_pain_rating
+
+    create_tables()
+    db = SessionLocal()
+    db.add_all([User(telegram_id=i) for i in range(args.users)])
+    db.commit()
+    random.seed(1)
+    for _ in range(args.users):
+        save_pain_rating(db, random.randrange(args.users), random.randint(1, 5))
+    db.close()
+
+    writes, reads, errors = asyncio.run(_load(args.seconds, args.writers, args.readers, args.users))
+    print(json.dumps({
+        'profile': profile,
+        'writes': len(writes),
+        'reads': len(reads),
+        'errors': errors,
+        'write_p50': _percentile(writes, 0.5),
+        'write_p99': _percentile(writes, 0.99),
+        'read_p50': _percentile(reads, 0.5),
+        'read_p99': _percentile(reads, 0.99),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--writers', type=int, default=20)
+    parser.add_argument('--readers', type=int, default=20)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--profiles', nargs='+', default=['default', 'tuned'])
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        _child(args.child, args)
+        return
+
+    results = []
+    for profile in args.profiles:
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.storage_profile', '--child', profile,
+             '--seconds', str(args.seconds), '--writers', str(args.writers),
+             '--readers', str(args.readers), '--users', str(args.users)],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f"Писателей: {args.writers}, читателей: {args.readers}, пользователей: {args.users}, "
+          f"{args.seconds:.0f} с на профиль")
+    print(f"{'профиль':<10}{'записей/с':>11}{'чтений/с':>10}{'ошибок':>8}"
+          f"{'запись p50/p99, мс':>22}{'чтение p50/p99, мс':>22}")
+    for r in results:
+        write_ms = f"{r['write_p50'] * 1000:.1f}/{r['write_p99'] * 1000:.1f}"
+        read_ms = f"{r['read_p50'] * 1000:.1f}/{r['read_p99'] * 1000:.1f}"
+        print(f"{r['profile']:<10}{r['writes'] / args.seconds:>11.0f}{r['reads'] / args.seconds:>10.0f}"
+              f"{r['errors']:>8}{write_ms:>22}{read_ms:>22}")
+
+
+if __name__ == '__main__':
+    main()
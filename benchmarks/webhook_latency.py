@@ -0,0 +1,212 @@
+"""
+Задержка реакции на нажатие кнопки: long polling против webhook.
+
+По умолчанию поднимает бота в этом процессе с поддельным Bot API
+(benchmarks/fake_telegram.py) и для каждого режима подает одни и те же
+апдейты: в polling - через очередь getUpdates, в webhook - POST-запросами
+на встроенный HTTP сервер. Задержка - время от появления апдейта до первого
+вызова Bot API в ответ на него (answerCallbackQuery). Сетевая задержка до
+Telegram эмулируется параметром --rtt-ms.
+
+С --url записанные апдейты (--file, JSON по одному на строку) отправляются
+на уже запущенный в режиме webhook бот; печатается время ответа сервера.
+
+Апдейты разных пользователей обрабатываются параллельно (UPDATE_CONCURRENCY,
+update_processor.py); при UPDATE_CONCURRENCY=1 и --rate выше пропускной
+способности обработчиков обе задержки определяет очередь.
+
+    python -m benchmarks.webhook_latency [--updates 200] [--rate 5] [--rtt-ms 60]
+    python -m benchmarks.webhook_latency --url http://127.0.0.1:8443/telegram --secret S --file updates.jsonl
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import socket
+import tempfile
+import time
+
+_tmp_dir = tempfile.mkdtemp(prefix="spina_bench_")
+os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(_tmp_dir, 'bench.db')}")
+
+from benchmarks.fake_telegram import FakeTelegramRequest, callback_update, update_key  # noqa: E402
+from benchmarks.http_client import HTTPClient  # noqa: E402
+from webhook import SECRET_HEADER, WebhookConfig, serve_webhook  # noqa: E402
+
+BENCH_TOKEN = "123456:bench"
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def _synthetic_updates(count: int, users: int):
+    random.seed(1)
+    return [callback_update(i + 1, 10_000 + random.randrange(users), f"pain_{random.randint(1, 5)}")
+            for i in range(count)]
+
+
+async def _feed(updates, rate, deliver):
+    """Подавать апдейты с частотой rate в секунду; возвращает время появления каждого"""
+    injected = {}
+    interval = 1 / rate
+    started = time.perf_counter()
+    tasks = []
+    for i, update in enumerate(updates):
+        delay = started + i * interval - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        injected[update_key(update)] = time.perf_counter()
+        tasks.append(asyncio.create_task(deliver(update)))
+    await asyncio.gather(*tasks)
+    return injected
+
+
+async def _wait_replies(fake, keys, timeout=60):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline and any(key not in fake.first_reply for key in keys):
+        await asyncio.sleep(0.01)
+
+
+def _latencies(fake, injected):
+    return [fake.first_reply[key] - at for key, at in injected.items() if key in fake.first_reply]
+
+
+async def _run_polling(updates, rate, rtt):
+    from main import ALLOWED_UPDATES, SpinaBot
+
+    fake = FakeTelegramRequest(rtt=rtt)
+    application = SpinaBot(token=BENCH_TOKEN, request=fake).application
+    await application.initialize()
+    await application.start()
+    await application.updater.start_polling(poll_interval=0, timeout=10, allowed_updates=ALLOWED_UPDATES)
+    try:
+        async def deliver(update):
+            fake.inject(update)
+
+        injected = await _feed(updates, rate, deliver)
+        await _wait_replies(fake, injected)
+    finally:
+        await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+    return _latencies(fake, injected)
+
+
+async def _run_webhook(updates, rate, rtt, connections):
+    from main import ALLOWED_UPDATES, SpinaBot
+
+    fake = FakeTelegramRequest(rtt=rtt)
+    application = SpinaBot(token=BENCH_TOKEN, request=fake).application
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    config = WebhookConfig(url=None, listen='127.0.0.1', port=port, path='/telegram', secret='bench')
+    stop = asyncio.Event()
+    server = asyncio.create_task(serve_webhook(application, config, ALLOWED_UPDATES, stop_event=stop))
+    while not application.running:
+        await asyncio.sleep(0.01)
+
+    clients = asyncio.Queue()
+    for _ in range(connections):
+        clients.put_nowait(HTTPClient(f"http://127.0.0.1:{port}/telegram"))
+
+    async def deliver(update):
+        # Telegram -> бот: полкруга сетевой задержки до POST
+        if rtt:
+            await asyncio.sleep(rtt / 2)
+        client = await clients.get()
+        try:
+            await client.post(json.dumps(update).encode(), {SECRET_HEADER: config.secret})
+        finally:
+            clients.put_nowait(client)
+
+    try:
+        injected = await _feed(updates, rate, deliver)
+        await _wait_replies(fake, injected)
+    finally:
+        while not clients.empty():
+            await clients.get_nowait().close()
+        stop.set()
+        await server
+    return _latencies(fake, injected)
+
+
+async def _replay(url, secret, updates, rate, connections):
+    """Отправить записанные апдейты на внешний webhook и замерить время ответа"""
+    clients = asyncio.Queue()
+    for _ in range(connections):
+        clients.put_nowait(HTTPClient(url))
+    timings = []
+    statuses = {}
+
+    async def deliver(update):
+        client = await clients.get()
+        try:
+            started = time.perf_counter()
+            status = await client.post(json.dumps(update).encode(), {SECRET_HEADER: secret})
+            timings.append(time.perf_counter() - started)
+            statuses[status] = statuses.get(status, 0) + 1
+        finally:
+            clients.put_nowait(client)
+
+    await _feed(updates, rate, deliver)
+    while not clients.empty():
+        await clients.get_nowait().close()
+    return timings, statuses
+
+
+def _print_row(name, latencies):
+    print(f"{name:<10}{len(latencies):>8}{_percentile(latencies, 0.5) * 1000:>10.1f}"
+          f"{_percentile(latencies, 0.95) * 1000:>10.1f}{_percentile(latencies, 0.99) * 1000:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--updates', type=int, default=200, help="сколько синтетических апдейтов подать")
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--rate', type=float, default=5, help="апдейтов в секунду")
+    parser.add_argument('--rtt-ms', type=float, default=60, help="эмулируемая задержка до Telegram")
+    parser.add_argument('--connections', type=int, default=40, help="параллельных соединений к webhook")
+    parser.add_argument('--file', help="записанные апдейты, JSON по одному на строку")
+    parser.add_argument('--url', help="адрес запущенного webhook для воспроизведения")
+    parser.add_argument('--secret', default='', help="WEBHOOK_SECRET запущенного бота")
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, encoding='utf-8') as f:
+            updates = [json.loads(line) for line in f if line.strip()]
+    else:
+        updates = _synthetic_updates(args.updates, args.users)
+
+    if args.url:
+        timings, statuses = asyncio.run(_replay(args.url, args.secret, updates, args.rate, args.connections))
+        print(f"Апдейтов: {len(updates)}, статусы ответов: {statuses}")
+        print(f"{'':<10}{'ответов':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}")
+        _print_row("webhook", timings)
+        return
+
+    from database import create_tables
+    create_tables()
+    # Журнал обработчиков (main настраивает INFO) искажает замер
+    logging.getLogger().setLevel(logging.ERROR)
+
+    rtt = args.rtt_ms / 1000
+    results = [
+        ("polling", asyncio.run(_run_polling(updates, args.rate, rtt))),
+        ("webhook", asyncio.run(_run_webhook(updates, args.rate, rtt, args.connections))),
+    ]
+    print(f"Апдейтов: {len(updates)}, {args.rate:.0f}/с, RTT до Telegram {args.rtt_ms:.0f} мс")
+    print(f"{'режим':<10}{'ответов':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}")
+    for name, latencies in results:
+        _print_row(name, latencies)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,321 @@
+"""
+Движок массовых рассылок для Spina Bot.
+
+Отправляет сообщения с ограниченной конкурентностью под общим token bucket,
+настроенным на лимиты Telegram (~30 сообщений в секунду глобально и не чаще
+одного сообщения в секунду в один чат).
+"""
+
+import asyncio
+import logging
+import os
+import time
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram Bot API (BROADCAST_RATE_LIMIT выше 30 - для платных рассылок и замеров)
+GLOBAL_RATE_LIMIT = float(os.getenv('BROADCAST_RATE_LIMIT', '30'))  # сообщений в секунду на бота
+PER_CHAT_INTERVAL = 1.0      # секунд между сообщениями в один чат
+DEFAULT_CONCURRENCY = 20     # одновременных запросов к API
+MAX_SEND_ATTEMPTS = 3        # попыток на одно сообщение при сетевых ошибках
+PER_CHAT_TRACK_LIMIT = 10000 # после скольких чатов чистить историю отправок
+
+# Отдельный пул соединений Bot API для рассылок: массовые отправки не занимают
+# соединения, через которые бот отвечает пользователям (см. main.bulk_request)
+BULK_POOL_SIZE = int(os.getenv('BULK_POOL_SIZE', '64'))
+BULK_POOL_TIMEOUT = float(os.getenv('BULK_POOL_TIMEOUT', '30'))   # рассылка может подождать соединение
+BULK_READ_TIMEOUT = float(os.getenv('BULK_READ_TIMEOUT', '20'))   # видео отправляется дольше ответа на кнопку
+
+# Итог отправки одного сообщения (для колбэка on_result)
+SEND_SENT = 'sent'
+SEND_BLOCKED = 'blocked'
+SEND_FAILED = 'failed'       # постоянная ошибка, повтор бесполезен
+SEND_RETRY = 'retry'         # временная ошибка, попытки в рамках рассылки исчерпаны
+
+# Растягивание рассылки на окно доставки
+PACE_INTERVAL = 5.0          # секунд между пересчетами темпа
+MIN_PACED_RATE = 0.2         # сообщений в секунду, ниже которых темп не опускается
+
+
+class TokenBucket:
+    """Token bucket с возможностью приостановки (для RetryAfter)"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def set_rate(self, rate: float):
+        """Изменить скорость выдачи токенов, не допуская всплеска накопленных токенов"""
+        now = time.monotonic()
+        if now > self._updated:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self._tokens = min(self._tokens, self.capacity)
+
+    def pause(self, seconds: float):
+        """Приостановить выдачу токенов всем отправителям"""
+        until = time.monotonic() + seconds
+        if until > self._paused_until:
+            self._paused_until = until
+            # После паузы начинаем с пустого ведра, чтобы не получить всплеск
+            self._tokens = 0.0
+            self._updated = until
+
+    async def acquire(self):
+        """Дождаться одного токена"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                elapsed = now - self._updated
+                self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+                self._updated = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class BroadcastStats:
+    """Итоги рассылки"""
+
+    def __init__(self):
+        self.total = 0
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        self.retry_after_pauses = 0
+        self.started_at = time.monotonic()
+        self.finished_at = None
+
+    @property
+    def duration(self) -> float:
+        end = self.finished_at if self.finished_at is not None else time.monotonic()
+        return end - self.started_at
+
+    @property
+    def rate(self) -> float:
+        """Фактическая пропускная способность, сообщений в секунду"""
+        duration = self.duration
+        return self.sent / duration if duration > 0 else 0.0
+
+    def __str__(self):
+        return (
+            f"отправлено {self.sent} из {self.total}, заблокировали бота {self.blocked}, "
+            f"ошибок {self.failed}, пауз RetryAfter {self.retry_after_pauses}, "
+            f"за {self.duration:.1f} с ({self.rate:.1f} сообщ./с)"
+        )
+
+
+def is_blocked_error(error: Exception) -> bool:
+    """Пользователь заблокировал бота или удалил аккаунт"""
+    if isinstance(error, Forbidden):
+        return True
+    message = str(error).lower()
+    return "blocked" in message or "user not found" in message or "chat not found" in message
+
+
+class WindowPacer:
+    """Темп рассылки, растягивающий ее на окно доставки.
+
+    Каждые PACE_INTERVAL секунд скорость пересчитывается как оставшиеся
+    сообщения / оставшееся время окна и умножается на коэффициент
+    замедления монитора нагрузки. Недоотправленное при замедлении
+    наверстывается позже, так как оставшееся время сокращается.
+    После конца окна рассылка идет с максимальной скоростью.
+    """
+
+    def __init__(self, total: int, window_seconds: float, monitor=None, max_rate: float = GLOBAL_RATE_LIMIT):
+        self.total = total
+        self.window_seconds = window_seconds
+        self.monitor = monitor
+        self.max_rate = max_rate
+
+    def rate_for(self, done: int, elapsed: float) -> float:
+        """Скорость после done обработанных сообщений через elapsed секунд от начала"""
+        remaining_time = self.window_seconds - elapsed
+        if remaining_time <= 0:
+            return self.max_rate
+        rate = max(self.total - done, 0) / remaining_time
+        if self.monitor is not None:
+            rate *= self.monitor.slowdown_factor()
+        return min(self.max_rate, max(MIN_PACED_RATE, rate))
+
+    def apply(self, bucket: TokenBucket, stats: BroadcastStats):
+        done = stats.sent + stats.failed + stats.blocked
+        bucket.set_rate(self.rate_for(done, stats.duration))
+
+    async def run(self, bucket: TokenBucket, stats: BroadcastStats):
+        """Периодически подстраивать скорость bucket до отмены задачи"""
+        while True:
+            await asyncio.sleep(PACE_INTERVAL)
+            self.apply(bucket, stats)
+
+
+class BroadcastEngine:
+    """Конкурентная рассылка под общим ограничением скорости"""
+
+    def __init__(self, rate: float = GLOBAL_RATE_LIMIT, concurrency: int = DEFAULT_CONCURRENCY,
+                 per_chat_interval: float = PER_CHAT_INTERVAL, max_attempts: int = MAX_SEND_ATTEMPTS,
+                 governed: bool = False):
+        """governed - send уже идет через ограничитель вызовов (governor.py): лимит
+        скорости, темп по чатам и паузы после RetryAfter задает он, а свой bucket движка только
+        растягивает рассылку темпом WindowPacer; rate тогда - целевая скорость
+        для метрик."""
+        self.bucket = TokenBucket(rate)
+        self.governed = governed
+        self._paced = False
+        self.concurrency = concurrency
+        self.per_chat_interval = per_chat_interval
+        self.max_attempts = max_attempts
+        self._last_sent_to_chat = {}
+
+    async def run(self, recipients, send, on_blocked=None, name: str = "рассылка",
+                  pacer: WindowPacer = None, on_result=None, stopped=None) -> BroadcastStats:
+        """
+        Разослать сообщение всем получателям.
+
+        recipients - итерируемый (или асинхронно итерируемый) набор chat_id,
+        send - корутина send(chat_id), выполняющая один вызов Bot API,
+        on_blocked - необязательный колбэк on_blocked(chat_id) для пользователей,
+        заблокировавших бота,
+        pacer - необязательный WindowPacer, растягивающий рассылку на окно доставки,
+        on_result - необязательный колбэк on_result(chat_id, итог SEND_*, ошибка или None)
+        для каждого получателя,
+        stopped - необязательная функция stopped() -> bool: когда она возвращает True,
+        сообщения, уже стоящие в очереди, не отправляются и on_result для них не вызывается.
+        """
+        stats = BroadcastStats()
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+
+        pacer_task = None
+        self._paced = pacer is not None
+        if pacer is not None:
+            pacer.apply(self.bucket, stats)
+            pacer_task = asyncio.create_task(pacer.run(self.bucket, stats))
+        metrics.broadcast_started(self.bucket.rate)
+
+        async def worker():
+            while True:
+                chat_id = await queue.get()
+                try:
+                    if chat_id is None:
+                        return
+                    await self._send_one(chat_id, send, stats, on_blocked, on_result, stopped)
+                finally:
+                    queue.task_done()
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            if hasattr(recipients, '__aiter__'):
+                async for chat_id in recipients:
+                    stats.total += 1
+                    metrics.broadcast_enqueued()
+                    await queue.put(chat_id)
+            else:
+                for chat_id in recipients:
+                    stats.total += 1
+                    metrics.broadcast_enqueued()
+                    await queue.put(chat_id)
+
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            if pacer_task is not None:
+                pacer_task.cancel()
+            stats.finished_at = time.monotonic()
+            metrics.broadcast_finished(stats.total - stats.sent - stats.failed - stats.blocked, stats.rate)
+
+        logger.info(f"{name.capitalize()} завершена: {stats}")
+        return stats
+
+    async def _wait_for_chat(self, chat_id: int):
+        """Соблюдаем лимит Telegram на частоту сообщений в один чат"""
+        last_sent = self._last_sent_to_chat.get(chat_id)
+        if last_sent is not None:
+            delay = last_sent + self.per_chat_interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        now = time.monotonic()
+        if len(self._last_sent_to_chat) >= PER_CHAT_TRACK_LIMIT:
+            # Храним только чаты, которым писали в пределах интервала
+            self._last_sent_to_chat = {
+                chat: sent for chat, sent in self._last_sent_to_chat.items()
+                if now - sent < self.per_chat_interval
+            }
+        self._last_sent_to_chat[chat_id] = now
+
+    async def _send_one(self, chat_id: int, send, stats: BroadcastStats, on_blocked, on_result, stopped=None):
+        attempts = 0
+        while True:
+            if not self.governed or self._paced:
+                await self.bucket.acquire()
+            if stopped is not None and stopped():
+                return
+            if not self.governed:
+                await self._wait_for_chat(chat_id)
+            try:
+                await send(chat_id)
+                stats.sent += 1
+                metrics.broadcast_progress(SEND_SENT, self.bucket.rate)
+                if on_result is not None:
+                    on_result(chat_id, SEND_SENT, None)
+                return
+            except RetryAfter as e:
+                # Telegram просит подождать - приостанавливаем всю рассылку, а не одно сообщение
+                stats.retry_after_pauses += 1
+                logger.warning(f"RetryAfter {e.retry_after} с, рассылка приостановлена")
+                # С ограничителем вызовов паузу держит он: повтор дождется ее там
+                if not self.governed:
+                    self.bucket.pause(e.retry_after)
+            except BadRequest as e:
+                self._mark_error(chat_id, e, stats, on_blocked, on_result)
+                metrics.broadcast_progress(SEND_BLOCKED if is_blocked_error(e) else SEND_FAILED, self.bucket.rate)
+                return
+            except NetworkError as e:
+                # Таймауты и сетевые сбои повторяем несколько раз
+                attempts += 1
+                if attempts >= self.max_attempts:
+                    stats.failed += 1
+                    metrics.broadcast_progress(SEND_RETRY, self.bucket.rate)
+                    logger.error(f"Не удалось отправить сообщение пользователю {chat_id}: {e}")
+                    if on_result is not None:
+                        on_result(chat_id, SEND_RETRY, e)
+                    return
+            except Exception as e:
+                self._mark_error(chat_id, e, stats, on_blocked, on_result)
+                metrics.broadcast_progress(SEND_BLOCKED if is_blocked_error(e) else SEND_FAILED, self.bucket.rate)
+                return
+
+    @staticmethod
+    def _mark_error(chat_id: int, error: Exception, stats: BroadcastStats, on_blocked, on_result):
+        if is_blocked_error(error):
+            stats.blocked += 1
+            if on_blocked is not None:
+                on_blocked(chat_id)
+            outcome = SEND_BLOCKED
+        else:
+            stats.failed += 1
+            logger.error(f"Ошибка отправки сообщения пользователю {chat_id}: {error}")
+            outcome = SEND_FAILED
+        if on_result is not None:
+            on_result(chat_id, outcome, error)
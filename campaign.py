@@ -0,0 +1,228 @@
+"""
+Рассылки администратора (кампании): текст или видео активным пользователям.
+
+Кампания - запуск рассылки типа 'campaign' в outbox (outbox.py). Получатели
+записываются в outbox одним INSERT ... SELECT и разбираются пачками по
+OUTBOX_BATCH_SIZE под общим лимитом скорости Telegram, так что список
+пользователей не загружается в память. Пока кампания идет, сообщение
+администратора с ее ходом обновляется раз в CAMPAIGN_PROGRESS_INTERVAL
+секунд; кнопки под ним ставят кампанию на паузу, возобновляют и отменяют ее.
+
+Одновременно может идти или стоять на паузе только одна кампания: это
+гарантирует частичный уникальный индекс broadcast_runs, а не только
+проверка в этом процессе.
+"""
+
+import asyncio
+import json
+import logging
+from datetime import datetime
+
+from sqlalchemy.exc import IntegrityError
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, MessageEntity
+from telegram.error import BadRequest
+
+import outbox
+from database import (
+    run_db, create_broadcast_run, fetch_active_run, fetch_broadcast_run, fetch_unfinished_runs,
+    count_outbox_by_status
+)
+
+logger = logging.getLogger(__name__)
+
+CAMPAIGN_KIND = 'campaign'
+CAMPAIGN_PROGRESS_INTERVAL = 5.0  # секунд между обновлениями сообщения о ходе рассылки
+
+# Аудитории (database.audience_condition) и их названия для администратора
+AUDIENCES = {
+    'all': "Все активные пользователи",
+    'recent': "Оценивали боль за последние 7 дней",
+    'silent': "Не оценивали боль 7 дней",
+}
+
+STATUS_TEXT = {
+    'running': "▶️ идет",
+    'paused': "⏸ на паузе",
+    'cancelled': "⏹ отменена",
+    'done': "✅ завершена",
+}
+
+# Задачи обновления сообщений о ходе рассылки по id запуска
+_watchers = {}
+
+
+def _campaign_sender(bot, payload):
+    """Отправка сообщения кампании одному пользователю (для outbox)"""
+    text = payload.get('text')
+    entities = [MessageEntity.de_json(entity, bot) for entity in payload.get('entities') or []] or None
+    video = payload.get('video')
+
+    async def send(chat_id):
+        if video:
+            await bot.send_video(chat_id=chat_id, video=video, caption=text, caption_entities=entities)
+        else:
+            await bot.send_message(chat_id=chat_id, text=text, entities=entities)
+
+    return send
+
+
+outbox.register_sender(CAMPAIGN_KIND, _campaign_sender)
+
+
+def message_payload(message, audience: str):
+    """Сообщение кампании из сообщения администратора: текст или видео с подписью.
+
+    Форматирование сохраняется как entities, поэтому текст не разбирается
+    как Markdown. None если сообщение не текст и не видео.
+    """
+    if message.video:
+        entities = message.caption_entities
+        payload = {'video': message.video.file_id, 'text': message.caption}
+    elif message.text:
+        entities = message.entities
+        payload = {'text': message.text}
+    else:
+        return None
+    payload['entities'] = [entity.to_dict() for entity in entities or ()]
+    payload['audience'] = audience
+    return payload
+
+
+def _create_campaign_run(db, run_key, audience, payload):
+    try:
+        return create_broadcast_run(db, run_key, CAMPAIGN_KIND, audience=audience, payload=payload)[0]
+    except IntegrityError:
+        # Другая кампания уже идет или стоит на паузе
+        db.rollback()
+        return None
+
+
+async def start_campaign(application, admin_id: int, payload: dict, chat_id: int, message_id: int):
+    """Создать кампанию и начать доставку; id запуска или None, если уже есть незавершенная.
+
+    chat_id и message_id - сообщение, в котором показывается ход рассылки.
+    """
+    encoded = json.dumps(dict(payload, progress=[chat_id, message_id]))
+    run_key = f"{CAMPAIGN_KIND}:{admin_id}:{datetime.utcnow():%Y%m%d%H%M%S%f}"
+    run_id = await run_db(_create_campaign_run, run_key, payload['audience'], encoded)
+    if run_id is None:
+        return None
+    logger.info(f"Администратор {admin_id} запустил рассылку {run_id} ({payload['audience']})")
+    if not outbox.BROADCAST_WORKERS:
+        application.create_task(
+            outbox.deliver_run(application.bot, run_id, CAMPAIGN_KIND, f"рассылка {run_id}", payload=encoded)
+        )
+    watch_progress(application, run_id, chat_id, message_id)
+    return run_id
+
+
+async def active_campaign():
+    """Незавершенная кампания: строка (id, status) или None"""
+    return await run_db(fetch_active_run, CAMPAIGN_KIND)
+
+
+def _progress(db, run_id):
+    run = fetch_broadcast_run(db, run_id)
+    if run is None:
+        return None, {}
+    return run, count_outbox_by_status(db, run_id)
+
+
+def progress_keyboard(run_id: int, status: str):
+    """Кнопки управления кампанией для ее статуса"""
+    if status == 'running':
+        buttons = [InlineKeyboardButton("⏸ Пауза", callback_data=f"campaign_pause_{run_id}")]
+    elif status == 'paused':
+        buttons = [InlineKeyboardButton("▶️ Продолжить", callback_data=f"campaign_resume_{run_id}")]
+    else:
+        return None
+    buttons.append(InlineKeyboardButton("⏹ Отменить", callback_data=f"campaign_cancel_{run_id}"))
+    return InlineKeyboardMarkup([buttons])
+
+
+def render_progress(run, counts: dict) -> str:
+    """Текст сообщения о ходе рассылки"""
+    payload = json.loads(run.payload) if run.payload else {}
+    done = run.total - counts.get('pending', 0) - counts.get('cancelled', 0)
+    text = (
+        f"📢 *Рассылка #{run.id}*\n\n"
+        f"Аудитория: {AUDIENCES.get(payload.get('audience'), '-')}\n"
+        f"Сообщение: {'видео' if payload.get('video') else 'текст'}\n"
+        f"Статус: {STATUS_TEXT.get(run.status, run.status)}\n\n"
+        f"Обработано: {done} из {run.total}\n"
+        f"Доставлено: {counts.get('sent', 0)}\n"
+        f"Заблокировали бота: {counts.get('blocked', 0)}\n"
+        f"Ошибок: {counts.get('failed', 0)}"
+    )
+    if counts.get('cancelled'):
+        text += f"\nНе отправлено (отмена): {counts['cancelled']}"
+    return text
+
+
+async def show_progress(bot, run_id: int, chat_id: int, message_id: int):
+    """Обновить сообщение о ходе рассылки; статус запуска"""
+    run, counts = await run_db(_progress, run_id)
+    if run is None:
+        return None
+    try:
+        await bot.edit_message_text(
+            render_progress(run, counts), chat_id=chat_id, message_id=message_id,
+            reply_markup=progress_keyboard(run.id, run.status), parse_mode='Markdown'
+        )
+    except BadRequest as e:
+        # Ничего не изменилось с прошлого обновления или сообщение удалено
+        if "not modified" not in str(e).lower():
+            logger.warning(f"Не удалось обновить ход рассылки {run_id}: {e}")
+    return run.status
+
+
+async def _watch(bot, run_id, chat_id, message_id):
+    try:
+        while True:
+            await asyncio.sleep(CAMPAIGN_PROGRESS_INTERVAL)
+            if await show_progress(bot, run_id, chat_id, message_id) != 'running':
+                return
+    finally:
+        _watchers.pop(run_id, None)
+
+
+def watch_progress(application, run_id: int, chat_id: int, message_id: int):
+    """Обновлять сообщение о ходе рассылки, пока она идет"""
+    if run_id in _watchers:
+        return
+    _watchers[run_id] = application.create_task(_watch(application.bot, run_id, chat_id, message_id))
+
+
+async def pause_campaign(run_id: int) -> bool:
+    """Приостановить кампанию; False если она не идет"""
+    return await outbox.pause_run(run_id)
+
+
+async def resume_campaign(application, run_id: int, chat_id: int, message_id: int) -> bool:
+    """Продолжить приостановленную кампанию и снова показывать ее ход"""
+    run = await run_db(fetch_broadcast_run, run_id)
+    if run is None or run.kind != CAMPAIGN_KIND:
+        return False
+    if not await outbox.resume_run(application, run_id, CAMPAIGN_KIND, f"рассылка {run_id}", payload=run.payload):
+        return False
+    watch_progress(application, run_id, chat_id, message_id)
+    return True
+
+
+async def cancel_campaign(run_id: int) -> bool:
+    """Отменить кампанию: неотправленные сообщения не будут отправлены"""
+    counts = await outbox.cancel_run(run_id)
+    if counts is None:
+        return False
+    logger.info(f"Рассылка {run_id} отменена, не отправлено {counts.get('cancelled', 0)}")
+    return True
+
+
+async def resume_progress_watchers(application):
+    """Снова обновлять ход кампаний, которые шли до перезапуска бота (из post_init)"""
+    for run in await run_db(fetch_unfinished_runs):
+        if run.kind != CAMPAIGN_KIND or not run.payload:
+            continue
+        progress = json.loads(run.payload).get('progress')
+        if progress:
+            watch_progress(application, run.id, *progress)
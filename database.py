@@ -1,12 +1,21 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, Text, Float
+from sqlalchemy import create_engine, event, make_url, Column, Integer, String, Date, DateTime, Boolean, Text, Float, Index, bindparam, text, select, insert, update, delete, literal, func, case
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import NamedTuple, Optional
+from zoneinfo import ZoneInfo
+import asyncio
+import contextvars
+import logging
 import os
+import threading
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 Base = declarative_base()
 
 class User(Base):
@@ -21,6 +30,23 @@ class User(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     last_pain_rating = Column(Integer, nullable=True)
     last_rating_date = Column(DateTime, nullable=True)
+    # Персональное время напоминания: часовой пояс (IANA), минута суток
+    # по местному времени и она же в UTC - номер минутной корзины рассылки
+    timezone = Column(String, nullable=True)
+    reminder_minute = Column(Integer, nullable=True)
+    reminder_utc_minute = Column(Integer, nullable=True)
+    
+    __table_args__ = (
+        # Постраничный обход активных пользователей для рассылки
+        Index('ix_users_active_id', 'is_active', 'id'),
+        # Получатели одной минутной корзины персональных напоминаний
+        Index('ix_users_reminder_bucket', 'reminder_utc_minute', 'is_active', 'id'),
+        # Поиск по началу username без учета регистра и постраничный обход его результатов
+        Index('ix_users_username_lower_id', func.lower(username), 'id'),
+        # Списки администратора: оценивавшие недавно и по последней оценке
+        Index('ix_users_active_rating_date_id', 'is_active', 'last_rating_date', 'id'),
+        Index('ix_users_last_pain_rating_id', 'last_pain_rating', 'id'),
+    )
 
 class VideoLesson(Base):
     __tablename__ = 'video_lessons'
@@ -33,6 +59,11 @@ class VideoLesson(Base):
     duration = Column(Integer, nullable=True)  # в секундах
     created_at = Column(DateTime, default=datetime.utcnow)
     created_by_admin = Column(Integer, nullable=False)
+    
+    __table_args__ = (
+        # Один видео-урок на уровень боли
+        Index('ux_video_lessons_pain_level', 'pain_level', unique=True),
+    )
 
 class BotSettings(Base):
     __tablename__ = 'bot_settings'
@@ -50,20 +81,138 @@ class UserResponse(Base):
     user_id = Column(Integer, nullable=False)
     pain_rating = Column(Integer, nullable=False)
     response_date = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        # Ответы пользователя за период и последний ответ
+        Index('ix_user_responses_user_date', 'user_id', 'response_date'),
+    )
+
+class UserStats(Base):
+    """Агрегаты ответов пользователя, обновляются вместе с каждой оценкой"""
+    __tablename__ = 'user_stats'
+    
+    user_id = Column(Integer, primary_key=True)  # telegram_id, как в user_responses
+    total_count = Column(Integer, nullable=False, default=0)
+    rating_sum = Column(Integer, nullable=False, default=0)
+    count_1 = Column(Integer, nullable=False, default=0)
+    count_2 = Column(Integer, nullable=False, default=0)
+    count_3 = Column(Integer, nullable=False, default=0)
+    count_4 = Column(Integer, nullable=False, default=0)
+    count_5 = Column(Integer, nullable=False, default=0)
+    last_rating = Column(Integer, nullable=True)
+    last_response_date = Column(DateTime, nullable=True)
+    
+    def level_counts(self) -> dict:
+        """Количество ответов по уровням боли"""
+        return {level: getattr(self, f'count_{level}') for level in range(1, 6)}
+
+class DailyRatingStats(Base):
+    """Количество ответов по дням и уровням боли для панели администратора"""
+    __tablename__ = 'daily_rating_stats'
+    
+    day = Column(Date, primary_key=True)
+    pain_level = Column(Integer, primary_key=True)
+    response_count = Column(Integer, nullable=False, default=0)
+
+class BroadcastRun(Base):
+    """Запуск рассылки; run_key делает повторный запуск того же дня идемпотентным"""
+    __tablename__ = 'broadcast_runs'
+    
+    id = Column(Integer, primary_key=True)
+    run_key = Column(String, unique=True, nullable=False)
+    kind = Column(String, nullable=False)  # тип сообщения, см. outbox.register_sender
+    status = Column(String, nullable=False, default='running')  # running, paused, cancelled, done
+    total = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+    payload = Column(Text, nullable=True)  # JSON сообщения рассылки администратора (кампании)
+    
+    __table_args__ = (
+        # Не больше одной незавершенной кампании: вторую база не даст создать
+        Index('ux_broadcast_runs_active_campaign', 'kind', unique=True,
+              sqlite_where=text("kind = 'campaign' AND status IN ('running', 'paused')"),
+              postgresql_where=text("kind = 'campaign' AND status IN ('running', 'paused')")),
+    )
+
+class OutboxMessage(Base):
+    """Сообщение рассылки одному пользователю"""
+    __tablename__ = 'outbox'
+    
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, nullable=False)
+    telegram_id = Column(Integer, nullable=False)
+    status = Column(String, nullable=False, default='pending')  # pending, sent, blocked, failed, cancelled
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    last_error = Column(String, nullable=True)
+    updated_at = Column(DateTime, nullable=True)
+    # Аренда: процесс, который сейчас отправляет сообщение, и до какого времени
+    lease_owner = Column(String, nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
+    
+    __table_args__ = (
+        # Выборка неотправленных сообщений запуска по порядку
+        Index('ix_outbox_run_status_id', 'run_id', 'status', 'id'),
+    )
 
 # Database setup
 DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///spina_bot.db')
 
+# Профили хранения SQLite: PRAGMA, применяемые к каждому новому соединению.
+# Профиль выбирается параметром profile в DATABASE_URL
+# (sqlite:///data/spina_bot.db?profile=default) или переменной DB_PROFILE.
+SQLITE_PROFILES = {
+    # Настройки SQLite по умолчанию: rollback journal и полный fsync на каждый коммит
+    'default': {},
+    # WAL: читатели не блокируют писателя, fsync только при чекпоинте
+    'tuned': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,          # мс ожидания блокировки вместо "database is locked"
+        'mmap_size': 64 * 1024 * 1024,  # байт; контейнер ограничен 256M
+        'cache_size': -16000,          # КиБ на соединение (отрицательное значение - в КиБ)
+        'temp_store': 'MEMORY',
+    },
+}
+
+# Пул потоков для синхронных запросов из асинхронных обработчиков
+DB_WORKERS = int(os.getenv('DB_WORKERS', '4'))
+
+_database_url = make_url(DATABASE_URL)
+DB_PROFILE = _database_url.query.get('profile', os.getenv('DB_PROFILE', 'tuned'))
+_database_url = _database_url.difference_update_query(['profile'])
+if DB_PROFILE not in SQLITE_PROFILES:
+    raise ValueError(f"Неизвестный профиль базы данных: {DB_PROFILE}")
+
+_engine_options = {}
+_is_sqlite = _database_url.get_backend_name() == 'sqlite'
+_is_sqlite_file = _is_sqlite and _database_url.database not in (None, '', ':memory:')
+
 # Создаем директорию для базы данных если её нет
-if DATABASE_URL.startswith('sqlite:///'):
-    db_path = DATABASE_URL.replace('sqlite:///', '')
-    db_dir = os.path.dirname(db_path)
+if _is_sqlite_file:
+    db_dir = os.path.dirname(_database_url.database)
     if db_dir and not os.path.exists(db_dir):
         os.makedirs(db_dir, exist_ok=True)
 
-engine = create_engine(DATABASE_URL)
+if not _is_sqlite or _is_sqlite_file:
+    # По соединению на каждый поток БД плюс запас для планировщика и запуска
+    _engine_options.update(pool_size=DB_WORKERS + 1, max_overflow=DB_WORKERS, pool_timeout=30)
+
+engine = create_engine(_database_url, **_engine_options)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+if _is_sqlite:
+    @event.listens_for(engine, "connect")
+    def _apply_sqlite_profile(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma, value in SQLITE_PROFILES[DB_PROFILE].items():
+                cursor.execute(f"PRAGMA {pragma}={value}")
+        finally:
+            cursor.close()
+
+_db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix='spina-db')
+
 def create_tables():
     Base.metadata.create_all(bind=engine)
 
@@ -89,4 +238,649 @@ def init_default_settings():
                 db.add(setting)
             db.commit()
     finally:
-        db.close() 
\ No newline at end of file
+        db.close() 
+
+def _run_in_session(func, args, kwargs):
+    db = SessionLocal()
+    try:
+        return func(db, *args, **kwargs)
+    finally:
+        db.close()
+
+async def run_db(func, *args, **kwargs):
+    """Выполнить func(db, *args, **kwargs) в пуле потоков БД, не блокируя event loop.
+
+    func получает собственную сессию, которая закрывается после вызова, поэтому
+    возвращать из нее нужно простые значения или уже загруженные объекты.
+    Контекст вызывающей задачи переносится в поток, чтобы запросы учитывались
+    в апдейте, который их вызвал (query_counter).
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(_db_executor, context.run, _run_in_session, func, args, kwargs)
+
+def save_pain_rating(db, telegram_id: int, pain_level: int):
+    """Сохранение оценки боли одной транзакцией без чтения из базы"""
+    save_pain_ratings(db, [(telegram_id, pain_level, datetime.utcnow())])
+
+def save_pain_ratings(db, ratings):
+    """Сохранение пачки оценок (telegram_id, pain_level, rated_at) одной транзакцией.
+
+    Ответы вставляются через executemany, пользователи обновляются одним
+    пакетным UPDATE, агрегаты user_stats и daily_rating_stats - одним
+    UPDATE на пользователя и на (день, уровень).
+    """
+    if not ratings:
+        return
+    
+    db.execute(UserResponse.__table__.insert(), [
+        {'user_id': telegram_id, 'pain_rating': pain_level, 'response_date': rated_at}
+        for telegram_id, pain_level, rated_at in ratings
+    ])
+    
+    by_user = {}
+    by_day = {}
+    for telegram_id, pain_level, rated_at in sorted(ratings, key=lambda rating: rating[2]):
+        by_user.setdefault(telegram_id, []).append((pain_level, rated_at))
+        key = (rated_at.date(), pain_level)
+        by_day[key] = by_day.get(key, 0) + 1
+    
+    users = User.__table__
+    db.execute(
+        users.update()
+        .where(users.c.telegram_id == bindparam('b_telegram_id'))
+        .values(last_pain_rating=bindparam('b_rating'), last_rating_date=bindparam('b_rated_at')),
+        [
+            {'b_telegram_id': telegram_id, 'b_rating': user_ratings[-1][0], 'b_rated_at': user_ratings[-1][1]}
+            for telegram_id, user_ratings in by_user.items()
+        ]
+    )
+    
+    for telegram_id, user_ratings in by_user.items():
+        _add_ratings_to_user_stats(db, telegram_id, user_ratings)
+    for (day, pain_level), count in by_day.items():
+        _add_ratings_to_daily_stats(db, day, pain_level, count)
+    db.commit()
+
+def _add_ratings_to_daily_stats(db, day, pain_level: int, count: int):
+    """Учесть оценки в дневной сводке в текущей транзакции"""
+    result = db.execute(
+        update(DailyRatingStats)
+        .where(DailyRatingStats.day == day, DailyRatingStats.pain_level == pain_level)
+        .values(response_count=DailyRatingStats.response_count + count)
+    )
+    if result.rowcount == 0:
+        db.add(DailyRatingStats(day=day, pain_level=pain_level, response_count=count))
+        db.flush()
+
+def _add_ratings_to_user_stats(db, telegram_id: int, user_ratings):
+    """Учесть новые оценки пользователя [(pain_level, rated_at)] в user_stats"""
+    level_deltas = {level: 0 for level in range(1, 6)}
+    for pain_level, _ in user_ratings:
+        level_deltas[pain_level] += 1
+    last_rating, last_date = user_ratings[-1]
+    
+    values = {
+        UserStats.total_count: UserStats.total_count + len(user_ratings),
+        UserStats.rating_sum: UserStats.rating_sum + sum(level for level, _ in user_ratings),
+        UserStats.last_rating: last_rating,
+        UserStats.last_response_date: last_date,
+    }
+    for level, delta in level_deltas.items():
+        if delta:
+            level_column = getattr(UserStats, f'count_{level}')
+            values[level_column] = level_column + delta
+    
+    result = db.execute(update(UserStats).where(UserStats.user_id == telegram_id).values(values))
+    if result.rowcount == 0:
+        # Строки еще нет (первая оценка или ответы до появления user_stats) -
+        # собираем агрегаты по всем ответам пользователя, включая текущие
+        rebuild_user_stats(db, telegram_id)
+
+def rebuild_user_stats(db, telegram_id: int) -> Optional[UserStats]:
+    """Пересчитать агрегаты пользователя по user_responses (без commit)"""
+    db.flush()
+    totals = db.execute(
+        select(
+            func.count(UserResponse.id),
+            func.coalesce(func.sum(UserResponse.pain_rating), 0),
+            *(func.coalesce(func.sum(case((UserResponse.pain_rating == level, 1), else_=0)), 0)
+              for level in range(1, 6))
+        ).where(UserResponse.user_id == telegram_id)
+    ).one()
+    if not totals[0]:
+        return None
+    
+    last = db.execute(
+        select(UserResponse.pain_rating, UserResponse.response_date)
+        .where(UserResponse.user_id == telegram_id)
+        .order_by(UserResponse.response_date.desc(), UserResponse.id.desc())
+        .limit(1)
+    ).one()
+    
+    stats = db.merge(UserStats(
+        user_id=telegram_id,
+        total_count=totals[0],
+        rating_sum=totals[1],
+        count_1=totals[2],
+        count_2=totals[3],
+        count_3=totals[4],
+        count_4=totals[5],
+        count_5=totals[6],
+        last_rating=last.pain_rating,
+        last_response_date=last.response_date,
+    ))
+    db.flush()
+    return stats
+
+MINUTES_PER_DAY = 24 * 60
+
+def local_to_utc_minute(timezone: str, local_minute: int, now: Optional[datetime] = None) -> int:
+    """Минута суток в UTC для местного времени local_minute в часовом поясе timezone.
+
+    Смещение берется на текущую дату, поэтому при переходе на летнее/зимнее
+    время корзину нужно пересчитать (refresh_reminder_buckets).
+    """
+    zone = ZoneInfo(timezone)
+    now = now or datetime.utcnow()
+    local_date = now.replace(tzinfo=dt_timezone.utc).astimezone(zone).date()
+    local = datetime(local_date.year, local_date.month, local_date.day,
+                     local_minute // 60, local_minute % 60, tzinfo=zone)
+    utc = local.astimezone(dt_timezone.utc)
+    return utc.hour * 60 + utc.minute
+
+def set_user_reminder_time(db, telegram_id: int, timezone: Optional[str] = None,
+                           local_minute: Optional[int] = None):
+    """Сохранить часовой пояс и/или местное время напоминания пользователя.
+
+    Недостающее значение берется из текущих: часовой пояс по умолчанию UTC,
+    время по умолчанию - глобальное время напоминаний. Возвращает
+    (часовой пояс, местная минута) или None, если пользователь не зарегистрирован.
+    """
+    user = db.query(User).filter(User.telegram_id == telegram_id).first()
+    if not user:
+        return None
+    if timezone is not None:
+        user.timezone = timezone
+    if local_minute is not None:
+        user.reminder_minute = local_minute
+    if user.timezone is None:
+        user.timezone = 'UTC'
+    if user.reminder_minute is None:
+        settings = settings_cache.get()
+        user.reminder_minute = settings.hour * 60 + settings.minute
+    user.reminder_utc_minute = local_to_utc_minute(user.timezone, user.reminder_minute)
+    saved = (user.timezone, user.reminder_minute)
+    db.commit()
+    return saved
+
+def reset_user_reminder_time(db, telegram_id: int) -> bool:
+    """Вернуть пользователя к глобальному времени напоминаний"""
+    result = db.execute(
+        update(User)
+        .where(User.telegram_id == telegram_id)
+        .values(timezone=None, reminder_minute=None, reminder_utc_minute=None)
+    )
+    db.commit()
+    return result.rowcount > 0
+
+def refresh_reminder_buckets(db, now: Optional[datetime] = None) -> int:
+    """Пересчитать минутные корзины после смены смещения часовых поясов.
+
+    Смещение считается один раз на пару (часовой пояс, местное время),
+    а не для каждого пользователя. Возвращает число перенесенных пользователей.
+    """
+    pairs = db.execute(
+        select(User.timezone, User.reminder_minute)
+        .where(User.reminder_minute.isnot(None))
+        .distinct()
+    ).all()
+    moved = 0
+    for timezone, local_minute in pairs:
+        utc_minute = local_to_utc_minute(timezone, local_minute, now)
+        moved += db.execute(
+            update(User)
+            .where(User.timezone == timezone, User.reminder_minute == local_minute,
+                   User.reminder_utc_minute != utc_minute)
+            .values(reminder_utc_minute=utc_minute)
+        ).rowcount
+    db.commit()
+    return moved
+
+# Аудитории рассылок администратора; активность - оценка за последние AUDIENCE_RECENT_DAYS дней
+AUDIENCE_RECENT_DAYS = 7
+
+def audience_condition(audience: str, now: Optional[datetime] = None):
+    """Условие на активных пользователей аудитории: all, recent или silent"""
+    now = now or datetime.utcnow()
+    since = now - timedelta(days=AUDIENCE_RECENT_DAYS)
+    if audience == 'all':
+        return User.is_active == True
+    if audience == 'recent':
+        return (User.is_active == True) & (User.last_rating_date >= since)
+    if audience == 'silent':
+        return (User.is_active == True) & (User.last_rating_date.is_(None) | (User.last_rating_date < since))
+    raise ValueError(f"Неизвестная аудитория: {audience}")
+
+def count_audience(db, audience: str) -> int:
+    """Число получателей аудитории"""
+    return db.execute(select(func.count(User.id)).where(audience_condition(audience))).scalar()
+
+def nonempty_reminder_buckets(db, utc_minutes) -> set:
+    """Минутные корзины из utc_minutes, в которых есть активные получатели.
+
+    Один запрос по индексу минутных корзин: пустые корзины (их большинство)
+    не создают запусков рассылки.
+    """
+    return set(db.execute(
+        select(User.reminder_utc_minute).distinct()
+        .where(User.reminder_utc_minute.in_(list(utc_minutes)), User.is_active == True)
+    ).scalars())
+
+def create_broadcast_run(db, run_key: str, kind: str, utc_minute: Optional[int] = None,
+                         audience: Optional[str] = None, payload: Optional[str] = None):
+    """Создать запуск рассылки и заполнить outbox получателями одним INSERT ... SELECT.
+
+    Получатели - минутная корзина напоминаний utc_minute или, если задана,
+    аудитория audience (см. audience_condition). Если запуск с таким run_key
+    уже есть, новые сообщения не создаются.
+    Возвращает (id запуска, создан ли он сейчас).
+    """
+    existing = db.execute(select(BroadcastRun.id).where(BroadcastRun.run_key == run_key)).scalar()
+    if existing is not None:
+        return existing, False
+    
+    run = BroadcastRun(run_key=run_key, kind=kind, payload=payload)
+    db.add(run)
+    db.flush()
+    
+    now = datetime.utcnow()
+    if audience is not None:
+        condition = audience_condition(audience, now)
+    else:
+        bucket = User.reminder_utc_minute.is_(None) if utc_minute is None else User.reminder_utc_minute == utc_minute
+        condition = bucket & (User.is_active == True)
+    recipients = select(
+        literal(run.id), User.telegram_id, literal('pending'), literal(0), literal(now)
+    ).where(condition).order_by(User.id)
+    result = db.execute(
+        insert(OutboxMessage).from_select(
+            ['run_id', 'telegram_id', 'status', 'attempts', 'next_attempt_at'], recipients
+        )
+    )
+    run.total = result.rowcount
+    run_id = run.id
+    db.commit()
+    return run_id, True
+
+def claim_outbox_batch(db, run_id: int, owner: str, due_before: datetime, now: datetime,
+                       lease_until: datetime, limit: int):
+    """Взять в аренду пачку сообщений запуска, которые пора отправить.
+
+    Берутся только сообщения без аренды или с истекшей арендой (упавший
+    процесс), одним UPDATE, поэтому два процесса не получат одно сообщение.
+    Возвращает строки (id, telegram_id, attempts) по возрастанию id.
+    """
+    outbox = OutboxMessage.__table__
+    claimable = (
+        select(outbox.c.id)
+        .where(outbox.c.run_id == run_id, outbox.c.status == 'pending',
+               outbox.c.next_attempt_at <= due_before,
+               (outbox.c.lease_expires_at.is_(None)) | (outbox.c.lease_expires_at < now))
+        .order_by(outbox.c.id)
+        .limit(limit)
+        # PostgreSQL: строки, которые сейчас берет другой процесс, пропускаются
+        .with_for_update(skip_locked=True)
+    )
+    rows = db.execute(
+        update(outbox)
+        .where(outbox.c.id.in_(claimable))
+        .values(lease_owner=owner, lease_expires_at=lease_until)
+        .returning(outbox.c.id, outbox.c.telegram_id, outbox.c.attempts)
+    ).all()
+    db.commit()
+    return sorted(rows, key=lambda row: row.id)
+
+def renew_outbox_leases(db, owner: str, lease_until: datetime) -> int:
+    """Продлить аренду всех неотправленных сообщений процесса owner"""
+    renewed = db.execute(
+        update(OutboxMessage.__table__)
+        .where(OutboxMessage.__table__.c.lease_owner == owner, OutboxMessage.__table__.c.status == 'pending')
+        .values(lease_expires_at=lease_until)
+    ).rowcount
+    db.commit()
+    return renewed
+
+def release_outbox_leases(db, owner: str, ids) -> None:
+    """Вернуть неотправленные сообщения другим процессам (рассылка прервана)"""
+    outbox = OutboxMessage.__table__
+    db.execute(
+        update(outbox)
+        .where(outbox.c.id.in_(list(ids)), outbox.c.lease_owner == owner, outbox.c.status == 'pending')
+        .values(lease_owner=None, lease_expires_at=None)
+    )
+    db.commit()
+
+def record_outbox_results(db, results):
+    """Записать итоги отправки одной транзакцией.
+
+    results - список (outbox_id, telegram_id, status, attempts, next_attempt_at, error).
+    Пользователи со статусом blocked деактивируются в той же транзакции.
+    """
+    if not results:
+        return
+    now = datetime.utcnow()
+    db.execute(
+        update(OutboxMessage.__table__)
+        .where(OutboxMessage.__table__.c.id == bindparam('b_id'))
+        .values(
+            status=bindparam('b_status'),
+            attempts=bindparam('b_attempts'),
+            next_attempt_at=bindparam('b_next_attempt_at'),
+            last_error=bindparam('b_error'),
+            updated_at=now,
+            lease_owner=None,
+            lease_expires_at=None,
+        ),
+        [
+            {'b_id': outbox_id, 'b_status': status, 'b_attempts': attempts,
+             'b_next_attempt_at': next_attempt_at, 'b_error': error}
+            for outbox_id, _, status, attempts, next_attempt_at, error in results
+        ]
+    )
+    blocked = [telegram_id for _, telegram_id, status, _, _, _ in results if status == 'blocked']
+    if blocked:
+        db.execute(update(User).where(User.telegram_id.in_(blocked)).values(is_active=False))
+    db.commit()
+
+def count_pending_outbox(db, run_id: int) -> int:
+    """Число неотправленных сообщений запуска"""
+    return db.execute(
+        select(func.count())
+        .select_from(OutboxMessage)
+        .where(OutboxMessage.run_id == run_id, OutboxMessage.status == 'pending')
+    ).scalar()
+
+def next_outbox_attempt(db, run_id: int) -> Optional[datetime]:
+    """Время ближайшей повторной попытки запуска; None если отправлять больше нечего.
+
+    Сообщения в аренде у другого процесса учитываются по времени окончания аренды.
+    """
+    available_at = case(
+        (OutboxMessage.lease_expires_at > OutboxMessage.next_attempt_at, OutboxMessage.lease_expires_at),
+        else_=OutboxMessage.next_attempt_at,
+    )
+    return db.execute(
+        select(func.min(available_at))
+        .where(OutboxMessage.run_id == run_id, OutboxMessage.status == 'pending')
+    ).scalar()
+
+def count_outbox_by_status(db, run_id: int) -> dict:
+    """Количество сообщений запуска по статусам"""
+    return dict(db.execute(
+        select(OutboxMessage.status, func.count())
+        .where(OutboxMessage.run_id == run_id)
+        .group_by(OutboxMessage.status)
+    ).all())
+
+def finish_broadcast_run(db, run_id: int) -> Optional[dict]:
+    """Отметить запуск завершенным; возвращает количество сообщений по статусам
+    или None, если запуск уже завершил другой процесс или его остановили"""
+    finished = db.execute(
+        update(BroadcastRun)
+        .where(BroadcastRun.id == run_id, BroadcastRun.status == 'running')
+        .values(status='done', finished_at=datetime.utcnow())
+    ).rowcount
+    db.commit()
+    if not finished:
+        return None
+    return count_outbox_by_status(db, run_id)
+
+def fetch_broadcast_run(db, run_id: int):
+    """Запуск рассылки: строка (id, run_key, kind, status, total, payload) или None"""
+    return db.execute(
+        select(BroadcastRun.id, BroadcastRun.run_key, BroadcastRun.kind, BroadcastRun.status,
+               BroadcastRun.total, BroadcastRun.payload)
+        .where(BroadcastRun.id == run_id)
+    ).first()
+
+def fetch_broadcast_run_status(db, run_id: int) -> Optional[str]:
+    """Статус запуска; None если запуск удален"""
+    return db.execute(select(BroadcastRun.status).where(BroadcastRun.id == run_id)).scalar()
+
+def fetch_active_run(db, kind: str):
+    """Незавершенный (идет или на паузе) запуск типа kind: строка (id, status) или None"""
+    return db.execute(
+        select(BroadcastRun.id, BroadcastRun.status)
+        .where(BroadcastRun.kind == kind, BroadcastRun.status.in_(('running', 'paused')))
+        .order_by(BroadcastRun.id)
+    ).first()
+
+def set_broadcast_run_status(db, run_id: int, status: str, from_status: str) -> bool:
+    """Перевести запуск из статуса from_status в status; False если он уже в другом статусе"""
+    changed = db.execute(
+        update(BroadcastRun)
+        .where(BroadcastRun.id == run_id, BroadcastRun.status == from_status)
+        .values(status=status)
+    ).rowcount
+    db.commit()
+    return bool(changed)
+
+def cancel_broadcast_run(db, run_id: int) -> Optional[dict]:
+    """Отменить незавершенный запуск: неотправленные сообщения получают статус cancelled.
+
+    Возвращает количество сообщений по статусам или None, если запуск уже завершен.
+    """
+    cancelled = db.execute(
+        update(BroadcastRun)
+        .where(BroadcastRun.id == run_id, BroadcastRun.status.in_(('running', 'paused')))
+        .values(status='cancelled', finished_at=datetime.utcnow())
+    ).rowcount
+    if not cancelled:
+        db.rollback()
+        return None
+    outbox = OutboxMessage.__table__
+    db.execute(
+        update(outbox)
+        .where(outbox.c.run_id == run_id, outbox.c.status == 'pending')
+        .values(status='cancelled', updated_at=datetime.utcnow(), lease_owner=None, lease_expires_at=None)
+    )
+    db.commit()
+    return count_outbox_by_status(db, run_id)
+
+def fetch_unfinished_runs(db):
+    """Запуски, прерванные остановкой бота: строки (id, run_key, kind, payload)"""
+    return db.execute(
+        select(BroadcastRun.id, BroadcastRun.run_key, BroadcastRun.kind, BroadcastRun.payload)
+        .where(BroadcastRun.status == 'running')
+        .order_by(BroadcastRun.id)
+    ).all()
+
+def purge_broadcast_runs(db, before: datetime) -> int:
+    """Удалить завершенные или отмененные до before запуски вместе с их сообщениями"""
+    run_ids = select(BroadcastRun.id).where(
+        BroadcastRun.status.in_(('done', 'cancelled')), BroadcastRun.finished_at < before
+    )
+    db.execute(delete(OutboxMessage).where(OutboxMessage.run_id.in_(run_ids)))
+    purged = db.execute(delete(BroadcastRun).where(BroadcastRun.id.in_(run_ids))).rowcount
+    db.commit()
+    return purged
+
+
+class ReminderSettings(NamedTuple):
+    """Глобальные настройки напоминаний"""
+    hour: int = 10
+    minute: int = 0
+    enabled: bool = True
+    window_minutes: int = 0  # окно доставки общей рассылки; 0 - без растягивания
+
+    @classmethod
+    def from_values(cls, values: dict) -> 'ReminderSettings':
+        """Собрать настройки из строковых значений таблицы bot_settings"""
+        defaults = cls()
+        return cls(
+            hour=int(values.get('reminder_hour', defaults.hour)),
+            minute=int(values.get('reminder_minute', defaults.minute)),
+            enabled=values.get('reminder_enabled', 'true') == 'true',
+            window_minutes=int(values.get('reminder_window_minutes', defaults.window_minutes)),
+        )
+
+    def to_values(self) -> dict:
+        return {
+            'reminder_hour': str(self.hour),
+            'reminder_minute': str(self.minute),
+            'reminder_enabled': 'true' if self.enabled else 'false',
+            'reminder_window_minutes': str(self.window_minutes),
+        }
+
+def _in_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+class SettingsCache:
+    """Кэш настроек бота в памяти процесса.
+
+    Все настройки загружаются одним запросом; изменения администратора
+    записываются в базу и сразу же в кэш (write-through).
+    """
+
+    def __init__(self):
+        self._settings = None
+        # Загрузка и изменение идут из потоков run_db: чтение-изменение-запись
+        # целиком под блокировкой, чтобы параллельные изменения не затирали друг друга
+        self._lock = threading.RLock()
+
+    def load(self, db) -> ReminderSettings:
+        """Загрузить все настройки из базы одним запросом"""
+        with self._lock:
+            rows = db.query(BotSettings.setting_name, BotSettings.setting_value).all()
+            settings = ReminderSettings.from_values(dict(rows))
+            self._settings = settings
+        return settings
+
+    async def warm(self) -> ReminderSettings:
+        """Загрузить настройки в пуле потоков БД, не блокируя event loop"""
+        return await run_db(self.load)
+
+    def get(self) -> ReminderSettings:
+        """Текущие настройки; база читается только при первом обращении.
+
+        Бот загружает кэш до запуска event loop (SpinaBot.setup_scheduler) и
+        перечитывает в post_init через warm(), поэтому обработчики и задачи
+        планировщика читают только память. Синхронное чтение остается для
+        вызовов вне event loop (скрипты, потоки run_db).
+        """
+        settings = self._settings
+        if settings is None:
+            if _in_event_loop():
+                logger.warning("Кэш настроек пуст в event loop: чтение из базы блокирует loop, нужен warm()")
+            db = SessionLocal()
+            try:
+                settings = self.load(db)
+            finally:
+                db.close()
+        return settings
+
+    def update(self, db, admin_id: int, **changes) -> ReminderSettings:
+        """Изменить настройки в базе и в кэше"""
+        with self._lock:
+            current = self.get()
+            settings = current._replace(**changes)
+            old_values = current.to_values()
+            changed = {
+                name: value for name, value in settings.to_values().items()
+                if value != old_values[name]
+            }
+
+            if changed:
+                existing = {
+                    setting.setting_name: setting
+                    for setting in db.query(BotSettings).filter(BotSettings.setting_name.in_(list(changed))).all()
+                }
+                for name, value in changed.items():
+                    setting = existing.get(name)
+                    if setting:
+                        setting.setting_value = value
+                        setting.updated_by_admin = admin_id
+                        setting.updated_at = datetime.utcnow()
+                    else:
+                        db.add(BotSettings(setting_name=name, setting_value=value, updated_by_admin=admin_id))
+                db.commit()
+
+            self._settings = settings
+        return settings
+
+settings_cache = SettingsCache()
+
+
+class CachedLesson(NamedTuple):
+    """Видео-урок с заранее подготовленным текстом сообщения"""
+    file_id: str
+    caption: str
+
+def render_lesson_caption(lesson: VideoLesson) -> str:
+    """Текст, который отправляется пользователю перед видео-уроком"""
+    video_info = f"Спасибо за оценку! Уровень боли: {lesson.pain_level}\n\n"
+    
+    if lesson.title:
+        video_info += f"🎥 *{lesson.title}*\n\n"
+        
+    if lesson.description:
+        video_info += f"{lesson.description}\n\n"
+        
+    if lesson.duration:
+        minutes = lesson.duration // 60
+        seconds = lesson.duration % 60
+        video_info += f"⏱ Длительность: {minutes}:{seconds:02d}\n\n"
+    
+    video_info += "Вот персональный видео-урок для вас:"
+    return video_info
+
+class LessonCache:
+    """Кэш видео-уроков по уровню боли.
+
+    Уроков не больше пяти и меняются они только администратором, поэтому
+    держим их в памяти целиком: бот загружает кэш в post_init, а после
+    каждого изменения администратор сбрасывает и перечитывает его.
+    """
+
+    def __init__(self):
+        self._lessons = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def load(self, db) -> dict:
+        """Перечитать все видео-уроки из базы"""
+        with self._lock:
+            generation = self._generation
+        lessons = {
+            lesson.pain_level: CachedLesson(lesson.file_id, render_lesson_caption(lesson))
+            for lesson in db.query(VideoLesson).order_by(VideoLesson.id).all()
+        }
+        with self._lock:
+            # Кэш сбросили, пока шел запрос: прочитанное могло устареть
+            if self._generation == generation:
+                self._lessons = lessons
+        return lessons
+
+    async def warm(self) -> dict:
+        """Загрузить видео-уроки в пуле потоков БД, не блокируя event loop"""
+        return await run_db(self.load)
+
+    async def get(self, pain_level: int) -> Optional[CachedLesson]:
+        """Видео-урок для уровня боли; база читается (через run_db) только если кэш пуст"""
+        lessons = self._lessons
+        if lessons is None:
+            lessons = await self.warm()
+        return lessons.get(pain_level)
+
+    def invalidate(self):
+        """Сбросить кэш после изменения видео-уроков"""
+        with self._lock:
+            self._generation += 1
+            self._lessons = None
+
+lesson_cache = LessonCache()
@@ -0,0 +1,162 @@
+"""
+Защита от потока входящих апдейтов.
+
+UpdateGuard.admit - фильтр PerChatUpdateProcessor (update_processor.py,
+подключается в SpinaBot): апдейт проверяется сразу при поступлении, до
+очереди чата и места среди UPDATE_CONCURRENCY, поэтому лишние апдейты
+отбрасываются, ничего не дожидаясь и до первого запроса к базе:
+    duplicate - повторное нажатие той же кнопки под тем же сообщением в течение
+                DUPLICATE_CALLBACK_WINDOW секунд (двойной тап по оценке)
+    throttled - пользователь прислал больше USER_RATE_LIMIT апдейтов в секунду
+                (с запасом USER_BURST на короткую серию)
+    shed      - бот перегружен, а апдейт - второстепенная команда (SHEDDABLE_COMMANDS)
+
+Перегрузка - когда апдейтов в обработке и в очереди (update_processor.py) не
+меньше SHED_BACKLOG или запись оценок в базу медленнее порога монитора
+нагрузки (load_monitor.py). Нажатия кнопок при перегрузке проходят, а
+администраторы не ограничиваются вовсе, кроме склейки повторных нажатий.
+
+Ответы на отброшенные апдейты отправляются в фоне, без ожидания: о лимите
+пользователь предупреждается не чаще раза в THROTTLE_NOTICE_INTERVAL,
+остальные лишние апдейты и повторные нажатия отбрасываются молча.
+Отброшенные апдейты считает spina_updates_dropped_total по причине и метке
+обработчика.
+"""
+
+import asyncio
+import logging
+import os
+import time
+
+from telegram.error import TelegramError
+
+import metrics
+from admin_handlers import is_admin
+from load_monitor import load_monitor
+from update_processor import UPDATE_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+USER_RATE_LIMIT = float(os.getenv('USER_RATE_LIMIT', '1'))  # апдейтов в секунду от одного пользователя
+USER_BURST = float(os.getenv('USER_BURST', '5'))            # апдейтов подряд без ограничения
+USER_TRACK_LIMIT = 10000        # после скольких пользователей чистить их счетчики
+THROTTLE_NOTICE_INTERVAL = 10   # секунд между предупреждениями о лимите одному пользователю
+# Секунд, в течение которых повторное нажатие склеивается; 0 - не склеивать (для замеров)
+DUPLICATE_CALLBACK_WINDOW = float(os.getenv('DUPLICATE_CALLBACK_WINDOW', '2'))
+# Апдейтов в обработке и в очереди, начиная с которого бот считается перегруженным
+SHED_BACKLOG = int(os.getenv('SHED_BACKLOG', str(UPDATE_CONCURRENCY * 2)))
+
+# Команды только для чтения, которые можно повторить позже
+SHEDDABLE_COMMANDS = frozenset({'stats', 'status', 'help'})
+
+THROTTLED_TEXT = "⏳ Слишком много сообщений. Подождите несколько секунд."
+THROTTLED_ANSWER = "⏳ Слишком часто. Подождите пару секунд."
+SHED_TEXT = "⏳ Сейчас много запросов. Повторите команду через минуту."
+
+
+def _command(message):
+    if message is None or not message.text or not message.text.startswith('/'):
+        return None
+    return message.text.split()[0].split('@')[0][1:].lower()
+
+
+class UpdateGuard:
+    """Ограничение частоты по пользователям, склейка нажатий и сброс нагрузки"""
+
+    def __init__(self, rate: float = USER_RATE_LIMIT, burst: float = USER_BURST,
+                 shed_backlog: int = SHED_BACKLOG):
+        self.rate = rate
+        self.burst = burst
+        self.shed_backlog = shed_backlog
+        self._users = {}    # user_id -> [запас апдейтов, время расчета, время предупреждения]
+        self._taps = {}     # (user_id, message_id, data) -> время первого нажатия, по порядку
+        self._replies = set()  # фоновые ответы на отброшенные апдейты
+
+    def _is_duplicate(self, query) -> bool:
+        now = time.monotonic()
+        # Словарь упорядочен по времени нажатия: устаревшие - в начале
+        while self._taps:
+            oldest = next(iter(self._taps))
+            if now - self._taps[oldest] < DUPLICATE_CALLBACK_WINDOW:
+                break
+            del self._taps[oldest]
+        message_id = query.message.message_id if query.message is not None else None
+        key = (query.from_user.id, message_id, query.data)
+        if key in self._taps:
+            return True
+        self._taps[key] = now
+        return False
+
+    def _take(self, user_id: int, now: float):
+        """Учесть апдейт пользователя, поступивший в now: (пропустить ли, предупреждать ли о лимите)"""
+        state = self._users.get(user_id)
+        if state is None:
+            if len(self._users) >= USER_TRACK_LIMIT:
+                # Храним только пользователей, чей запас еще не восстановился
+                self._users = {
+                    user: value for user, value in self._users.items()
+                    if value[0] + (now - value[1]) * self.rate < self.burst
+                }
+            state = self._users[user_id] = [self.burst, now, None]
+        if now > state[1]:
+            state[0] = min(self.burst, state[0] + (now - state[1]) * self.rate)
+            state[1] = now
+        if state[0] >= 1:
+            state[0] -= 1
+            return True, False
+        # Предупреждаем не чаще раза в интервал, чтобы ответы не умножали поток
+        warn = state[2] is None or now - state[2] >= THROTTLE_NOTICE_INTERVAL
+        if warn:
+            state[2] = now
+        return False, warn
+
+    def overloaded(self, processor) -> bool:
+        """Бот не успевает: очередь апдейтов или медленная запись в базу"""
+        return processor.pending >= self.shed_backlog \
+            or load_monitor.write_latency() > load_monitor.max_write_latency
+
+    def admit(self, update, processor) -> bool:
+        """Пропустить апдейт в очередь обработки или отбросить (фильтр PerChatUpdateProcessor)"""
+        user = getattr(update, 'effective_user', None)
+        if user is None:
+            return True
+        query = update.callback_query
+
+        if query is not None and query.data and self._is_duplicate(query):
+            return self._drop(update, 'duplicate')
+
+        if is_admin(user.id):
+            return True
+
+        allowed, warn = self._take(user.id, time.monotonic())
+        if not allowed:
+            reply = None
+            if warn and query is not None:
+                reply = query.answer(THROTTLED_ANSWER)
+            elif warn and update.effective_message is not None:
+                reply = update.effective_message.reply_text(THROTTLED_TEXT)
+            return self._drop(update, 'throttled', reply)
+
+        if query is None and _command(update.effective_message) in SHEDDABLE_COMMANDS \
+                and self.overloaded(processor):
+            return self._drop(update, 'shed', update.effective_message.reply_text(SHED_TEXT))
+        return True
+
+    def _drop(self, update, reason: str, reply=None) -> bool:
+        """Отбросить апдейт; reply - необязательный ответ пользователю, отправляется в фоне"""
+        metrics.update_dropped(reason, metrics.update_label(update))
+        if reply is not None:
+            task = asyncio.get_running_loop().create_task(self._send_reply(reason, reply))
+            self._replies.add(task)
+            task.add_done_callback(self._replies.discard)
+        return False
+
+    @staticmethod
+    async def _send_reply(reason: str, reply):
+        try:
+            await reply
+        except TelegramError as e:
+            logger.warning(f"Не удалось ответить на отброшенный апдейт ({reason}): {e}")
+
+
+update_guard = UpdateGuard()
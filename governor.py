@@ -0,0 +1,267 @@
+"""
+Общий для процесса ограничитель исходящих вызовов Bot API с полосами приоритета.
+
+Запросы бота (main.SpinaBot) и бота рассылок (main.bulk_request) обернуты
+в GovernedRequest, поэтому через ограничитель проходят все вызовы: ответы
+обработчиков user_handlers.py и admin_handlers.py (reply_text,
+edit_message_text, send_video, query.answer), рассылки и сообщения о ходе
+кампаний. Полосы по убыванию приоритета:
+    callback    - ответы на нажатия кнопок (answerCallbackQuery)
+    interactive - остальные вызовы бота, отвечающего пользователям
+    bulk        - вызовы бота рассылок
+
+Отправки сообщений (send*, copyMessage, forwardMessage) делят лимит
+OUTBOUND_RATE_LIMIT сообщений в секунду на бота; освободившийся токен
+достается самой приоритетной ждущей полосе, так что в пик рассылка
+замедляется, а ответы пользователям - нет. Ответы на нажатия в этот лимит
+не входят и не ждут. Сообщения и правки в одном чате идут не чаще одного в
+OUTBOUND_CHAT_INTERVAL, с запасом CHAT_BURST на короткую серию (ответ на
+нажатие - правка и видео).
+
+На RetryAfter (429) ограничитель приостанавливает отправки всех полос на
+retry_after секунд. Вызовы полос callback и interactive повторяются сами,
+если ждать не дольше OUTBOUND_RETRY_MAX_WAIT; рассылке RetryAfter
+передается для учета, а ее повтор ждет конца той же паузы здесь. Повтор
+не занимает второе место в очереди чата. Для рассылок этот ограничитель
+единственный: движок рассылок outbox (broadcast.py) свой лимит скорости
+не применяет.
+
+Ограничитель один на процесс; у воркеров рассылок (BOT_MODE=worker) он
+получает долю лимита OUTBOUND_RATE_LIMIT / BROADCAST_WORKERS
+(main.run_broadcast_worker).
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+from telegram.error import RetryAfter
+from telegram.request import BaseRequest
+
+import metrics
+from broadcast import GLOBAL_RATE_LIMIT, PER_CHAT_INTERVAL, PER_CHAT_TRACK_LIMIT
+
+logger = logging.getLogger(__name__)
+
+# Лимит отправок на бота; по умолчанию тот же, что у рассылок (BROADCAST_RATE_LIMIT)
+OUTBOUND_RATE_LIMIT = float(os.getenv('OUTBOUND_RATE_LIMIT', str(GLOBAL_RATE_LIMIT)))
+# Секунд между сообщениями в один чат; 0 - без ограничения (для замеров)
+OUTBOUND_CHAT_INTERVAL = float(os.getenv('OUTBOUND_CHAT_INTERVAL', str(PER_CHAT_INTERVAL)))
+CHAT_BURST = 3                  # сообщений в один чат подряд без ожидания
+OUTBOUND_RETRY_MAX_WAIT = float(os.getenv('OUTBOUND_RETRY_MAX_WAIT', '10'))  # секунд; дольше ответ уже не нужен
+OUTBOUND_MAX_RETRIES = 3        # повторов одного вызова после RetryAfter
+
+LANES = ('callback', 'interactive', 'bulk')
+
+CALLBACK_METHODS = frozenset({'answerCallbackQuery'})
+MESSAGE_PREFIXES = ('send', 'copyMessage', 'forwardMessage')
+UNPACED_METHODS = frozenset({'sendChatAction'})
+CHAT_PREFIXES = ('editMessage',)
+
+
+def method_kind(method: str):
+    """Как ограничивается вызов: 'callback', 'message', 'chat' или None (без ограничений)"""
+    if method in CALLBACK_METHODS:
+        return 'callback'
+    if method in UNPACED_METHODS:
+        return None
+    if method.startswith(MESSAGE_PREFIXES):
+        return 'message'
+    if method.startswith(CHAT_PREFIXES):
+        return 'chat'
+    return None
+
+
+class PriorityBucket:
+    """Token bucket, который раздает токены ожидающим по приоритету полосы.
+
+    Внутри полосы ожидающие обслуживаются по очереди поступления.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters = [deque() for _ in LANES]
+        self._timer = None
+
+    @property
+    def paused_for(self) -> float:
+        """Сколько секунд еще длится пауза после RetryAfter"""
+        return max(0.0, self._paused_until - time.monotonic())
+
+    def waiting(self, lane: int) -> int:
+        return sum(1 for waiter in self._waiters[lane] if not waiter.done())
+
+    def pause(self, seconds: float):
+        """Приостановить выдачу токенов всем полосам"""
+        until = time.monotonic() + seconds
+        if until > self._paused_until:
+            self._paused_until = until
+            # После паузы начинаем с пустого ведра, чтобы не получить всплеск
+            self._tokens = 0.0
+            self._updated = until
+
+    def _refill(self, now: float):
+        if now > self._updated:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    async def acquire(self, lane: int):
+        """Дождаться токена; lane - индекс полосы в LANES"""
+        now = time.monotonic()
+        self._refill(now)
+        if now >= self._paused_until and self._tokens >= 1 and not any(
+            self.waiting(ahead) for ahead in range(lane + 1)
+        ):
+            self._tokens -= 1
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[lane].append(waiter)
+        self._dispatch()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Токен уже выдан, но вызов отменили: вернуть его следующему
+                self._tokens += 1
+                self._dispatch()
+            raise
+
+    def _next_waiter(self):
+        for waiters in self._waiters:
+            while waiters and waiters[0].done():
+                # Отмененные ожидающие
+                waiters.popleft()
+            if waiters:
+                return waiters
+        return None
+
+    def _dispatch(self):
+        """Раздать накопленные токены и запланировать следующую раздачу"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        now = time.monotonic()
+        self._refill(now)
+        while True:
+            waiters = self._next_waiter()
+            if waiters is None:
+                return
+            if now < self._paused_until:
+                delay = self._paused_until - now
+                break
+            if self._tokens < 1:
+                delay = (1 - self._tokens) / self.rate
+                break
+            self._tokens -= 1
+            waiters.popleft().set_result(None)
+        self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+
+class OutboundGovernor:
+    """Полосы приоритета, темп по чатам и повторы после RetryAfter"""
+
+    def __init__(self, rate: float = OUTBOUND_RATE_LIMIT, chat_burst: int = CHAT_BURST,
+                 per_chat_interval: float = OUTBOUND_CHAT_INTERVAL):
+        # Без запаса токенов: всплеск сверх лимита Telegram засчитывает за ту же секунду
+        self.bucket = PriorityBucket(rate, capacity=1.0)
+        self.chat_burst = chat_burst
+        self.per_chat_interval = per_chat_interval
+        self._chats = {}  # chat_id -> (запас сообщений, время расчета)
+
+    def _chat_delay(self, chat_id) -> float:
+        """Занять место в очереди сообщений чата; сколько секунд ждать своей очереди"""
+        now = time.monotonic()
+        allowance, updated = self._chats.get(chat_id, (self.chat_burst, now))
+        allowance = min(self.chat_burst, allowance + (now - updated) / self.per_chat_interval) - 1
+        if len(self._chats) >= PER_CHAT_TRACK_LIMIT:
+            # Храним только чаты, запас которых еще не восстановился
+            self._chats = {
+                chat: state for chat, state in self._chats.items()
+                if state[0] + (now - state[1]) / self.per_chat_interval < self.chat_burst
+            }
+        self._chats[chat_id] = (allowance, now)
+        return max(0.0, -allowance) * self.per_chat_interval
+
+    async def _wait_turn(self, kind: str, lane: str, chat_id):
+        """Дождаться очереди чата (chat_id None - без нее) и токена общего лимита"""
+        if chat_id is not None and self.per_chat_interval > 0:
+            delay = self._chat_delay(chat_id)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        if kind == 'message':
+            await self.bucket.acquire(LANES.index(lane))
+        elif self.bucket.paused_for > 0:
+            await asyncio.sleep(self.bucket.paused_for)
+
+    async def call(self, method: str, lane: str, chat_id, send):
+        """Выполнить вызов send() метода method в свою очередь; повторить после RetryAfter"""
+        kind = method_kind(method)
+        if kind is None:
+            return await send()
+        if kind == 'callback':
+            lane, chat_id = 'callback', None
+
+        retries = 0
+        while True:
+            if kind != 'callback':
+                started = time.perf_counter()
+                metrics.outbound_queued(lane)
+                try:
+                    # Место в очереди чата заняла первая попытка: повтор ждет только общий лимит
+                    await self._wait_turn(kind, lane, chat_id if retries == 0 else None)
+                finally:
+                    metrics.outbound_granted(lane, time.perf_counter() - started)
+            try:
+                return await send()
+            except RetryAfter as e:
+                metrics.outbound_retry_after(lane)
+                self.bucket.pause(e.retry_after)
+                retries += 1
+                if lane == 'bulk' or e.retry_after > OUTBOUND_RETRY_MAX_WAIT or retries > OUTBOUND_MAX_RETRIES:
+                    raise
+                logger.warning(f"RetryAfter {e.retry_after} с на {method}, повтор после паузы")
+                if kind == 'callback':
+                    await asyncio.sleep(e.retry_after)
+
+
+governor = OutboundGovernor()
+
+
+class GovernedRequest(BaseRequest):
+    """Запрос Bot API, вызовы которого проходят через общий ограничитель.
+
+    lane - полоса вызовов ('interactive' или 'bulk'); ответы на нажатия
+    всегда идут полосой callback.
+    """
+
+    def __init__(self, request: BaseRequest, lane: str = 'interactive', outbound: OutboundGovernor = None):
+        self.request = request
+        self.lane = lane
+        self.governor = outbound or governor
+
+    @property
+    def read_timeout(self):
+        return self.request.read_timeout
+
+    async def initialize(self):
+        await self.request.initialize()
+
+    async def shutdown(self):
+        await self.request.shutdown()
+
+    async def do_request(self, *args, **kwargs):
+        return await self.request.do_request(*args, **kwargs)
+
+    async def post(self, url, request_data=None, *args, **kwargs):
+        method = url.rsplit('/', 1)[-1]
+        chat_id = request_data.parameters.get('chat_id') if request_data is not None else None
+        return await self.governor.call(
+            method, self.lane, chat_id, lambda: self.request.post(url, request_data, *args, **kwargs)
+        )
@@ -0,0 +1,162 @@
+"""
+Минимальный асинхронный HTTP/1.1 сервер на asyncio для webhook Telegram.
+
+Поддерживает ровно то, что нужно боту: маршруты по (метод, путь), тело
+по Content-Length и keep-alive. Внешние зависимости (tornado, aiohttp)
+не нужны, сервер работает в том же event loop, что и приложение.
+"""
+
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, NamedTuple, Tuple
+
+logger = logging.getLogger(__name__)
+
+MAX_HEADER_SIZE = 16 * 1024      # байт на строку запроса и заголовки
+MAX_BODY_SIZE = 1024 * 1024      # байт тела запроса (апдейты Telegram намного меньше)
+READ_TIMEOUT = 30.0              # секунд ожидания следующего запроса в keep-alive соединении
+STOP_TIMEOUT = 5.0               # секунд на завершение открытых соединений при остановке
+
+STATUS_TEXT = {
+    200: "OK",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    429: "Too Many Requests",
+    500: "Internal Server Error",
+}
+
+
+class Request(NamedTuple):
+    method: str
+    path: str
+    headers: Dict[str, str]  # имена заголовков в нижнем регистре
+    body: bytes
+
+
+class Response(NamedTuple):
+    status: int = 200
+    body: bytes = b""
+    content_type: str = "text/plain; charset=utf-8"
+
+
+Handler = Callable[[Request], Awaitable[Response]]
+
+
+class HTTPServer:
+    """HTTP сервер с обработчиками async handler(request) -> Response"""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._routes: Dict[Tuple[str, str], Handler] = {}
+        self._server = None
+        self._connections = {}           # writer -> задача соединения
+
+    def route(self, method: str, path: str, handler: Handler):
+        self._routes[(method.upper(), path)] = handler
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._handle_connection, self.host, self.port, limit=MAX_HEADER_SIZE
+        )
+        if not self.port:
+            # Порт 0 - выбранный системой свободный порт
+            self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"HTTP сервер слушает {self.host}:{self.port}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            # Простаивающие keep-alive соединения иначе держат задачи до отмены цикла
+            for writer in list(self._connections):
+                writer.close()
+            if self._connections:
+                await asyncio.wait(list(self._connections.values()), timeout=STOP_TIMEOUT)
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._connections[writer] = asyncio.current_task()
+        try:
+            while True:
+                request, error = await self._read_request(reader)
+                if request is None and error is None:
+                    break
+                if error is not None:
+                    await self._write_response(writer, Response(error, STATUS_TEXT[error].encode()), False)
+                    break
+
+                keep_alive = request.headers.get('connection', '').lower() != 'close'
+                response = await self._dispatch(request)
+                await self._write_response(writer, response, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+            self._connections.pop(writer, None)
+
+    async def _read_request(self, reader: asyncio.StreamReader):
+        """Прочитать запрос; (None, None) - клиент закрыл соединение, (None, статус) - ошибка"""
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), READ_TIMEOUT)
+        except asyncio.IncompleteReadError as e:
+            return None, (400 if e.partial.strip() else None)
+        except asyncio.LimitOverrunError:
+            return None, 413
+
+        lines = head.decode('latin-1').split("\r\n")
+        try:
+            method, target, _ = lines[0].split(" ", 2)
+        except ValueError:
+            return None, 400
+
+        headers = {}
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get('content-length', '0'))
+        except ValueError:
+            return None, 400
+        if length > MAX_BODY_SIZE:
+            return None, 413
+        body = await asyncio.wait_for(reader.readexactly(length), READ_TIMEOUT) if length else b""
+
+        path = target.split("?", 1)[0]
+        return Request(method.upper(), path, headers, body), None
+
+    async def _dispatch(self, request: Request) -> Response:
+        handler = self._routes.get((request.method, request.path))
+        if handler is None:
+            known_path = any(path == request.path for _, path in self._routes)
+            status = 405 if known_path else 404
+            return Response(status, STATUS_TEXT[status].encode())
+        try:
+            return await handler(request)
+        except Exception as e:
+            logger.error(f"Ошибка обработки {request.method} {request.path}: {e}")
+            return Response(500, STATUS_TEXT[500].encode())
+
+    @staticmethod
+    async def _write_response(writer: asyncio.StreamWriter, response: Response, keep_alive: bool):
+        head = (
+            f"HTTP/1.1 {response.status} {STATUS_TEXT.get(response.status, '')}\r\n"
+            f"Content-Type: {response.content_type}\r\n"
+            f"Content-Length: {len(response.body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+            "\r\n"
+        )
+        writer.write(head.encode('latin-1') + response.body)
+        await writer.drain()
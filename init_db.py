@@ -6,6 +6,7 @@
 import os
 import sys
 from database import create_tables, init_default_settings
+from migrations import run_migrations
 
 def main():
     """Инициализация базы данных"""
@@ -16,6 +17,10 @@ def main():
         create_tables()
         print("✅ Таблицы созданы")
         
+        # Применяем миграции схемы (индексы и изменения существующих таблиц)
+        run_migrations()
+        print("✅ Миграции применены")
+        
         # Инициализируем настройки по умолчанию
         init_default_settings()
         print("✅ Настройки по умолчанию установлены")
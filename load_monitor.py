@@ -0,0 +1,77 @@
+"""
+Наблюдение за входящей нагрузкой для темпа рассылок.
+
+Ответы на напоминание приходят волной: каждое нажатие кнопки оценки -
+это callback и запись в базу. Монитор считает частоту callback-ов оценки
+за последние секунды и сглаженную задержку записи оценок, а рассылка
+по ним замедляется, пока база не справляется.
+"""
+
+import os
+import time
+from collections import deque
+
+# Пороги, выше которых рассылка замедляется
+PACING_MAX_CALLBACK_RATE = float(os.getenv('PACING_MAX_CALLBACK_RATE', '20'))         # callback-ов в секунду
+PACING_MAX_WRITE_LATENCY_MS = float(os.getenv('PACING_MAX_WRITE_LATENCY_MS', '250'))  # мс на запись оценки
+# Во сколько раз рассылка может замедлиться при перегрузке
+PACING_MIN_FACTOR = 0.1
+
+CALLBACK_RATE_WINDOW = 10.0  # секунд, за которые считается частота callback-ов
+LATENCY_SMOOTHING = 0.2      # вес нового замера в скользящем среднем задержки
+LATENCY_STALE_AFTER = 30.0   # секунд без записей, после которых задержка не учитывается
+
+
+class LoadMonitor:
+    """Частота входящих оценок и задержка их записи в базу"""
+
+    def __init__(self, max_callback_rate: float = PACING_MAX_CALLBACK_RATE,
+                 max_write_latency_ms: float = PACING_MAX_WRITE_LATENCY_MS):
+        self.max_callback_rate = max_callback_rate
+        self.max_write_latency = max_write_latency_ms / 1000
+        self._callbacks = deque()
+        self._write_latency = 0.0
+        self._write_latency_at = 0.0
+
+    def record_callback(self):
+        """Отметить входящий callback оценки"""
+        now = time.monotonic()
+        self._callbacks.append(now)
+        self._trim(now)
+
+    def record_db_write(self, seconds: float):
+        """Учесть длительность записи оценки (или пачки оценок) в базу"""
+        if self._write_latency_at:
+            self._write_latency += LATENCY_SMOOTHING * (seconds - self._write_latency)
+        else:
+            self._write_latency = seconds
+        self._write_latency_at = time.monotonic()
+
+    def _trim(self, now: float):
+        while self._callbacks and now - self._callbacks[0] > CALLBACK_RATE_WINDOW:
+            self._callbacks.popleft()
+
+    def callback_rate(self) -> float:
+        """Callback-ов оценки в секунду за последние CALLBACK_RATE_WINDOW секунд"""
+        self._trim(time.monotonic())
+        return len(self._callbacks) / CALLBACK_RATE_WINDOW
+
+    def write_latency(self) -> float:
+        """Сглаженная задержка записи оценки, секунд (0, если записей давно не было)"""
+        if time.monotonic() - self._write_latency_at > LATENCY_STALE_AFTER:
+            return 0.0
+        return self._write_latency
+
+    def slowdown_factor(self) -> float:
+        """Множитель темпа рассылки: 1.0 без перегрузки, меньше - при перегрузке"""
+        factor = 1.0
+        rate = self.callback_rate()
+        if rate > self.max_callback_rate:
+            factor = min(factor, self.max_callback_rate / rate)
+        latency = self.write_latency()
+        if latency > self.max_write_latency:
+            factor = min(factor, self.max_write_latency / latency)
+        return max(factor, PACING_MIN_FACTOR)
+
+
+load_monitor = LoadMonitor()
@@ -3,17 +3,38 @@
 # Press Shift+F10 to execute it or replace it with your code.
 # Press Double Shift to search everywhere for classes, files, tool windows, actions, and settings.
 
+import asyncio
 import os
 import logging
-from datetime import time
+from datetime import datetime, time
 from dotenv import load_dotenv
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ConversationHandler
-from database import create_tables, init_default_settings, SessionLocal, BotSettings
-from user_handlers import start, help_command, rate_pain, handle_pain_rating, user_stats, send_daily_reminder, stop_reminders, resume_reminders, reminder_status
+from telegram import Bot
+from telegram.ext import (
+    Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ConversationHandler
+)
+from database import create_tables, init_default_settings, settings_cache, lesson_cache, engine
+from migrations import run_migrations
+from write_behind import rating_buffer
+from outbox import BROADCAST_WORKERS, resume_unfinished_runs, purge_old_runs, serve_worker, use_bulk_bot
+from broadcast import BULK_POOL_SIZE, BULK_POOL_TIMEOUT, BULK_READ_TIMEOUT
+from webhook import BOT_MODE, WebhookConfig, serve_webhook
+from metrics import InstrumentedRequest, instrument_application, instrument_engine, metrics_server
+from governor import OUTBOUND_RATE_LIMIT, GovernedRequest, OutboundGovernor
+from update_processor import PerChatUpdateProcessor
+from flood_guard import update_guard
+from user_handlers import (
+    start, help_command, rate_pain, handle_pain_rating, user_stats, send_daily_reminder, stop_reminders,
+    resume_reminders, reminder_status, set_timezone, set_personal_time, send_scheduled_reminders,
+    refresh_reminder_schedule
+)
 from admin_handlers import (
     admin_panel, handle_admin_callback, receive_video, receive_video_title, receive_video_description,
-    cancel_admin_conversation, WAITING_VIDEO, WAITING_TITLE, WAITING_DESCRIPTION, is_admin
+    cancel_admin_conversation, WAITING_VIDEO, WAITING_TITLE, WAITING_DESCRIPTION, is_admin,
+    start_campaign_dialog, choose_campaign_audience, receive_campaign_message, confirm_campaign,
+    abort_campaign_dialog, handle_campaign_control, CAMPAIGN_AUDIENCE, CAMPAIGN_MESSAGE, CAMPAIGN_CONFIRM,
+    start_user_search, receive_user_search, WAITING_USER_SEARCH
 )
+from campaign import resume_progress_watchers
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -25,24 +46,102 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Типы апдейтов, которые бот получает от Telegram
+ALLOWED_UPDATES = ['message', 'callback_query']
+
+def bulk_request(outbound: OutboundGovernor = None):
+    """Пул соединений Bot API для рассылок, отдельный от ответов пользователям;
+    в общем ограничителе вызовов (governor.py) рассылки идут последними.
+    outbound - свой ограничитель вместо общего"""
+    return GovernedRequest(
+        InstrumentedRequest(
+            pool='bulk',
+            connection_pool_size=BULK_POOL_SIZE,
+            pool_timeout=BULK_POOL_TIMEOUT,
+            read_timeout=BULK_READ_TIMEOUT,
+            write_timeout=BULK_READ_TIMEOUT,
+        ),
+        lane='bulk',
+        outbound=outbound,
+    )
+
 class SpinaBot:
-    def __init__(self):
-        self.token = os.getenv('BOT_TOKEN')
+    def __init__(self, token: str = None, request=None, base_url: str = None):
+        """token по умолчанию берется из BOT_TOKEN; request - свой BaseRequest
+        для всех вызовов Bot API (например, для локальных тестов и замеров);
+        base_url (по умолчанию TELEGRAM_API_URL) - адрес Bot API вместо
+        https://api.telegram.org/bot, например локального сервера для нагрузочных тестов.
+
+        Рассылки отправляются через отдельный бот self.bulk_bot со своим пулом
+        соединений (bulk_request), чтобы не задерживать ответы пользователям;
+        с собственным request рассылки идут через него же.
+
+        Все вызовы Bot API, кроме getUpdates, проходят через общий ограничитель
+        (governor.py): ответы обработчиков - раньше рассылок."""
+        self.token = token or os.getenv('BOT_TOKEN')
         if not self.token:
             raise ValueError("BOT_TOKEN не найден в переменных окружения")
         
         # Создаем приложение
-        self.application = Application.builder().token(self.token).build()
+        builder = (
+            Application.builder()
+            .token(self.token)
+            .post_init(self.post_init)
+            .post_shutdown(self.post_shutdown)
+            # Разные пользователи обрабатываются параллельно, апдейты одного чата - по очереди;
+            # ограничение частоты, склейка повторных нажатий и сброс нагрузки - до очереди
+            .concurrent_updates(PerChatUpdateProcessor(admit=update_guard.admit))
+        )
+        base_url = base_url or os.getenv('TELEGRAM_API_URL')
+        if base_url:
+            builder = builder.base_url(base_url)
+        self.bulk_bot = None
+        if request is not None:
+            builder = builder.request(GovernedRequest(request)).get_updates_request(request)
+        else:
+            # Тот же размер пула, что у HTTPXRequest по умолчанию в ApplicationBuilder
+            builder = builder.request(
+                GovernedRequest(InstrumentedRequest(pool='interactive', connection_pool_size=256))
+            )
+            self.bulk_bot = Bot(
+                self.token,
+                base_url=base_url or "https://api.telegram.org/bot",
+                request=bulk_request(),
+            )
+        self.application = builder.build()
         
         # Добавляем ссылку на бота в контекст приложения для обновления планировщика
         self.application.spina_bot = self
         
         # Настраиваем обработчики
         self.setup_handlers()
+        instrument_application(self.application)
         
         # Настраиваем планировщик
         self.setup_scheduler()
     
+    async def post_init(self, application):
+        """Запуск фоновых задач после инициализации приложения"""
+        # Свежие настройки и видео-уроки до первого апдейта; чтение - в пуле потоков БД
+        await settings_cache.warm()
+        await lesson_cache.warm()
+        await rating_buffer.start()
+        await metrics_server.start()
+        if self.bulk_bot is not None:
+            await self.bulk_bot.initialize()
+            use_bulk_bot(self.bulk_bot)
+        # Дослать рассылки, прерванные предыдущей остановкой бота
+        await resume_unfinished_runs(application)
+        await resume_progress_watchers(application)
+    
+    async def post_shutdown(self, application):
+        """Остановка фоновых задач и сброс буферов перед выходом"""
+        await rating_buffer.stop()
+        await metrics_server.stop()
+        if self.bulk_bot is not None:
+            use_bulk_bot(None)
+            await self.bulk_bot.shutdown()
+    
     def setup_handlers(self):
         """Настройка всех обработчиков сообщений"""
         
@@ -54,6 +153,8 @@ class SpinaBot:
         self.application.add_handler(CommandHandler("stop", stop_reminders))
         self.application.add_handler(CommandHandler("resume", resume_reminders))
         self.application.add_handler(CommandHandler("status", reminder_status))
+        self.application.add_handler(CommandHandler("timezone", set_timezone))
+        self.application.add_handler(CommandHandler("time", set_personal_time))
         
         # Обработчик команды администратора
         self.application.add_handler(CommandHandler("admin", admin_panel))
@@ -84,11 +185,41 @@ class SpinaBot:
         )
         self.application.add_handler(video_conv_handler)
         
+        # Разговор для рассылки администратора (до общего обработчика кнопки "broadcast")
+        campaign_conv_handler = ConversationHandler(
+            entry_points=[CallbackQueryHandler(start_campaign_dialog, pattern=r"^broadcast$")],
+            states={
+                CAMPAIGN_AUDIENCE: [CallbackQueryHandler(choose_campaign_audience, pattern=r"^campaign_audience_\w+$")],
+                CAMPAIGN_MESSAGE: [MessageHandler(
+                    (filters.TEXT & ~filters.COMMAND) | filters.VIDEO,
+                    receive_campaign_message
+                )],
+                CAMPAIGN_CONFIRM: [CallbackQueryHandler(confirm_campaign, pattern=r"^campaign_confirm$")]
+            },
+            fallbacks=[
+                CommandHandler("cancel", cancel_admin_conversation),
+                CallbackQueryHandler(abort_campaign_dialog, pattern=r"^campaign_abort$")
+            ]
+        )
+        self.application.add_handler(campaign_conv_handler)
+        self.application.add_handler(CallbackQueryHandler(handle_campaign_control, pattern=r"^campaign_(pause|resume|cancel)_\d+$"))
+        
+        # Разговор для поиска пользователей по username (до общего обработчика кнопок "list_")
+        user_search_conv_handler = ConversationHandler(
+            entry_points=[CallbackQueryHandler(start_user_search, pattern=r"^list_search$")],
+            states={
+                WAITING_USER_SEARCH: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_user_search)]
+            },
+            fallbacks=[CommandHandler("cancel", cancel_admin_conversation)]
+        )
+        self.application.add_handler(user_search_conv_handler)
+        
         # Обработчики callback кнопок
         self.application.add_handler(CallbackQueryHandler(handle_pain_rating, pattern=r"^pain_\d$"))
         self.application.add_handler(CallbackQueryHandler(handle_admin_callback, pattern=r"^(manage_|view_|back_to_|toggle_|change_|list_|broadcast)"))
         self.application.add_handler(CallbackQueryHandler(handle_admin_callback, pattern=r"^(edit_video_|delete_video_|replace_video_|edit_title_|edit_description_)\d$"))
         self.application.add_handler(CallbackQueryHandler(handle_admin_callback, pattern=r"^set_time_\d+_\d+$"))
+        self.application.add_handler(CallbackQueryHandler(handle_admin_callback, pattern=r"^set_window_\d+$"))
         
         # Обработчик неизвестных команд
         self.application.add_handler(MessageHandler(filters.COMMAND, self.unknown_command))
@@ -131,30 +262,42 @@ class SpinaBot:
     
     def setup_scheduler(self):
         """Настройка планировщика для ежедневных напоминаний"""
-        # Получаем настройки времени из базы данных
-        db = SessionLocal()
-        try:
-            hour_setting = db.query(BotSettings).filter(BotSettings.setting_name == 'reminder_hour').first()
-            minute_setting = db.query(BotSettings).filter(BotSettings.setting_name == 'reminder_minute').first()
-            enabled_setting = db.query(BotSettings).filter(BotSettings.setting_name == 'reminder_enabled').first()
-            
-            hour = int(hour_setting.setting_value) if hour_setting else 10
-            minute = int(minute_setting.setting_value) if minute_setting else 0
-            enabled = enabled_setting.setting_value == 'true' if enabled_setting else True
-            
-            if enabled:
-                # Добавляем ежедневную задачу
-                self.application.job_queue.run_daily(
-                    send_daily_reminder,
-                    time=time(hour=hour, minute=minute),
-                    name="daily_reminder"
-                )
-                logger.info(f"Планировщик настроен на {hour:02d}:{minute:02d}")
-            else:
-                logger.info("Ежедневные напоминания отключены")
-                
-        finally:
-            db.close()
+        # Загружаем настройки из базы данных в кэш одним запросом (до запуска event loop)
+        settings = settings_cache.get()
+        
+        if settings.enabled:
+            # Добавляем ежедневную задачу
+            self.application.job_queue.run_daily(
+                send_daily_reminder,
+                time=time(hour=settings.hour, minute=settings.minute),
+                name="daily_reminder"
+            )
+            logger.info(f"Планировщик настроен на {settings.hour:02d}:{settings.minute:02d}")
+        else:
+            logger.info("Ежедневные напоминания отключены")
+        
+        # Персональное время: каждую минуту рассылаем только корзину этой минуты (UTC).
+        # Глобальный выключатель проверяется внутри задачи.
+        self.application.job_queue.run_repeating(
+            send_scheduled_reminders,
+            interval=60,
+            first=60 - datetime.utcnow().second,
+            data={},
+            name="bucket_reminders"
+        )
+        # Пересчет корзин после перехода на летнее/зимнее время
+        self.application.job_queue.run_repeating(
+            refresh_reminder_schedule,
+            interval=3600,
+            first=60,
+            name="refresh_reminder_buckets"
+        )
+        # Очистка outbox от завершенных рассылок
+        self.application.job_queue.run_daily(
+            purge_old_runs,
+            time=time(hour=3, minute=30),
+            name="purge_outbox"
+        )
     
     def update_scheduler(self, hour: int, minute: int, enabled: bool):
         """Обновление настроек планировщика"""
@@ -178,7 +321,11 @@ class SpinaBot:
         logger.info("Бот готов к работе!")
         
         # Запускаем бота
-        self.application.run_polling(allowed_updates=['message', 'callback_query'])
+        if BOT_MODE == 'webhook':
+            logger.info("Режим webhook")
+            asyncio.run(serve_webhook(self.application, WebhookConfig.from_env(), allowed_updates=ALLOWED_UPDATES))
+        else:
+            self.application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 async def handle_pain_rating_from_text(update, context, pain_level):
     """Обработка оценки боли из текстового сообщения"""
@@ -207,6 +354,23 @@ async def handle_pain_rating_from_text(update, context, pain_level):
     # Вызываем обработчик
     await handle_pain_rating(update, context)
 
+async def run_broadcast_worker(token: str):
+    """Режим воркера рассылок (BOT_MODE=worker): только доставка outbox,
+    без получения апдейтов и планировщика; воркеров может быть несколько"""
+    # Воркеры делят лимит скорости бота между собой
+    outbound = OutboundGovernor(rate=OUTBOUND_RATE_LIMIT / max(BROADCAST_WORKERS, 1))
+    bot = Bot(
+        token,
+        base_url=os.getenv('TELEGRAM_API_URL') or "https://api.telegram.org/bot",
+        request=bulk_request(outbound),
+    )
+    async with bot:
+        await metrics_server.start()
+        try:
+            await serve_worker(bot)
+        finally:
+            await metrics_server.stop()
+
 def main():
     """Главная функция"""
     try:
@@ -226,10 +390,20 @@ def main():
         
         logger.info("✅ Директория для базы данных готова")
         
+        # Время SQL-запросов для /metrics
+        instrument_engine(engine)
+        
+        if BOT_MODE == 'worker':
+            # Схему базы создает и обновляет основной процесс бота
+            logger.info("📨 Запуск воркера рассылок...")
+            asyncio.run(run_broadcast_worker(token))
+            return
+        
         # Инициализируем базу данных
         logger.info("🗄️ Инициализация базы данных...")
         try:
             create_tables()
+            run_migrations()
             init_default_settings()
             logger.info("✅ База данных инициализирована")
         except Exception as db_error:
@@ -0,0 +1,433 @@
+"""
+Метрики Spina Bot в текстовом формате Prometheus.
+
+Отдаются встроенным HTTP сервером (http_server.py) по адресу
+http://METRICS_LISTEN:METRICS_PORT/metrics (по умолчанию порт 8000, тот же,
+что открыт в Dockerfile). METRICS_PORT=0 отключает сервер метрик.
+
+Собираются:
+    spina_handler_duration_seconds   - время обработчиков по команде/префиксу callback
+    spina_handler_errors_total       - исключения обработчиков
+    spina_handler_db_queries         - число SQL-запросов на апдейт (см. query_counter.py)
+    spina_updates_dropped_total      - апдейты, отброшенные до обработчиков (см. flood_guard.py)
+    spina_db_query_duration_seconds  - время SQL-запросов по типу (SELECT, INSERT, ...)
+    spina_bot_api_duration_seconds   - время вызовов Bot API по методу и пулу соединений
+    spina_bot_api_errors_total       - ошибки Bot API по методу и классу ошибки
+    spina_bot_api_pool_*             - заполненность пулов соединений Bot API
+                                       (interactive - ответы пользователям, bulk - рассылки)
+    spina_outbound_*                 - очередь общего ограничителя вызовов Bot API по полосам
+                                       (см. governor.py) и ответы RetryAfter
+    spina_broadcast_*                - ход и скорость рассылок
+    spina_event_loop_lag_seconds     - задержка event loop
+"""
+
+import asyncio
+import logging
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+
+from sqlalchemy import event
+from telegram.error import TimedOut
+from telegram.ext import ConversationHandler
+from telegram.request import HTTPXRequest
+
+import query_counter
+from http_server import HTTPServer, Response
+
+logger = logging.getLogger(__name__)
+
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '0.0.0.0')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '8000'))
+
+LOOP_LAG_INTERVAL = 0.5  # секунд между замерами задержки event loop
+
+# Границы корзин гистограмм, секунд
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict):
+        return tuple(labels.get(name, "") for name in self.label_names)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+        yield from self._samples()
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(self.label_names, key)} {value}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        self._values = {}  # ключ -> [счетчики корзин..., сумма, количество]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def _samples(self):
+        with self._lock:
+            values = {key: list(state) for key, state in self._values.items()}
+        for key, state in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                labels = _format_labels(self.label_names + ("le",), key + (bound,))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.label_names + ("le",), key + ("+Inf",))
+            yield f"{self.name}_bucket{labels} {state[-1]}"
+            yield f"{self.name}_sum{_format_labels(self.label_names, key)} {state[-2]}"
+            yield f"{self.name}_count{_format_labels(self.label_names, key)} {state[-1]}"
+
+
+REGISTRY = []
+
+HANDLER_LATENCY = Histogram(
+    'spina_handler_duration_seconds', "Время обработки апдейта", ('handler',))
+HANDLER_ERRORS = Counter(
+    'spina_handler_errors_total', "Исключения в обработчиках", ('handler',))
+HANDLER_DB_QUERIES = Histogram(
+    'spina_handler_db_queries', "SQL-запросов на один апдейт", ('handler',), buckets=QUERY_COUNT_BUCKETS)
+UPDATES_DROPPED = Counter(
+    'spina_updates_dropped_total', "Апдейты, отброшенные до обработчиков", ('reason', 'handler'))
+RATINGS_DROPPED = Counter(
+    'spina_ratings_dropped_total', "Оценки, отброшенные буфером отложенной записи без записи в базу", ('reason',))
+DB_QUERY_LATENCY = Histogram(
+    'spina_db_query_duration_seconds', "Время SQL-запросов", ('statement',), buckets=DB_BUCKETS)
+BOT_API_LATENCY = Histogram(
+    'spina_bot_api_duration_seconds', "Время вызовов Bot API", ('method', 'pool'))
+BOT_API_ERRORS = Counter(
+    'spina_bot_api_errors_total', "Ошибки вызовов Bot API", ('method', 'error'))
+BOT_API_POOL_SIZE = Gauge(
+    'spina_bot_api_pool_size', "Размер пула соединений Bot API", ('pool',))
+BOT_API_POOL_IN_USE = Gauge(
+    'spina_bot_api_pool_in_use', "Занятые соединения пула Bot API", ('pool',))
+BOT_API_POOL_WAITING = Gauge(
+    'spina_bot_api_pool_waiting', "Вызовы Bot API, ждущие свободного соединения пула", ('pool',))
+BOT_API_POOL_TIMEOUTS = Counter(
+    'spina_bot_api_pool_timeouts_total', "Вызовы Bot API, не дождавшиеся соединения (pool_timeout)", ('pool',))
+OUTBOUND_WAITING = Gauge(
+    'spina_outbound_waiting', "Вызовы Bot API, ждущие своей очереди в ограничителе", ('lane',))
+OUTBOUND_WAIT = Histogram(
+    'spina_outbound_wait_seconds', "Ожидание вызова Bot API в ограничителе", ('lane',))
+OUTBOUND_RETRY_AFTER = Counter(
+    'spina_outbound_retry_after_total', "Ответы RetryAfter (429) от Bot API", ('lane',))
+BROADCASTS_ACTIVE = Gauge(
+    'spina_broadcast_active', "Рассылок в процессе")
+BROADCAST_MESSAGES = Counter(
+    'spina_broadcast_messages_total', "Сообщения рассылок по итогу отправки", ('outcome',))
+BROADCAST_QUEUED = Gauge(
+    'spina_broadcast_queued', "Получателей текущих рассылок, еще не обработанных")
+BROADCAST_RATE = Gauge(
+    'spina_broadcast_rate', "Фактическая скорость последней рассылки, сообщений в секунду")
+BROADCAST_TARGET_RATE = Gauge(
+    'spina_broadcast_target_rate', "Заданная скорость последней рассылки, сообщений в секунду")
+REMINDER_BUCKETS_SKIPPED = Counter(
+    'spina_reminder_buckets_skipped_total', "Минутные корзины напоминаний, пропущенные без рассылки")
+EVENT_LOOP_LAG = Gauge(
+    'spina_event_loop_lag_seconds', "Последняя замеренная задержка event loop")
+EVENT_LOOP_LAG_HISTOGRAM = Histogram(
+    'spina_event_loop_lag_distribution_seconds', "Распределение задержки event loop")
+
+
+def render() -> str:
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Обработчики
+
+_NUMERIC_SUFFIX = re.compile(r'(_\d+)+$')
+_CALLBACK_LABEL = re.compile(r'^[a-z_]{1,32}$')
+
+# Команды зарегистрированных обработчиков; прочие команды попадают в одну метку
+_known_commands = set()
+
+
+def update_label(update) -> str:
+    """Метка обработчика: команда (/stats), префикс callback (pain, set_time) или тип сообщения"""
+    query = getattr(update, 'callback_query', None)
+    if query is not None and query.data:
+        # Числовые параметры (pain_3, set_time_9_0) не должны раздувать число меток
+        label = _NUMERIC_SUFFIX.sub('', query.data)
+        return label if _CALLBACK_LABEL.match(label) else 'other'
+    message = getattr(update, 'effective_message', None)
+    if message is not None:
+        if message.text and message.text.startswith('/'):
+            command = message.text.split()[0].split('@')[0][1:].lower()
+            return f"/{command}" if command in _known_commands else '/unknown'
+
+        if message.video or message.video_note:
+            return 'video'
+        if message.text:
+            return 'text'
+    return 'other'
+
+
+def _timed_callback(callback):
+    @wraps(callback)
+    async def timed(update, context):
+        started = time.perf_counter()
+        label = update_label(update)
+        try:
+            with query_counter.track_update(label) as tally:
+                return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=label)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, handler=label)
+            HANDLER_DB_QUERIES.observe(tally.count, handler=label)
+    return timed
+
+
+def _instrument_handler(handler):
+    if isinstance(handler, ConversationHandler):
+        for inner in handler.entry_points + handler.fallbacks:
+            _instrument_handler(inner)
+        for handlers in handler.states.values():
+            for inner in handlers:
+                _instrument_handler(inner)
+    elif not getattr(handler.callback, '_spina_timed', False):
+        _known_commands.update(getattr(handler, 'commands', ()))
+        handler.callback = _timed_callback(handler.callback)
+        handler.callback._spina_timed = True
+
+
+def instrument_application(application):
+    """Обернуть колбэки всех зарегистрированных обработчиков замером времени.
+
+    Группы с отрицательным номером (проверки до обработчиков, flood_guard.py)
+    не замеряются: иначе апдейт попадал бы в гистограммы дважды.
+    """
+    for group, handlers in application.handlers.items():
+        if group < 0:
+            continue
+        for handler in handlers:
+            _instrument_handler(handler)
+
+
+def update_dropped(reason: str, handler: str):
+    UPDATES_DROPPED.inc(reason=reason, handler=handler)
+
+
+# База данных
+
+def instrument_engine(engine):
+    """Замер времени каждого SQL-запроса и учет его в апдейте (query_counter)"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('spina_query_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - conn.info['spina_query_started'].pop()
+        query_counter.record(statement, duration)
+        kind = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'OTHER'
+        if kind not in ('SELECT', 'INSERT', 'UPDATE', 'DELETE'):
+            kind = 'OTHER'
+        DB_QUERY_LATENCY.observe(duration, statement=kind)
+
+    @event.listens_for(engine, "handle_error")
+    def _error(context):
+        # Запрос с ошибкой не доходит до after_cursor_execute
+        stack = context.connection.info.get('spina_query_started') if context.connection is not None else None
+        if stack:
+            stack.pop()
+
+
+# Bot API
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest с замером времени и ошибок каждого вызова Bot API.
+
+    pool - имя пула соединений в метриках. Вызовы сверх connection_pool_size
+    ждут свободного соединения до pool_timeout; их число показывает
+    spina_bot_api_pool_waiting.
+    """
+
+    def __init__(self, pool: str = 'interactive', connection_pool_size: int = 1, **kwargs):
+        super().__init__(connection_pool_size=connection_pool_size, **kwargs)
+        self.pool = pool
+        self.pool_size = connection_pool_size
+        self._in_flight = 0
+        BOT_API_POOL_SIZE.set(connection_pool_size, pool=pool)
+
+    def _update_pool_metrics(self):
+        BOT_API_POOL_IN_USE.set(min(self._in_flight, self.pool_size), pool=self.pool)
+        BOT_API_POOL_WAITING.set(max(0, self._in_flight - self.pool_size), pool=self.pool)
+
+    async def post(self, url, *args, **kwargs):
+        method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        self._in_flight += 1
+        self._update_pool_metrics()
+        try:
+            return await super().post(url, *args, **kwargs)
+        except Exception as e:
+            BOT_API_ERRORS.inc(method=method, error=type(e).__name__)
+            if isinstance(e, TimedOut) and str(e).startswith("Pool timeout"):
+                BOT_API_POOL_TIMEOUTS.inc(pool=self.pool)
+            raise
+        finally:
+            self._in_flight -= 1
+            self._update_pool_metrics()
+            BOT_API_LATENCY.observe(time.perf_counter() - started, method=method, pool=self.pool)
+
+
+# Отложенная запись оценок
+
+def ratings_dropped(reason: str, count: int):
+    RATINGS_DROPPED.inc(count, reason=reason)
+
+
+# Ограничитель исходящих вызовов
+
+def outbound_queued(lane: str):
+    OUTBOUND_WAITING.inc(lane=lane)
+
+
+def outbound_granted(lane: str, waited: float):
+    OUTBOUND_WAITING.dec(lane=lane)
+    OUTBOUND_WAIT.observe(waited, lane=lane)
+
+
+def outbound_retry_after(lane: str):
+    OUTBOUND_RETRY_AFTER.inc(lane=lane)
+
+
+# Рассылки
+
+def broadcast_started(target_rate: float):
+    BROADCASTS_ACTIVE.inc()
+    BROADCAST_TARGET_RATE.set(target_rate)
+
+
+def broadcast_enqueued():
+    BROADCAST_QUEUED.inc()
+
+
+def broadcast_progress(outcome: str, target_rate: float):
+    BROADCAST_MESSAGES.inc(outcome=outcome)
+    BROADCAST_QUEUED.dec()
+    BROADCAST_TARGET_RATE.set(target_rate)
+
+
+def broadcast_finished(unprocessed: int, rate: float):
+    """unprocessed - получатели, поставленные в очередь, но не обработанные (рассылку прервали)"""
+    BROADCASTS_ACTIVE.dec()
+    BROADCAST_QUEUED.dec(unprocessed)
+    BROADCAST_RATE.set(rate)
+
+
+def reminder_buckets_skipped(count: int):
+    REMINDER_BUCKETS_SKIPPED.inc(count)
+
+
+# Event loop
+
+async def _watch_event_loop_lag():
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, time.perf_counter() - started - LOOP_LAG_INTERVAL)
+        EVENT_LOOP_LAG.set(lag)
+        EVENT_LOOP_LAG_HISTOGRAM.observe(lag)
+
+
+class MetricsServer:
+    """HTTP сервер /metrics и замер задержки event loop"""
+
+    def __init__(self, listen: str = METRICS_LISTEN, port: int = METRICS_PORT):
+        self.enabled = bool(port)
+        self._server = HTTPServer(listen, port)
+        self._server.route('GET', '/metrics', self._metrics)
+        self._lag_task = None
+
+    @staticmethod
+    async def _metrics(request):
+        return Response(200, render().encode(), "text/plain; version=0.0.4; charset=utf-8")
+
+    async def start(self):
+        if not self.enabled:
+            return
+        await self._server.start()
+        self._lag_task = asyncio.create_task(_watch_event_loop_lag())
+
+    async def stop(self):
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            self._lag_task = None
+        await self._server.stop()
+
+
+metrics_server = MetricsServer()
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+Версионированные миграции схемы базы данных Spina Bot.
+
+create_tables() создает только отсутствующие таблицы и не меняет
+существующие, поэтому индексы и новые колонки для уже работающих баз
+добавляются здесь. Примененные версии хранятся в таблице schema_migrations.
+
+    python migrations.py          # применить новые миграции
+    python migrations.py --check  # проверить планы горячих запросов (EXPLAIN)
+    python -m pytest tests        # то же на временной базе после всех миграций
+"""
+
+import logging
+import sys
+from datetime import datetime, timedelta
+
+from sqlalchemy import Column, DateTime, Integer, String, Table, func, inspect, select, text
+from sqlalchemy.orm import aliased
+from sqlalchemy.schema import CreateIndex
+
+from database import Base, engine, User, UserResponse, VideoLesson, DailyRatingStats, BroadcastRun, OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+schema_migrations = Table(
+    'schema_migrations', Base.metadata,
+    Column('version', Integer, primary_key=True),
+    Column('name', String, nullable=False),
+    Column('applied_at', DateTime, default=datetime.utcnow),
+)
+
+
+def _create_index(conn, model, name):
+    """Создать индекс, объявленный в модели, если его еще нет"""
+    index = next(ix for ix in model.__table__.indexes if ix.name == name)
+    index.create(conn, checkfirst=True)
+
+
+def _add_hot_path_indexes(conn):
+    _create_index(conn, UserResponse, 'ix_user_responses_user_date')
+    _create_index(conn, User, 'ix_users_active_id')
+
+
+def _unique_video_lesson_pain_level(conn):
+    # Оставляем только последний загруженный урок для каждого уровня боли;
+    # удаленные дубликаты записываем в журнал, чтобы их можно было восстановить
+    duplicates = conn.execute(text(
+        "SELECT id, pain_level, file_id FROM video_lessons WHERE id NOT IN "
+        "(SELECT MAX(id) FROM video_lessons GROUP BY pain_level) ORDER BY pain_level, id"
+    )).all()
+    for lesson_id, pain_level, file_id in duplicates:
+        logger.warning(
+            f"Удален дубликат видео-урока id={lesson_id} для уровня боли {pain_level} (file_id={file_id})"
+        )
+    if duplicates:
+        conn.execute(
+            VideoLesson.__table__.delete().where(VideoLesson.id.in_([row.id for row in duplicates]))
+        )
+    _create_index(conn, VideoLesson, 'ux_video_lessons_pain_level')
+
+
+def _backfill_daily_rating_stats(conn):
+    # Дневная сводка по ответам, сохраненным до ее появления
+    DailyRatingStats.__table__.create(conn, checkfirst=True)
+    conn.execute(text(
+        "INSERT INTO daily_rating_stats (day, pain_level, response_count) "
+        "SELECT date(response_date), pain_rating, COUNT(*) FROM user_responses "
+        "WHERE response_date IS NOT NULL GROUP BY date(response_date), pain_rating"
+    ))
+
+
+def _add_user_reminder_time(conn):
+    # Колонки есть, если таблицу users уже создал create_tables() с новой моделью
+    existing = {column['name'] for column in inspect(conn).get_columns('users')}
+    for name, sql_type in (('timezone', 'VARCHAR'), ('reminder_minute', 'INTEGER'),
+                           ('reminder_utc_minute', 'INTEGER')):
+        if name not in existing:
+            conn.execute(text(f"ALTER TABLE users ADD COLUMN {name} {sql_type}"))
+    _create_index(conn, User, 'ix_users_reminder_bucket')
+
+
+def _add_outbox_leases(conn):
+    # Таблицы outbox нет, если ее еще не создал create_tables()
+    if not inspect(conn).has_table('outbox'):
+        return
+    existing = {column['name'] for column in inspect(conn).get_columns('outbox')}
+    for name, sql_type in (('lease_owner', 'VARCHAR'), ('lease_expires_at', 'DATETIME')):
+        if name not in existing:
+            conn.execute(text(f"ALTER TABLE outbox ADD COLUMN {name} {sql_type}"))
+
+
+def _add_campaigns(conn):
+    # Таблицы broadcast_runs нет, если ее еще не создал create_tables()
+    if not inspect(conn).has_table('broadcast_runs'):
+        return
+    existing = {column['name'] for column in inspect(conn).get_columns('broadcast_runs')}
+    if 'payload' not in existing:
+        conn.execute(text("ALTER TABLE broadcast_runs ADD COLUMN payload TEXT"))
+    _create_index(conn, BroadcastRun, 'ux_broadcast_runs_active_campaign')
+
+
+def _add_username_search_index(conn):
+    if not inspect(conn).has_table('users'):
+        return
+    # SQLite не показывает индексы по выражению в inspect(), поэтому checkfirst
+    # не видит уже созданный create_tables() индекс
+    index = next(ix for ix in User.__table__.indexes if ix.name == 'ix_users_username_lower_id')
+    conn.execute(CreateIndex(index, if_not_exists=True))
+
+
+def _add_user_list_filter_indexes(conn):
+    if not inspect(conn).has_table('users'):
+        return
+    # Без checkfirst: его отражение индексов users спотыкается об индекс по выражению
+    for name in ('ix_users_active_rating_date_id', 'ix_users_last_pain_rating_id'):
+        index = next(ix for ix in User.__table__.indexes if ix.name == name)
+        conn.execute(CreateIndex(index, if_not_exists=True))
+
+
+# (версия, описание, функция); новые миграции добавляются только в конец
+MIGRATIONS = [
+    (1, "индексы user_responses(user_id, response_date) и users(is_active, id)", _add_hot_path_indexes),
+    (2, "уникальный индекс video_lessons(pain_level)", _unique_video_lesson_pain_level),
+    (3, "заполнение daily_rating_stats по user_responses", _backfill_daily_rating_stats),
+    (4, "персональное время напоминаний и индекс минутных корзин", _add_user_reminder_time),
+    (5, "аренда сообщений outbox воркерами рассылок", _add_outbox_leases),
+    (6, "рассылки администратора: текст сообщения и одна незавершенная кампания", _add_campaigns),
+    (7, "индекс users(lower(username), id) для поиска в списке пользователей", _add_username_search_index),
+    (8, "индексы users(is_active, last_rating_date, id) и users(last_pain_rating, id) для фильтров списка пользователей",
+     _add_user_list_filter_indexes),
+]
+
+
+def run_migrations(bind=engine):
+    """Применить все еще не примененные миграции, каждую в своей транзакции"""
+    schema_migrations.create(bind, checkfirst=True)
+    with bind.connect() as conn:
+        applied = set(conn.execute(select(schema_migrations.c.version)).scalars())
+
+    for version, name, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        with bind.begin() as conn:
+            migrate(conn)
+            conn.execute(schema_migrations.insert().values(version=version, name=name))
+        logger.info(f"Применена миграция {version}: {name}")
+
+
+def _hot_queries():
+    """Формы горячих запросов и индекс, который каждый из них должен использовать"""
+    week_ago = datetime.utcnow() - timedelta(days=7)
+    cursor = aliased(User)
+    cursor_name = select(func.lower(cursor.username)).where(cursor.id == 1000).scalar_subquery()
+    cursor_date = select(cursor.last_rating_date).where(cursor.id == 1000).scalar_subquery()
+    cursor_rating = select(cursor.last_pain_rating).where(cursor.id == 1000).scalar_subquery()
+    return [
+        (
+            "получатели рассылки",
+            select(User.telegram_id)
+            .where(User.reminder_utc_minute.is_(None), User.is_active == True)
+            .order_by(User.id),
+            'ix_users_reminder_bucket',
+        ),
+        (
+            "получатели минутной корзины",
+            select(User.telegram_id)
+            .where(User.reminder_utc_minute == 600, User.is_active == True)
+            .order_by(User.id),
+            'ix_users_reminder_bucket',
+        ),
+        (
+            "непустые минутные корзины",
+            select(User.reminder_utc_minute).distinct()
+            .where(User.reminder_utc_minute.in_([598, 599, 600]), User.is_active == True),
+            'ix_users_reminder_bucket',
+        ),
+        (
+            "получатели рассылки администратора",
+            select(User.telegram_id)
+            .where(User.is_active == True, User.last_rating_date >= week_ago)
+            .order_by(User.id),
+            'ix_users_active_rating_date_id',
+        ),
+        (
+            "страница списка пользователей с фильтром",
+            select(User.id, User.telegram_id, User.username)
+            .where(User.is_active == False, User.id > 1000)
+            .order_by(User.id)
+            .limit(11),
+            'ix_users_active_id',
+        ),
+        (
+            "страница поиска пользователей по username",
+            select(User.id, User.telegram_id, User.username)
+            .where(func.lower(User.username) >= cursor_name,
+                   (func.lower(User.username) > cursor_name) | (User.id > 1000),
+                   func.lower(User.username) < 'ac')
+            .order_by(func.lower(User.username), User.id)
+            .limit(11),
+            'ix_users_username_lower_id',
+        ),
+        (
+            "страница списка: оценивали за 7 дней",
+            select(User.id, User.telegram_id, User.username)
+            .where(User.last_rating_date >= cursor_date,
+                   (User.last_rating_date > cursor_date) | (User.id > 1000),
+                   User.is_active == True)
+            .order_by(User.last_rating_date, User.id)
+            .limit(11),
+            'ix_users_active_rating_date_id',
+        ),
+        (
+            "страница списка по последней оценке",
+            select(User.id, User.telegram_id, User.username)
+            .where(User.last_pain_rating >= cursor_rating,
+                   (User.last_pain_rating > cursor_rating) | (User.id > 1000),
+                   User.last_pain_rating < 6)
+            .order_by(User.last_pain_rating, User.id)
+            .limit(11),
+            'ix_users_last_pain_rating_id',
+        ),
+        (
+            "пачка outbox в аренду",
+            select(OutboxMessage.id)
+            .where(OutboxMessage.run_id == 1, OutboxMessage.status == 'pending',
+                   OutboxMessage.next_attempt_at <= datetime.utcnow(),
+                   OutboxMessage.lease_expires_at.is_(None) | (OutboxMessage.lease_expires_at < datetime.utcnow()))
+            .order_by(OutboxMessage.id)
+            .limit(100),
+            'ix_outbox_run_status_id',
+        ),
+        (
+            "ответы за 7 дней",
+            select(UserResponse.id)
+            .where(UserResponse.user_id == 1, UserResponse.response_date >= week_ago),
+            'ix_user_responses_user_date',
+        ),
+        (
+            "последний ответ пользователя",
+            select(UserResponse.pain_rating, UserResponse.response_date)
+            .where(UserResponse.user_id == 1)
+            .order_by(UserResponse.response_date.desc(), UserResponse.id.desc())
+            .limit(1),
+            'ix_user_responses_user_date',
+        ),
+        (
+            "видео-урок по уровню боли",
+            select(VideoLesson.id).where(VideoLesson.pain_level == 1),
+            'ux_video_lessons_pain_level',
+        ),
+    ]
+
+
+def check_query_plans(bind=engine):
+    """Проверить через EXPLAIN QUERY PLAN, что горячие запросы используют индексы.
+
+    Возвращает список (описание, ожидаемый индекс, план) для запросов,
+    которые индекс не используют. Поддерживается только SQLite.
+    """
+    problems = []
+    with bind.connect() as conn:
+        for description, query, index_name in _hot_queries():
+            compiled = query.compile(bind, compile_kwargs={"literal_binds": True})
+            plan = " | ".join(
+                row[-1] for row in conn.execute(text(f"EXPLAIN QUERY PLAN {compiled}"))
+            )
+            logger.info(f"{description}: {plan}")
+            if index_name not in plan:
+                problems.append((description, index_name, plan))
+    return problems
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    run_migrations()
+
+    if '--check' in sys.argv[1:]:
+        problems = check_query_plans()
+        for description, index_name, plan in problems:
+            print(f"❌ {description}: индекс {index_name} не используется ({plan})")
+        if problems:
+            return 1
+        print("✅ Все горячие запросы используют индексы")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,340 @@
+"""
+Надежная доставка рассылок через таблицу outbox.
+
+Каждый запуск рассылки (broadcast_runs) сначала записывает в outbox по
+сообщению на получателя, а затем разбирает его пачками. Итоги отправки
+сохраняются в базу перед чтением следующей пачки и не реже раза в
+OUTBOX_FLUSH_INTERVAL, поэтому после перезапуска бота доставка продолжается
+с неотправленных сообщений, а повторный запуск с тем же run_key не
+отправляет сообщения второй раз. Повторно после сбоя могут уйти только
+сообщения, отправленные за последний интервал до него.
+
+Временные ошибки (сеть, таймауты) повторяются с экспоненциальной задержкой
+до OUTBOX_MAX_ATTEMPTS попыток.
+
+Пачки берутся в аренду (lease_owner, lease_expires_at) одним UPDATE, поэтому
+одну рассылку могут разбирать несколько процессов: бот и воркеры рассылок
+(BOT_MODE=worker в main.py). Процесс продлевает аренду, пока отправляет
+пачку; аренду упавшего процесса через OUTBOX_LEASE_SECONDS забирают другие.
+При BROADCAST_WORKERS > 0 бот только создает запуски, а отправляют воркеры,
+деля между собой лимит скорости Telegram (у каждого свой ограничитель вызовов
+с долей лимита, см. governor.py).
+
+Запуск можно приостановить (paused) и отменить (cancelled): процессы
+проверяют статус перед каждой пачкой, а в этом процессе - перед каждым
+сообщением. После возобновления доставка продолжается с неотправленных
+сообщений, при отмене они получают статус cancelled.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import secrets
+import signal
+import socket
+import time
+from datetime import datetime, timedelta
+
+from broadcast import BroadcastEngine, GLOBAL_RATE_LIMIT, SEND_BLOCKED, SEND_RETRY, SEND_SENT
+from database import (
+    run_db, create_broadcast_run, claim_outbox_batch, renew_outbox_leases, release_outbox_leases,
+    record_outbox_results, next_outbox_attempt, count_pending_outbox, finish_broadcast_run,
+    fetch_unfinished_runs, purge_broadcast_runs, fetch_broadcast_run_status, set_broadcast_run_status,
+    cancel_broadcast_run
+)
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '100'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '5'))
+OUTBOX_BACKOFF_BASE = 30        # секунд до первой повторной попытки
+OUTBOX_BACKOFF_MAX = 3600       # секунд, больше которых задержка не растет
+OUTBOX_RETRY_GROUPING = 5       # секунд: повторы, наступающие в этом интервале, идут одним проходом
+OUTBOX_RETENTION_DAYS = 7       # сколько дней хранить завершенные запуски
+OUTBOX_LEASE_SECONDS = int(os.getenv('OUTBOX_LEASE_SECONDS', '60'))
+OUTBOX_FLUSH_INTERVAL = 1.0     # секунд: итоги отправки записываются не реже, чем раз в интервал
+OUTBOX_POLL_INTERVAL = 2.0      # секунд между проверками новых запусков в воркере
+OUTBOX_STOP_WAIT = 10.0         # секунд, которые пауза и отмена ждут записи итогов доставки в этом процессе
+
+# Число воркеров рассылок; 0 - бот отправляет рассылки сам
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', '0'))
+
+# Владелец аренды сообщений: уникален для каждого процесса
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(3)}"
+
+# Фабрики отправителей по типу рассылки: factory(bot, payload) -> async send(chat_id),
+# payload - сообщение запуска из broadcast_runs.payload (None для напоминаний)
+_senders = {}
+
+# Бот с отдельным пулом соединений для рассылок (use_bulk_bot); None - бот вызывающего
+_bulk_bot = None
+
+# Запуски, которые уже разбираются в этом процессе
+_active_runs = set()
+
+# Запуски, приостановленные или отмененные в этом процессе: доставка
+# останавливается перед следующим сообщением, не дожидаясь конца пачки
+_stopping = set()
+
+
+def register_sender(kind: str, factory):
+    """Зарегистрировать отправку сообщений рассылки типа kind (нужно для возобновления)"""
+    _senders[kind] = factory
+
+
+def use_bulk_bot(bot):
+    """Отправлять сообщения всех рассылок через bot (None - через бот, переданный в deliver_run)"""
+    global _bulk_bot
+    _bulk_bot = bot
+
+
+def backoff_delay(attempts: int) -> float:
+    """Задержка перед следующей попыткой после attempts неудачных"""
+    return min(OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1), OUTBOX_BACKOFF_MAX)
+
+
+def _outcome_to_result(row, outcome, error, now):
+    attempts = row.attempts + 1
+    if outcome == SEND_RETRY and attempts < OUTBOX_MAX_ATTEMPTS:
+        status, next_attempt_at = 'pending', now + timedelta(seconds=backoff_delay(attempts))
+    else:
+        status = {SEND_SENT: 'sent', SEND_BLOCKED: 'blocked'}.get(outcome, 'failed')
+        next_attempt_at = now
+    message = str(error)[:500] if error is not None else None
+    return row.id, row.telegram_id, status, attempts, next_attempt_at, message
+
+
+async def start_run(application, run_key: str, kind: str, name: str, utc_minute: int = None, pacer_factory=None):
+    """Создать (или найти) запуск рассылки и начать его доставку фоновой задачей.
+
+    Доставка (с паузами перед повторными попытками) идет в задаче
+    application.create_task, поэтому задача планировщика, создающая запуски,
+    не ждет ее и следующая минутная корзина не откладывается. Возвращает
+    задачу доставки или None, если запуск отправляют воркеры рассылок.
+
+    pacer_factory(total) - необязательная фабрика WindowPacer для первого прохода.
+    """
+    run_id, created = await run_db(create_broadcast_run, run_key, kind, utc_minute)
+    if BROADCAST_WORKERS:
+        # Окно доставки воркерами не применяется: их темп задает доля лимита скорости
+        logger.info(f"{name.capitalize()}: запуск {run_id} передан воркерам рассылок")
+        return None
+    if not created:
+        logger.info(f"Запуск {run_key} уже существует, продолжаем его без повторной отправки")
+    return application.create_task(
+        deliver_run(application.bot, run_id, kind, name, pacer_factory=pacer_factory)
+    )
+
+
+async def deliver_run(bot, run_id: int, kind: str, name: str, pacer_factory=None, payload: str = None):
+    """Разбирать outbox запуска, пока в нем есть неотправленные сообщения.
+
+    payload - JSON сообщения запуска (broadcast_runs.payload).
+    Возвращает, не подводя итог, если запуск приостановили или отменили.
+    """
+    if run_id in _active_runs:
+        return
+    _active_runs.add(run_id)
+    try:
+        send = _senders[kind](_bulk_bot or bot, json.loads(payload) if payload else None)
+        while True:
+            await _drain_pass(run_id, send, name, pacer_factory)
+            # Окно доставки действует только на первый проход
+            pacer_factory = None
+
+            status = await run_db(fetch_broadcast_run_status, run_id)
+            if status != 'running':
+                logger.info(f"{name.capitalize()}: запуск {run_id} остановлен ({status})")
+                return
+
+            next_attempt_at = await run_db(next_outbox_attempt, run_id)
+            if next_attempt_at is None:
+                break
+            delay = (next_attempt_at - datetime.utcnow()).total_seconds()
+            if delay > 0:
+                logger.info(f"{name.capitalize()}: повторные попытки через {delay:.0f} с")
+                await asyncio.sleep(delay)
+
+        counts = await run_db(finish_broadcast_run, run_id)
+        if counts is None:
+            # Последние сообщения отправил другой процесс, он и подвел итог
+            return
+        logger.info(
+            f"{name.capitalize()}: запуск {run_id} завершен, отправлено {counts.get('sent', 0)}, "
+            f"заблокировали бота {counts.get('blocked', 0)}, ошибок {counts.get('failed', 0)}"
+        )
+    finally:
+        _active_runs.discard(run_id)
+        _stopping.discard(run_id)
+
+
+async def _wait_delivery_stopped(run_id: int, timeout: float = None):
+    """Дождаться, пока доставка запуска в этом процессе запишет итоги и завершится"""
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    while run_id in _active_runs and (deadline is None or time.monotonic() < deadline):
+        await asyncio.sleep(0.1)
+
+
+async def pause_run(run_id: int) -> bool:
+    """Приостановить запуск; False если он не идет"""
+    if not await run_db(set_broadcast_run_status, run_id, 'paused', 'running'):
+        return False
+    if run_id in _active_runs:
+        _stopping.add(run_id)
+        await _wait_delivery_stopped(run_id, OUTBOX_STOP_WAIT)
+    return True
+
+
+async def resume_run(application, run_id: int, kind: str, name: str, payload: str = None) -> bool:
+    """Возобновить приостановленный запуск; False если он не на паузе"""
+    if not await run_db(set_broadcast_run_status, run_id, 'running', 'paused'):
+        return False
+    _stopping.discard(run_id)
+    if not BROADCAST_WORKERS:
+        # Приостановленная доставка может еще дописывать итоги: новая начнется после нее
+        application.create_task(_deliver_after_stop(application.bot, run_id, kind, name, payload))
+    return True
+
+
+async def _deliver_after_stop(bot, run_id, kind, name, payload):
+    await _wait_delivery_stopped(run_id)
+    await deliver_run(bot, run_id, kind, name, payload=payload)
+
+
+async def cancel_run(run_id: int):
+    """Отменить запуск; количество сообщений по статусам или None, если он уже завершен"""
+    counts = await run_db(cancel_broadcast_run, run_id)
+    if counts is not None and run_id in _active_runs:
+        _stopping.add(run_id)
+        await _wait_delivery_stopped(run_id, OUTBOX_STOP_WAIT)
+    return counts
+
+
+async def _renew_leases():
+    """Продлевать аренду взятых сообщений, пока идет проход"""
+    while True:
+        await asyncio.sleep(OUTBOX_LEASE_SECONDS / 3)
+        await run_db(renew_outbox_leases, WORKER_ID, datetime.utcnow() + timedelta(seconds=OUTBOX_LEASE_SECONDS))
+
+
+async def _drain_pass(run_id: int, send, name: str, pacer_factory):
+    """Один проход по сообщениям запуска, которые уже пора отправить"""
+    in_flight = {}
+    results = []
+
+    async def flush_results():
+        if results:
+            # Забираем накопленное до ожидания: рассылка продолжает пополнять список
+            pending = results[:]
+            del results[:len(pending)]
+            await run_db(record_outbox_results, pending)
+
+    async def recipients():
+        due_before = datetime.utcnow() + timedelta(seconds=OUTBOX_RETRY_GROUPING)
+        while True:
+            await flush_results()
+            # Пауза или отмена в другом процессе видна перед следующей пачкой
+            if run_id in _stopping or await run_db(fetch_broadcast_run_status, run_id) != 'running':
+                return
+            now = datetime.utcnow()
+            batch = await run_db(
+                claim_outbox_batch, run_id, WORKER_ID, due_before, now,
+                now + timedelta(seconds=OUTBOX_LEASE_SECONDS), OUTBOX_BATCH_SIZE
+            )
+            if not batch:
+                return
+            # Вся пачка в аренде: при остановке невыданные сообщения тоже возвращаются
+            for row in batch:
+                in_flight[row.telegram_id] = row
+            for row in batch:
+                if run_id in _stopping:
+                    return
+                yield row.telegram_id
+
+    async def flush_periodically():
+        # Упавший процесс повторно отправит только сообщения последнего интервала
+        while True:
+            await asyncio.sleep(OUTBOX_FLUSH_INTERVAL)
+            await flush_results()
+
+    def on_result(chat_id, outcome, error):
+        results.append(_outcome_to_result(in_flight.pop(chat_id), outcome, error, datetime.utcnow()))
+
+    pacer = None
+    if pacer_factory is not None:
+        pending_total = await run_db(count_pending_outbox, run_id)
+        pacer = pacer_factory(pending_total)
+
+    # Временные ошибки повторяет outbox с задержкой, а не движок сразу.
+    # Лимит скорости - только у ограничителя вызовов бота рассылок (governor.py),
+    # у воркеров - их доля лимита (main.run_broadcast_worker)
+    rate = GLOBAL_RATE_LIMIT / BROADCAST_WORKERS if BROADCAST_WORKERS else GLOBAL_RATE_LIMIT
+    engine = BroadcastEngine(rate=rate, max_attempts=1, governed=True)
+    background = [asyncio.create_task(_renew_leases()), asyncio.create_task(flush_periodically())]
+    try:
+        await engine.run(recipients(), send, name=name, pacer=pacer, on_result=on_result,
+                         stopped=lambda: run_id in _stopping)
+    finally:
+        for task in background:
+            task.cancel()
+        await flush_results()
+        if in_flight:
+            # Взятые, но не отправленные сообщения сразу достаются другим процессам
+            await run_db(release_outbox_leases, WORKER_ID, [row.id for row in in_flight.values()])
+
+
+async def resume_unfinished_runs(application):
+    """Продолжить запуски, прерванные предыдущей остановкой бота (из post_init)"""
+    if BROADCAST_WORKERS:
+        return
+    for run in await run_db(fetch_unfinished_runs):
+        if run.kind not in _senders:
+            logger.warning(f"Нет отправителя для рассылки {run.kind}, запуск {run.run_key} пропущен")
+            continue
+        logger.info(f"Возобновляем рассылку {run.run_key}")
+        application.create_task(
+            deliver_run(application.bot, run.id, run.kind, f"рассылка {run.run_key}", payload=run.payload)
+        )
+
+
+async def purge_old_runs(context):
+    """Ежедневная очистка outbox от давно завершенных запусков"""
+    purged = await run_db(purge_broadcast_runs, datetime.utcnow() - timedelta(days=OUTBOX_RETENTION_DAYS))
+    if purged:
+        logger.info(f"Удалено {purged} завершенных запусков рассылки")
+
+
+async def serve_worker(bot, stop_event: asyncio.Event = None):
+    """Воркер рассылок: разбирать незавершенные запуски до stop_event (или SIGINT/SIGTERM)"""
+    if stop_event is None:
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop_event.set)
+            except NotImplementedError:
+                pass
+
+    logger.info(f"Воркер рассылок {WORKER_ID} запущен")
+    tasks = set()
+    try:
+        while not stop_event.is_set():
+            for run in await run_db(fetch_unfinished_runs):
+                if run.id in _active_runs or run.kind not in _senders:
+                    continue
+                task = asyncio.create_task(
+                    deliver_run(bot, run.id, run.kind, f"рассылка {run.run_key}", payload=run.payload)
+                )
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            try:
+                await asyncio.wait_for(stop_event.wait(), OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        # Прерванные проходы записывают итоги и возвращают аренду
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        logger.info(f"Воркер рассылок {WORKER_ID} остановлен")
@@ -0,0 +1,142 @@
+"""
+Счетчик SQL-запросов на один апдейт Telegram.
+
+Обертка обработчиков (metrics.instrument_application) открывает учет на
+время обработки апдейта, а события SQLAlchemy (metrics.instrument_engine)
+добавляют в него каждый запрос. Учет хранится в contextvar и переносится
+в пул потоков БД вместе с контекстом (см. database.run_db).
+
+По итогам апдейта в журнал пишутся:
+    - апдейты, сделавшие больше QUERY_LOG_THRESHOLD запросов
+      или потратившие на базу больше QUERY_SLOW_MS миллисекунд;
+    - повтор одного и того же запроса N_PLUS_ONE_THRESHOLD раз и больше
+      (типичный N+1: запрос в цикле по строкам другого запроса).
+
+Бюджет запросов обработчиков задан в HANDLER_QUERY_BUDGETS для прогретого
+бота (первая оценка пользователя еще заполняет его агрегаты и кэш уроков).
+QUERY_BUDGET_MODE=warn пишет превышения в журнал, raise (для тестов и
+benchmarks/query_budget.py) бросает QueryBudgetExceeded.
+"""
+
+import contextvars
+import logging
+import os
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+QUERY_LOG_THRESHOLD = int(os.getenv('QUERY_LOG_THRESHOLD', '10'))
+QUERY_SLOW_MS = float(os.getenv('QUERY_SLOW_MS', '200'))
+N_PLUS_ONE_THRESHOLD = int(os.getenv('N_PLUS_ONE_THRESHOLD', '5'))
+# off - не проверять, warn - писать в журнал, raise - бросать QueryBudgetExceeded
+QUERY_BUDGET_MODE = os.getenv('QUERY_BUDGET_MODE', 'off').lower()
+
+# Максимум запросов на апдейт по метке обработчика (см. metrics.update_label)
+HANDLER_QUERY_BUDGETS = {
+    '/start': 3,
+    '/stats': 4,
+    '/stop': 2,
+    '/resume': 2,
+    '/status': 1,
+    '/timezone': 2,
+    '/time': 2,
+    'pain': 5,
+    'manage_time': 0,
+    'toggle_reminders': 2,
+    'set_time': 2,
+    'set_window': 2,
+    'view_stats': 3,
+    'manage_users': 1,
+    'manage_video': 1,
+    'list_users': 1,
+    'list_all_next': 1,
+    'list_all_prev': 2,  # вторая - если до начала списка меньше страницы
+    'list_recent': 1,
+    'list_high': 1,
+    'list_high_next': 1,
+    'list_high_prev': 2,
+}
+DEFAULT_QUERY_BUDGET = 10
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Обработчик сделал больше запросов, чем разрешено бюджетом"""
+
+
+class QueryTally:
+    """Запросы одного апдейта"""
+
+    def __init__(self, label: str):
+        self.label = label
+        self.count = 0
+        self.duration = 0.0
+        self.statements = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, statement: str, duration: float):
+        # Запросы идут из потоков пула БД, иногда параллельно
+        with self._lock:
+            self.count += 1
+            self.duration += duration
+            self.statements[statement] += 1
+
+    def most_repeated(self):
+        """(запрос, число повторов) самого частого запроса"""
+        with self._lock:
+            return self.statements.most_common(1)[0] if self.statements else (None, 0)
+
+
+_current_tally = contextvars.ContextVar('spina_query_tally', default=None)
+
+
+def record(statement: str, duration: float):
+    """Учесть запрос в текущем апдейте (вызывается из событий SQLAlchemy)"""
+    tally = _current_tally.get()
+    if tally is not None:
+        tally.add(statement, duration)
+
+
+def current_tally():
+    return _current_tally.get()
+
+
+@contextmanager
+def track_update(label: str):
+    """Учет запросов на время обработки апдейта обработчиком label"""
+    if _current_tally.get() is not None:
+        # Вложенный обработчик: запросы уже учитываются внешним
+        yield _current_tally.get()
+        return
+
+    tally = QueryTally(label)
+    token = _current_tally.set(tally)
+    try:
+        yield tally
+    finally:
+        _current_tally.reset(token)
+    _report(tally)
+
+
+def _report(tally: QueryTally):
+    if tally.count > QUERY_LOG_THRESHOLD or tally.duration * 1000 > QUERY_SLOW_MS:
+        logger.warning(
+            f"Обработчик {tally.label}: {tally.count} запросов к базе за {tally.duration * 1000:.1f} мс"
+        )
+
+    statement, repeats = tally.most_repeated()
+    if repeats >= N_PLUS_ONE_THRESHOLD:
+        logger.warning(
+            f"Обработчик {tally.label}: возможный N+1, запрос повторен {repeats} раз: "
+            f"{' '.join(statement.split())[:200]}"
+        )
+
+    if QUERY_BUDGET_MODE == 'off':
+        return
+    budget = HANDLER_QUERY_BUDGETS.get(tally.label, DEFAULT_QUERY_BUDGET)
+    if tally.count > budget:
+        message = f"Обработчик {tally.label}: {tally.count} запросов при бюджете {budget}"
+        if QUERY_BUDGET_MODE == 'raise':
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
@@ -0,0 +1,20 @@
+"""
+Общее окружение тестов: временная база вместо рабочей, поддельный токен и
+никаких обращений к Telegram. Задается до импорта модулей бота, которые
+читают переменные окружения при импорте (database, flood_guard, governor).
+"""
+
+import os
+import tempfile
+
+_tmp_dir = tempfile.mkdtemp(prefix="spina_tests_")
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_tmp_dir, 'spina_bot.db')}"
+os.environ['BOT_TOKEN'] = "123456:test"
+os.environ['TELEGRAM_API_URL'] = ''
+os.environ['METRICS_PORT'] = '0'
+# Сценарии идут быстрее живого пользователя: лимиты модулей по умолчанию сняты,
+# тесты ограничителей создают их со своими параметрами
+os.environ['USER_RATE_LIMIT'] = '1000000'
+os.environ['DUPLICATE_CALLBACK_WINDOW'] = '0'
+os.environ['OUTBOUND_CHAT_INTERVAL'] = '0'
+os.environ['BROADCAST_RATE_LIMIT'] = '1000000'
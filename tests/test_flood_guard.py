@@ -0,0 +1,170 @@
+"""
+Фильтр входящих апдейтов (flood_guard.py) в очереди апдейтов: лишние апдейты
+отбрасываются при поступлении, не дожидаясь очереди чата и места, а ответы
+на них уходят в фоне и не чаще раза в интервал.
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import flood_guard
+import metrics
+from flood_guard import SHED_TEXT, THROTTLED_TEXT, UpdateGuard
+from update_processor import PerChatUpdateProcessor
+
+USER = 7_000_001
+OTHER_USER = 7_000_002
+
+
+class Replies:
+    """Ответы бота на апдейты; пока gate закрыт, ни один ответ не завершается"""
+
+    def __init__(self):
+        self.sent = []
+        self.gate = asyncio.Event()
+
+    def reply(self, chat_id):
+        async def send(text=None, **kwargs):
+            await self.gate.wait()
+            self.sent.append((chat_id, text))
+        return send
+
+
+def _message(update_id, user_id, text, replies):
+    message = SimpleNamespace(text=text, video=None, video_note=None, reply_text=replies.reply(user_id))
+    return SimpleNamespace(
+        update_id=update_id, effective_user=SimpleNamespace(id=user_id),
+        effective_chat=SimpleNamespace(id=user_id), effective_message=message, callback_query=None,
+    )
+
+
+def _tap(update_id, user_id, data, replies, message_id=1):
+    query = SimpleNamespace(
+        data=data, from_user=SimpleNamespace(id=user_id),
+        message=SimpleNamespace(message_id=message_id), answer=replies.reply(user_id),
+    )
+    return SimpleNamespace(
+        update_id=update_id, effective_user=SimpleNamespace(id=user_id),
+        effective_chat=SimpleNamespace(id=user_id), effective_message=query.message, callback_query=query,
+    )
+
+
+async def _handle(handled, update, release=None):
+    if release is not None:
+        await release.wait()
+    handled.append(update.update_id)
+
+
+def _dropped(reason):
+    return sum(value for key, value in metrics.UPDATES_DROPPED._values.items() if key[0] == reason)
+
+
+def test_flood_is_dropped_without_waiting_for_chat_or_slot():
+    async def scenario():
+        guard = UpdateGuard(rate=0.001, burst=2)
+        processor = PerChatUpdateProcessor(max_concurrent_updates=1, admit=guard.admit)
+        replies = Replies()
+        handled = []
+        release = asyncio.Event()
+
+        # Единственное место занято медленным апдейтом другого пользователя
+        slow = _message(1, OTHER_USER, "привет", replies)
+        busy = asyncio.create_task(processor.process_update(slow, _handle(handled, slow, release)))
+        await asyncio.sleep(0)
+        flood = [_message(10 + i, USER, "спам", replies) for i in range(6)]
+        tasks = [asyncio.create_task(processor.process_update(update, _handle(handled, update))) for update in flood]
+        await asyncio.sleep(0.01)
+
+        # Запас из двух апдейтов ждет места, остальные уже отброшены
+        done = [task.done() for task in tasks]
+        pending = processor.pending
+        release.set()
+        replies.gate.set()
+        await asyncio.gather(busy, *tasks, *guard._replies)
+        return done, pending, handled, replies.sent
+
+    dropped_before = _dropped('throttled')
+    done, pending, handled, sent = asyncio.run(scenario())
+    assert done == [False, False, True, True, True, True]
+    assert pending == 3
+    assert handled == [1, 10, 11]
+    assert _dropped('throttled') - dropped_before == 4
+    # Одно предупреждение на всю серию
+    assert sent == [(USER, THROTTLED_TEXT)]
+
+
+def test_throttle_notice_does_not_block_and_repeats_after_interval(monkeypatch):
+    async def scenario():
+        guard = UpdateGuard(rate=0.001, burst=1)
+        processor = PerChatUpdateProcessor(admit=guard.admit)
+        replies = Replies()
+        handled = []
+
+        async def feed(update_id):
+            update = _message(update_id, USER, "спам", replies)
+            await asyncio.wait_for(processor.process_update(update, _handle(handled, update)), 1)
+
+        await feed(1)
+        # Ответы еще не доставлены (gate закрыт), а апдейты уже отброшены
+        for update_id in range(2, 6):
+            await feed(update_id)
+        notices = len(guard._replies)
+        monkeypatch.setattr(flood_guard, 'THROTTLE_NOTICE_INTERVAL', 0)
+        await feed(6)
+        replies.gate.set()
+        await asyncio.gather(*guard._replies)
+        return handled, notices, replies.sent
+
+    handled, notices, sent = asyncio.run(scenario())
+    assert handled == [1]
+    assert notices == 1
+    assert sent == [(USER, THROTTLED_TEXT)] * 2
+
+
+def test_duplicate_tap_is_dropped_silently(monkeypatch):
+    monkeypatch.setattr(flood_guard, 'DUPLICATE_CALLBACK_WINDOW', 2)
+
+    async def scenario():
+        guard = UpdateGuard(rate=1000, burst=1000)
+        processor = PerChatUpdateProcessor(admit=guard.admit)
+        replies = Replies()
+        replies.gate.set()
+        handled = []
+        taps = [_tap(1, USER, 'pain_3', replies), _tap(2, USER, 'pain_3', replies),
+                _tap(3, USER, 'pain_3', replies, message_id=2)]
+        for update in taps:
+            await processor.process_update(update, _handle(handled, update))
+        return handled, replies.sent, guard._replies
+
+    handled, sent, background = asyncio.run(scenario())
+    assert handled == [1, 3]
+    assert sent == [] and not background
+
+
+@pytest.mark.parametrize('text, shed', [("/stats", True), ("/start", False)])
+def test_secondary_commands_are_shed_under_backlog(text, shed):
+    async def scenario():
+        guard = UpdateGuard(rate=1000, burst=1000, shed_backlog=1)
+        processor = PerChatUpdateProcessor(admit=guard.admit)
+        replies = Replies()
+        replies.gate.set()
+        handled = []
+        release = asyncio.Event()
+
+        first = _message(1, OTHER_USER, "привет", replies)
+        busy = asyncio.create_task(processor.process_update(first, _handle(handled, first, release)))
+        await asyncio.sleep(0)
+        command = _message(2, USER, text, replies)
+        task = asyncio.create_task(processor.process_update(command, _handle(handled, command)))
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(busy, task, *guard._replies)
+        return handled, replies.sent
+
+    handled, sent = asyncio.run(scenario())
+    if shed:
+        assert handled == [1] and sent == [(USER, SHED_TEXT)]
+    else:
+        assert sorted(handled) == [1, 2] and sent == []
@@ -0,0 +1,103 @@
+"""
+Ограничитель исходящих вызовов: ответы пользователям обгоняют рассылку,
+повтор после RetryAfter не занимает второе место в очереди чата, а рассылка
+outbox ограничивается только им, без второго token bucket движка.
+"""
+
+import asyncio
+import time
+
+from telegram.error import RetryAfter
+
+from broadcast import BroadcastEngine
+from governor import OutboundGovernor
+
+
+def test_interactive_calls_preempt_queued_bulk():
+    async def scenario():
+        governor = OutboundGovernor(rate=20, per_chat_interval=0)
+        order = []
+
+        async def call(lane, n):
+            async def send():
+                order.append((lane, n))
+            await governor.call('sendMessage', lane, n, send)
+
+        bulk = [asyncio.create_task(call('bulk', n)) for n in range(8)]
+        # Рассылка уже стоит в очереди, когда приходят ответы пользователям
+        await asyncio.sleep(0.01)
+        interactive = [asyncio.create_task(call('interactive', n)) for n in range(3)]
+        await asyncio.gather(*bulk, *interactive)
+        return order
+
+    order = asyncio.run(scenario())
+    lanes = [lane for lane, _ in order]
+    # Первую рассылку токен застал свободным, дальше - все ответы, затем остальная рассылка
+    assert lanes == ['bulk'] + ['interactive'] * 3 + ['bulk'] * 7
+    # Внутри полосы - по очереди поступления
+    assert [n for lane, n in order if lane == 'bulk'] == list(range(8))
+
+
+def test_callback_answers_do_not_wait_for_message_queue():
+    async def scenario():
+        governor = OutboundGovernor(rate=5, per_chat_interval=0)
+
+        async def send():
+            pass
+
+        bulk = [asyncio.create_task(governor.call('sendMessage', 'bulk', n, send)) for n in range(5)]
+        await asyncio.sleep(0.01)
+        started = time.perf_counter()
+        await governor.call('answerCallbackQuery', 'interactive', None, send)
+        elapsed = time.perf_counter() - started
+        for task in bulk:
+            task.cancel()
+        await asyncio.gather(*bulk, return_exceptions=True)
+        return elapsed
+
+    assert asyncio.run(scenario()) < 0.05
+
+
+def test_retry_after_does_not_charge_chat_turn_twice():
+    async def scenario():
+        governor = OutboundGovernor(rate=1000, chat_burst=1, per_chat_interval=1.0)
+        attempts = []
+
+        async def send():
+            attempts.append(time.perf_counter())
+            if len(attempts) == 1:
+                raise RetryAfter(0.05)
+
+        started = time.perf_counter()
+        await governor.call('sendMessage', 'interactive', 42, send)
+        return governor, attempts, time.perf_counter() - started
+
+    governor, attempts, elapsed = asyncio.run(scenario())
+    assert len(attempts) == 2
+    # Повтор ждет только паузу RetryAfter, а не еще один интервал чата
+    assert elapsed < 0.5
+    assert governor._chats[42][0] == 0
+
+
+def test_governed_broadcast_is_limited_only_by_governor():
+    async def scenario():
+        governor = OutboundGovernor(rate=100, per_chat_interval=0)
+        # Свой лимит движка в 1 сообщение в секунду растянул бы рассылку на 10 с
+        engine = BroadcastEngine(rate=1, max_attempts=1, governed=True)
+        retried = set()
+
+        async def send(chat_id):
+            async def post():
+                if chat_id == 3 and chat_id not in retried:
+                    retried.add(chat_id)
+                    raise RetryAfter(0.05)
+            await governor.call('sendMessage', 'bulk', chat_id, post)
+
+        started = time.perf_counter()
+        stats = await engine.run(range(10), send)
+        return stats, time.perf_counter() - started
+
+    stats, elapsed = asyncio.run(scenario())
+    assert stats.sent == 10
+    assert stats.retry_after_pauses == 1
+    assert elapsed < 1.0
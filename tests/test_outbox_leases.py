@@ -0,0 +1,163 @@
+"""
+Аренда сообщений outbox: два процесса на одной базе SQLite не берут одно
+сообщение, а аренда упавшего процесса после истечения достается другому.
+"""
+
+import asyncio
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine, event, insert, select
+from sqlalchemy.orm import sessionmaker
+
+import outbox
+from database import (
+    Base, BroadcastRun, OutboxMessage, SessionLocal, claim_outbox_batch, create_tables,
+    release_outbox_leases, renew_outbox_leases,
+)
+
+MESSAGES = 300
+LEASE = timedelta(seconds=60)
+
+
+def _add_run(session_factory, run_key, count, first_telegram_id=1):
+    with session_factory() as db:
+        run = BroadcastRun(run_key=run_key, kind='reminder', total=count)
+        db.add(run)
+        db.flush()
+        now = datetime.utcnow()
+        db.execute(insert(OutboxMessage), [
+            {'run_id': run.id, 'telegram_id': first_telegram_id + i, 'status': 'pending',
+             'attempts': 0, 'next_attempt_at': now}
+            for i in range(count)
+        ])
+        run_id = run.id
+        db.commit()
+    return run_id
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    # Отдельный файл базы с настройками рабочего профиля: WAL и ожидание блокировки
+    engine = create_engine(f"sqlite:///{tmp_path / 'outbox.db'}")
+
+    @event.listens_for(engine, "connect")
+    def _pragmas(dbapi_connection, connection_record):
+        dbapi_connection.execute("PRAGMA journal_mode=WAL")
+        dbapi_connection.execute("PRAGMA busy_timeout=10000")
+
+    Base.metadata.create_all(engine)
+    yield sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    engine.dispose()
+
+
+def _claim(session_factory, run_id, owner, now, limit=7):
+    with session_factory() as db:
+        return claim_outbox_batch(db, run_id, owner, now, now, now + LEASE, limit)
+
+
+def test_two_claimers_never_share_a_message(session_factory):
+    run_id = _add_run(session_factory, 'parallel', MESSAGES)
+    claimed = {'a': [], 'b': []}
+    start = threading.Barrier(2)
+    errors = []
+
+    def claimer(owner):
+        try:
+            start.wait()
+            # Каждый процесс со своим соединением берет пачки, пока сообщения не кончатся
+            while True:
+                batch = _claim(session_factory, run_id, owner, datetime.utcnow())
+                if not batch:
+                    return
+                claimed[owner].extend(row.id for row in batch)
+        except Exception as e:  # pragma: no cover - ошибка видна в assert ниже
+            errors.append(e)
+
+    threads = [threading.Thread(target=claimer, args=(owner,)) for owner in claimed]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    a, b = set(claimed['a']), set(claimed['b'])
+    assert len(a) == len(claimed['a']) and len(b) == len(claimed['b'])
+    assert not a & b
+    with session_factory() as db:
+        all_ids = set(db.execute(select(OutboxMessage.id).where(OutboxMessage.run_id == run_id)).scalars())
+        owners = dict(db.execute(select(OutboxMessage.id, OutboxMessage.lease_owner)).all())
+    assert a | b == all_ids
+    assert all(owners[outbox_id] == 'a' for outbox_id in a)
+    assert all(owners[outbox_id] == 'b' for outbox_id in b)
+
+
+def test_expired_lease_is_reclaimed(session_factory):
+    run_id = _add_run(session_factory, 'crashed', 10)
+    t0 = datetime.utcnow()
+    taken = {row.id for row in _claim(session_factory, run_id, 'crashed', t0, limit=10)}
+    assert len(taken) == 10
+
+    # Пока аренда действует, другой процесс сообщения не получает
+    assert _claim(session_factory, run_id, 'survivor', t0 + LEASE / 2, limit=10) == []
+    # После истечения аренды сообщения упавшего процесса достаются другому
+    reclaimed = _claim(session_factory, run_id, 'survivor', t0 + LEASE + timedelta(seconds=1), limit=10)
+    assert {row.id for row in reclaimed} == taken
+
+
+def test_renewed_lease_is_not_reclaimed(session_factory):
+    run_id = _add_run(session_factory, 'renewed', 10)
+    t0 = datetime.utcnow()
+    _claim(session_factory, run_id, 'alive', t0, limit=4)
+    _claim(session_factory, run_id, 'other', t0, limit=3)
+
+    with session_factory() as db:
+        # Продлевается только аренда своего процесса
+        assert renew_outbox_leases(db, 'alive', t0 + 3 * LEASE) == 4
+
+    later = t0 + LEASE + timedelta(seconds=1)
+    reclaimed = _claim(session_factory, run_id, 'survivor', later, limit=10)
+    # Свободные 3 сообщения и 3 с истекшей арендой 'other', но не 4 продленных
+    assert len(reclaimed) == 6
+    with session_factory() as db:
+        owners = db.execute(
+            select(OutboxMessage.lease_owner).where(OutboxMessage.run_id == run_id)
+        ).scalars().all()
+    assert owners.count('alive') == 4 and owners.count('survivor') == 6
+
+
+def test_released_messages_go_to_another_claimer(session_factory):
+    run_id = _add_run(session_factory, 'released', 5)
+    t0 = datetime.utcnow()
+    taken = [row.id for row in _claim(session_factory, run_id, 'stopping', t0, limit=5)]
+    with session_factory() as db:
+        release_outbox_leases(db, 'stopping', taken[2:])
+    assert [row.id for row in _claim(session_factory, run_id, 'next', t0, limit=5)] == taken[2:]
+
+
+def test_drain_pass_sends_expired_leases_and_skips_live_ones():
+    create_tables()
+    run_id = _add_run(SessionLocal, 'drain-after-crash', 12, first_telegram_id=9_100_000)
+    now = datetime.utcnow()
+    with SessionLocal() as db:
+        # Упавший процесс оставил аренду, которая уже истекла, живой - действующую
+        alive = claim_outbox_batch(db, run_id, 'alive', now, now, now + LEASE, 3)
+        expired = claim_outbox_batch(db, run_id, 'crashed', now, now, now - timedelta(seconds=1), 5)
+    sent = []
+
+    async def send(chat_id):
+        sent.append(chat_id)
+
+    asyncio.run(outbox._drain_pass(run_id, send, "тест аренды", None))
+
+    alive_chats = {row.telegram_id for row in alive}
+    assert len(sent) == len(set(sent)) == 9
+    assert {row.telegram_id for row in expired} <= set(sent)
+    assert not alive_chats & set(sent)
+    with SessionLocal() as db:
+        statuses = dict(db.execute(
+            select(OutboxMessage.telegram_id, OutboxMessage.status).where(OutboxMessage.run_id == run_id)
+        ).all())
+    assert all(statuses[chat_id] == 'sent' for chat_id in sent)
+    assert all(statuses[chat_id] == 'pending' for chat_id in alive_chats)
@@ -0,0 +1,59 @@
+"""
+Бюджет SQL-запросов горячих обработчиков (query_counter.HANDLER_QUERY_BUDGETS).
+
+Сценарий benchmarks/query_budget.py прогоняется через настоящее приложение
+с поддельным Bot API: первый проход прогревает кэши и агрегаты, второй идет
+с QUERY_BUDGET_MODE=raise, и любое превышение бюджета - ошибка теста.
+"""
+
+import asyncio
+
+import pytest
+
+import query_counter
+from benchmarks.fake_telegram import FakeTelegramRequest
+from benchmarks.query_budget import BENCH_TOKEN, _pass
+
+
+@pytest.fixture(scope='module')
+def results():
+    from admin_handlers import ADMIN_IDS
+    from database import create_tables, engine
+    from main import SpinaBot
+    from metrics import instrument_engine
+
+    instrument_engine(engine)
+    create_tables()
+
+    async def run():
+        application = SpinaBot(token=BENCH_TOKEN, request=FakeTelegramRequest()).application
+        await application.initialize()
+        mode = query_counter.QUERY_BUDGET_MODE
+        try:
+            query_counter.QUERY_BUDGET_MODE = 'off'
+            await _pass(application, ADMIN_IDS[0])
+            query_counter.QUERY_BUDGET_MODE = 'raise'
+            return await _pass(application, ADMIN_IDS[0])
+        finally:
+            query_counter.QUERY_BUDGET_MODE = mode
+            await application.shutdown()
+
+    return asyncio.run(run())
+
+
+def test_no_handler_exceeds_budget(results):
+    exceeded = [f"{label}: {count} > {budget}" for label, count, _, budget, error in results if error is not None]
+    assert exceeded == []
+
+
+@pytest.mark.parametrize('label', sorted(query_counter.HANDLER_QUERY_BUDGETS))
+def test_handler_query_count(results, label):
+    counts = [count for handler, count, _, _, _ in results if handler == label]
+    assert counts, f"сценарий не проходит через {label}"
+    assert max(counts) <= query_counter.HANDLER_QUERY_BUDGETS[label]
+
+
+def test_hot_paths_use_queries(results):
+    # Нулевой счет значил бы, что учет запросов не подключен, а не что бюджет соблюден
+    counts = {label: count for label, count, _, _, _ in results}
+    assert counts['pain'] > 0 and counts['/stats'] > 0 and counts['view_stats'] > 0
@@ -0,0 +1,99 @@
+"""
+Миграции на временной базе SQLite и планы горячих запросов (EXPLAIN QUERY PLAN).
+
+База создается так, как ее видит уже работающий бот: таблицы есть, а индексов,
+которые добавляют миграции, еще нет.
+"""
+
+import logging
+
+import pytest
+from sqlalchemy import create_engine, insert, select, text
+from sqlalchemy.exc import IntegrityError
+
+from database import Base, VideoLesson
+from migrations import MIGRATIONS, _hot_queries, check_query_plans, run_migrations
+
+# Индексы, которые создаются миграциями, а не только create_tables()
+MIGRATED_INDEXES = [
+    'ix_user_responses_user_date',
+    'ix_users_active_id',
+    'ux_video_lessons_pain_level',
+    'ix_users_reminder_bucket',
+    'ux_broadcast_runs_active_campaign',
+    'ix_users_username_lower_id',
+    'ix_users_active_rating_date_id',
+    'ix_users_last_pain_rating_id',
+]
+
+
+@pytest.fixture
+def legacy_engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'spina_bot.db'}")
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        for name in MIGRATED_INDEXES:
+            conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+    yield engine
+    engine.dispose()
+
+
+def _plan(engine, query):
+    compiled = query.compile(engine, compile_kwargs={"literal_binds": True})
+    with engine.connect() as conn:
+        return " | ".join(row[-1] for row in conn.execute(text(f"EXPLAIN QUERY PLAN {compiled}")))
+
+
+def _lesson(pain_level, file_id):
+    return {'pain_level': pain_level, 'file_id': file_id, 'created_by_admin': 1}
+
+
+def test_migrations_are_recorded(legacy_engine):
+    run_migrations(legacy_engine)
+    run_migrations(legacy_engine)  # повторный запуск ничего не применяет
+    with legacy_engine.connect() as conn:
+        versions = conn.execute(text("SELECT version FROM schema_migrations ORDER BY version")).scalars().all()
+    assert versions == [version for version, _, _ in MIGRATIONS]
+
+
+HOT_QUERIES = _hot_queries()
+
+
+@pytest.mark.parametrize('description, query, index_name', HOT_QUERIES,
+                         ids=[description for description, _, _ in HOT_QUERIES])
+def test_hot_query_uses_index(legacy_engine, description, query, index_name):
+    run_migrations(legacy_engine)
+    assert index_name in _plan(legacy_engine, query), description
+
+
+def test_check_query_plans(legacy_engine):
+    # Без индексов миграций проверка находит проблемы, после миграций - нет
+    assert check_query_plans(legacy_engine)
+    run_migrations(legacy_engine)
+    assert check_query_plans(legacy_engine) == []
+
+
+def test_unique_pain_level_index(legacy_engine):
+    run_migrations(legacy_engine)
+    with legacy_engine.begin() as conn:
+        conn.execute(insert(VideoLesson), [_lesson(1, 'a')])
+    with pytest.raises(IntegrityError):
+        with legacy_engine.begin() as conn:
+            conn.execute(insert(VideoLesson), [_lesson(1, 'b')])
+
+
+def test_duplicate_lessons_are_logged(legacy_engine, caplog):
+    with legacy_engine.begin() as conn:
+        conn.execute(insert(VideoLesson), [_lesson(2, 'old'), _lesson(2, 'new'), _lesson(3, 'only')])
+
+    with caplog.at_level(logging.WARNING, logger='migrations'):
+        run_migrations(legacy_engine)
+
+    with legacy_engine.connect() as conn:
+        remaining = conn.execute(
+            select(VideoLesson.pain_level, VideoLesson.file_id).order_by(VideoLesson.pain_level)
+        ).all()
+    assert remaining == [(2, 'new'), (3, 'only')]
+    messages = [record.getMessage() for record in caplog.records]
+    assert len(messages) == 1
+    assert 'id=1' in messages[0] and 'уровня боли 2' in messages[0] and 'file_id=old' in messages[0]
@@ -0,0 +1,75 @@
+"""
+Очереди апдейтов по чатам (update_processor.py): порядок внутри чата и
+независимость чатов друг от друга при ограниченном числе мест.
+"""
+
+import asyncio
+import time
+from types import SimpleNamespace
+
+from update_processor import PerChatUpdateProcessor
+
+HANDLER_SECONDS = 0.05
+
+
+def _update(update_id, chat_id):
+    return SimpleNamespace(update_id=update_id, effective_chat=SimpleNamespace(id=chat_id), effective_user=None)
+
+
+async def _handle(log, update):
+    await asyncio.sleep(HANDLER_SECONDS)
+    log.append((update.effective_chat.id, update.update_id, time.monotonic()))
+
+
+def _feed(processor, updates, log):
+    return [
+        asyncio.create_task(processor.process_update(update, _handle(log, update)))
+        for update in updates
+    ]
+
+
+def test_chat_backlog_does_not_delay_other_chats():
+    async def scenario():
+        processor = PerChatUpdateProcessor(max_concurrent_updates=8)
+        log = []
+        started = time.monotonic()
+        backlog = _feed(processor, [_update(i, 1) for i in range(20)], log)
+        await asyncio.sleep(0)
+        other = _feed(processor, [_update(100, 2)], log)
+        await asyncio.gather(*backlog, *other)
+        finished = {update_id: at - started for _, update_id, at in log}
+        return finished, processor
+
+    finished, processor = asyncio.run(scenario())
+    # Без разделения очереди чата и мест апдейт чата 2 ждал бы почти всю очередь чата 1
+    assert finished[100] < HANDLER_SECONDS * 4
+    assert processor.pending == 0 and processor.active_chats == 0
+
+
+def test_updates_of_one_chat_run_in_order():
+    async def scenario():
+        processor = PerChatUpdateProcessor(max_concurrent_updates=8)
+        log = []
+        await asyncio.gather(*_feed(processor, [_update(i, 1) for i in range(10)], log))
+        return log
+
+    log = asyncio.run(scenario())
+    assert [update_id for _, update_id, _ in log] == list(range(10))
+
+
+def test_concurrency_limit_across_chats():
+    async def scenario():
+        processor = PerChatUpdateProcessor(max_concurrent_updates=2)
+        running = peak = 0
+
+        async def handle():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        await asyncio.gather(*(processor.process_update(_update(i, i), handle()) for i in range(6)))
+        return peak
+
+    assert asyncio.run(scenario()) == 2
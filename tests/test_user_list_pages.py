@@ -0,0 +1,129 @@
+"""
+Keyset-пагинация списка пользователей администратора: обход всех фильтров
+вперед и назад по страницам при большом числе совпадений ключа сортировки
+(одинаковые оценки, даты и username) - без повторов и пропусков.
+"""
+
+import random
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+
+from admin_handlers import USER_LIST_FILTERS, USER_LIST_PAGE_SIZE, USER_LIST_RATING_BANDS, _fetch_user_page
+from database import AUDIENCE_RECENT_DAYS, Base, User
+
+USERS = 137
+SEARCH = 'ann'
+
+
+def _make_users(now):
+    # Несколько значений каждого ключа на всех: страницы режут группы одинаковых ключей
+    dates = [None, now - timedelta(days=1), now - timedelta(days=3), now - timedelta(days=5),
+             now - timedelta(days=10)]
+    usernames = [None, 'anna', 'Anna', 'ANN_', 'annet', 'bob', 'an']
+    users = [
+        {
+            'telegram_id': 1000 + i,
+            'username': usernames[i % len(usernames)],
+            'first_name': f"user{i}",
+            'is_active': i % 4 != 0,
+            'last_pain_rating': None if i % 6 == 0 else i % 6,
+            'last_rating_date': dates[i % len(dates)],
+        }
+        for i in range(USERS)
+    ]
+    # Порядок вставки (id) не совпадает с порядком ключей
+    random.Random(7).shuffle(users)
+    return users
+
+
+def _expected(users, user_filter, search=None):
+    """Ожидаемый порядок списка: id строк, отобранных и отсортированных без SQL"""
+    since = datetime.utcnow() - timedelta(days=AUDIENCE_RECENT_DAYS)
+    if search:
+        rows = [u for u in users if u['username'] and u['username'].lower().startswith(search)]
+        return [u['id'] for u in sorted(rows, key=lambda u: (u['username'].lower(), u['id']))]
+    if user_filter == 'recent':
+        rows = [u for u in users if u['is_active'] and u['last_rating_date'] and u['last_rating_date'] >= since]
+        return [u['id'] for u in sorted(rows, key=lambda u: (u['last_rating_date'], u['id']))]
+    if user_filter in USER_LIST_RATING_BANDS:
+        low, high = USER_LIST_RATING_BANDS[user_filter]
+        rows = [u for u in users if u['last_pain_rating'] is not None and low <= u['last_pain_rating'] < high]
+        return [u['id'] for u in sorted(rows, key=lambda u: (u['last_pain_rating'], u['id']))]
+    conditions = {
+        'all': lambda u: True,
+        'active': lambda u: u['is_active'],
+        'stopped': lambda u: not u['is_active'],
+        'silent': lambda u: u['is_active'] and (u['last_rating_date'] is None or u['last_rating_date'] < since),
+    }
+    return [u['id'] for u in users if conditions[user_filter](u)]
+
+
+@pytest.fixture(scope='module')
+def user_list(tmp_path_factory):
+    engine = create_engine(f"sqlite:///{tmp_path_factory.mktemp('user_list') / 'spina_bot.db'}")
+    Base.metadata.create_all(engine)
+    users = _make_users(datetime.utcnow())
+    with engine.begin() as conn:
+        conn.execute(insert(User), users)
+    for user_id, user in enumerate(users, start=1):
+        user['id'] = user_id
+    session = sessionmaker(bind=engine)()
+    yield session, users
+    session.close()
+    engine.dispose()
+
+
+def _walk(db, user_filter, search):
+    """Пройти список вперед до конца, затем назад до начала; страницы - списки id"""
+    rows, has_prev, has_next = _fetch_user_page(db, user_filter, search)
+    assert not has_prev
+    forward = [[row.id for row in rows]]
+    while has_next:
+        rows, has_prev, has_next = _fetch_user_page(db, user_filter, search, after=forward[-1][-1])
+        assert has_prev
+        forward.append([row.id for row in rows])
+
+    backward = [forward[-1]]
+    has_prev = len(forward) > 1
+    while has_prev:
+        rows, has_prev, has_next = _fetch_user_page(db, user_filter, search, before=backward[0][0])
+        assert has_next
+        backward.insert(0, [row.id for row in rows])
+    return forward, backward
+
+
+@pytest.mark.parametrize('user_filter, search', [
+    *[(name, None) for name in USER_LIST_FILTERS],
+    ('found', SEARCH),
+])
+def test_pages_cover_list_without_duplicates_or_gaps(user_list, user_filter, search):
+    db, users = user_list
+    expected = _expected(users, user_filter, search)
+    # Список длиннее нескольких страниц, иначе обход ничего не проверяет
+    assert len(expected) > 2 * USER_LIST_PAGE_SIZE
+
+    forward, backward = _walk(db, user_filter, search)
+
+    assert [user_id for page in forward for user_id in page] == expected
+    assert all(len(page) == USER_LIST_PAGE_SIZE for page in forward[:-1])
+    assert backward == forward
+
+
+def test_page_after_cursor_inside_group_of_equal_keys(user_list):
+    db, users = user_list
+    expected = _expected(users, 'low')
+    ratings = {u['id']: u['last_pain_rating'] for u in users}
+    # Курсор в середине группы одинаковых оценок: следующая страница начинается сразу за ним
+    cursor = next(
+        i for i in range(1, len(expected) - 1)
+        if ratings[expected[i - 1]] == ratings[expected[i]] == ratings[expected[i + 1]]
+    )
+    rows, has_prev, _ = _fetch_user_page(db, 'low', after=expected[cursor])
+    assert has_prev
+    assert [row.id for row in rows] == expected[cursor + 1:cursor + 1 + USER_LIST_PAGE_SIZE]
+    rows, _, has_next = _fetch_user_page(db, 'low', before=expected[cursor + USER_LIST_PAGE_SIZE])
+    assert has_next
+    assert [row.id for row in rows] == expected[cursor:cursor + USER_LIST_PAGE_SIZE]
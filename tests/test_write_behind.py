@@ -0,0 +1,88 @@
+"""
+Буфер отложенной записи оценок при сбоях базы: ограничение размера,
+запись по одной после неудачных сбросов и учет отброшенных оценок.
+"""
+
+import asyncio
+
+import pytest
+
+import metrics
+import write_behind
+from write_behind import RatingWriteBuffer
+
+
+class FlakyDatabase:
+    """Подмена save_pain_ratings: падает целиком или на оценках отдельных пользователей"""
+
+    def __init__(self):
+        self.down = False
+        self.bad_users = set()
+        self.saved = []
+
+    def __call__(self, db, ratings):
+        if self.down or any(telegram_id in self.bad_users for telegram_id, _, _ in ratings):
+            raise RuntimeError("database is locked")
+        self.saved.extend((telegram_id, pain_level) for telegram_id, pain_level, _ in ratings)
+
+
+@pytest.fixture
+def database(monkeypatch):
+    fake = FlakyDatabase()
+    monkeypatch.setattr(write_behind, 'save_pain_ratings', fake)
+    return fake
+
+
+def _dropped(reason):
+    return metrics.RATINGS_DROPPED._values.get((reason,), 0)
+
+
+def test_buffer_is_capped_while_database_is_down(database):
+    buffer = RatingWriteBuffer(enabled=True, max_rows=100, max_buffered_rows=3)
+    database.down = True
+    before = _dropped('overflow')
+
+    for telegram_id in range(1, 6):
+        buffer.add(telegram_id, 3)
+    asyncio.run(buffer.flush())
+
+    assert [row[0] for row in buffer._pending] == [3, 4, 5]
+    assert not buffer.has_pending(1) and buffer.has_pending(5)
+    assert _dropped('overflow') - before == 2
+
+
+def test_expired_ratings_are_dropped(database):
+    buffer = RatingWriteBuffer(enabled=True, max_age=0)
+    database.down = True
+    before = _dropped('expired')
+
+    buffer.add(1, 2)
+    asyncio.run(buffer.flush())
+
+    assert buffer._pending == [] and not buffer.has_pending(1)
+    assert _dropped('expired') - before == 1
+
+
+def test_per_row_fallback_after_failed_flushes(database):
+    buffer = RatingWriteBuffer(enabled=True, max_failed_flushes=2)
+    database.down = True
+    before = _dropped('rejected')
+
+    async def scenario():
+        for telegram_id in (1, 2, 3):
+            buffer.add(telegram_id, 4)
+        await buffer.flush()
+        assert not buffer.degraded
+        await buffer.flush()
+        assert buffer.degraded
+
+        # База снова доступна, но оценку пользователя 2 записать нельзя
+        database.down = False
+        database.bad_users = {2}
+        await buffer.write_through(3, 5)
+
+    asyncio.run(scenario())
+
+    assert database.saved == [(1, 4), (3, 4), (3, 5)]
+    assert buffer._pending == [] and not buffer.degraded
+    assert _dropped('rejected') - before == 1
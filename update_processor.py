@@ -0,0 +1,98 @@
+"""
+Параллельная обработка апдейтов с сохранением порядка внутри чата.
+
+Апдейты разных пользователей обрабатываются одновременно (до
+UPDATE_CONCURRENCY штук), поэтому медленная отправка видео или запись в базу
+одного пользователя не задерживает остальных. Апдейты одного чата
+выполняются строго по очереди поступления: последовательность /start ->
+оценка -> /stats не перемешивается, а ConversationHandler загрузки видео
+видит шаги диалога в правильном порядке.
+
+Место среди UPDATE_CONCURRENCY апдейт занимает, только дождавшись своей
+очереди в чате: очередь одного чата не занимает места, нужные другим.
+
+Фильтр admit (flood_guard.py) решает, обрабатывать ли апдейт, сразу при
+поступлении, до очереди чата и места: отброшенный апдейт ничего не ждет.
+"""
+
+import asyncio
+import os
+
+from telegram.ext import BaseUpdateProcessor
+
+# Сколько апдейтов обрабатывается одновременно; 1 - строго последовательно.
+# Апдейты, ждущие своей очереди в чате, места не занимают
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '64'))
+
+
+def update_key(update):
+    """Ключ очереди апдейта: чат, а если его нет (inline-запросы) - пользователь"""
+    chat = getattr(update, 'effective_chat', None)
+    if chat is not None:
+        return chat.id
+    user = getattr(update, 'effective_user', None)
+    if user is not None:
+        return user.id
+    return None
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Апдейты разных чатов - параллельно, одного чата - по очереди"""
+
+    def __init__(self, max_concurrent_updates: int = UPDATE_CONCURRENCY, admit=None):
+        """admit - необязательный фильтр admit(update, processor) -> bool,
+        False - апдейт отбрасывается, не дожидаясь очереди"""
+        super().__init__(max_concurrent_updates)
+        self.admit = admit
+        self._queues = {}  # ключ -> [Lock, число апдейтов чата в обработке или ожидании]
+        self.pending = 0   # апдейтов в обработке и в ожидании, включая ждущих места (flood_guard.py)
+
+    @property
+    def active_chats(self) -> int:
+        return len(self._queues)
+
+    async def process_update(self, update, coroutine):
+        """Проверить апдейт фильтром admit, дождаться очереди в чате, затем
+        свободного места, и обработать апдейт.
+
+        Заменяет BaseUpdateProcessor.process_update, который берет место
+        (семафор) до do_process_update: иначе апдейты, ждущие своей очереди
+        в одном чате, держали бы места и задерживали все остальные чаты.
+        """
+        if self.admit is not None and not self.admit(update, self):
+            # Обработка апдейта еще не началась: закрываем корутину без запуска
+            coroutine.close()
+            return
+
+        self.pending += 1
+        try:
+            key = update_key(update)
+            if key is None:
+                async with self._semaphore:
+                    await self.do_process_update(update, coroutine)
+                return
+
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self._queues[key] = [asyncio.Lock(), 0]
+            queue[1] += 1
+            try:
+                # asyncio.Lock пропускает ожидающих в порядке очереди
+                async with queue[0]:
+                    async with self._semaphore:
+                        await self.do_process_update(update, coroutine)
+            finally:
+                queue[1] -= 1
+                if not queue[1]:
+                    del self._queues[key]
+        finally:
+            self.pending -= 1
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -1,38 +1,53 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
-from database import SessionLocal, User, UserResponse, VideoLesson
-from datetime import datetime
+from telegram.helpers import escape_markdown
+from database import (
+    User, UserResponse, UserStats, rebuild_user_stats, run_db, settings_cache, lesson_cache, save_pain_rating,
+    set_user_reminder_time, reset_user_reminder_time,
+    refresh_reminder_buckets, nonempty_reminder_buckets
+)
+from broadcast import WindowPacer
+from outbox import register_sender, start_run
+from load_monitor import load_monitor
+from write_behind import rating_buffer
+import metrics
+from datetime import datetime, timedelta
+from functools import lru_cache
+from sqlalchemy import func
+from zoneinfo import available_timezones
 import logging
+import re
+import time
 
 logger = logging.getLogger(__name__)
 
+def _register_user(db, user):
+    """Регистрация нового пользователя или обновление данных существующего"""
+    existing_user = db.query(User).filter(User.telegram_id == user.id).first()
+    if not existing_user:
+        new_user = User(
+            telegram_id=user.id,
+            username=user.username,
+            first_name=user.first_name,
+            last_name=user.last_name
+        )
+        db.add(new_user)
+        db.commit()
+        logger.info(f"Новый пользователь зарегистрирован: {user.id}")
+    else:
+        # Обновляем информацию о пользователе
+        existing_user.username = user.username
+        existing_user.first_name = user.first_name
+        existing_user.last_name = user.last_name
+        existing_user.is_active = True
+        db.commit()
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     user = update.effective_user
     
     # Регистрируем пользователя в базе данных
-    db = SessionLocal()
-    try:
-        existing_user = db.query(User).filter(User.telegram_id == user.id).first()
-        if not existing_user:
-            new_user = User(
-                telegram_id=user.id,
-                username=user.username,
-                first_name=user.first_name,
-                last_name=user.last_name
-            )
-            db.add(new_user)
-            db.commit()
-            logger.info(f"Новый пользователь зарегистрирован: {user.id}")
-        else:
-            # Обновляем информацию о пользователе
-            existing_user.username = user.username
-            existing_user.first_name = user.first_name
-            existing_user.last_name = user.last_name
-            existing_user.is_active = True
-            db.commit()
-    finally:
-        db.close()
+    await run_db(_register_user, user)
     
     welcome_text = (
         f"Привет, {user.first_name}! 👋\n\n"
@@ -71,6 +86,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/stop - Отключить ежедневные напоминания\n"
         "/resume - Включить ежедневные напоминания\n"
         "/status - Проверить статус напоминаний\n"
+        "/timezone - Указать свой часовой пояс\n"
+        "/time - Выбрать время напоминаний\n"
         "/help - Эта справка\n\n"
         "💡 *Как пользоваться ботом:*\n"
         "• Каждый день я буду спрашивать о состоянии вашей спины\n"
@@ -109,46 +126,25 @@ async def handle_pain_rating(update: Update, context: ContextTypes.DEFAULT_TYPE)
     # Извлекаем уровень боли из callback_data
     pain_level = int(query.data.split('_')[1])
     user_id = query.from_user.id
+    load_monitor.record_callback()
     
-    # Сохраняем ответ в базу данных
-    db = SessionLocal()
     try:
-        # Добавляем запись об ответе
-        response = UserResponse(
-            user_id=user_id,
-            pain_rating=pain_level
-        )
-        db.add(response)
-        
-        # Обновляем информацию о пользователе
-        user = db.query(User).filter(User.telegram_id == user_id).first()
-        if user:
-            user.last_pain_rating = pain_level
-            user.last_rating_date = datetime.utcnow()
-        
-        db.commit()
+        # Сохраняем ответ в базу данных (сразу или через буфер отложенной записи)
+        if rating_buffer.enabled and rating_buffer.degraded:
+            # База не принимает пачки: ждем записи, а не копим оценки в памяти
+            await rating_buffer.write_through(user_id, pain_level)
+        elif rating_buffer.enabled:
+            rating_buffer.add(user_id, pain_level)
+        else:
+            started = time.monotonic()
+            await run_db(save_pain_rating, user_id, pain_level)
+            load_monitor.record_db_write(time.monotonic() - started)
         
-        # Получаем соответствующий видео-урок
-        video_lesson = db.query(VideoLesson).filter(VideoLesson.pain_level == pain_level).first()
+        # Получаем соответствующий видео-урок из кэша
+        video_lesson = await lesson_cache.get(pain_level)
         
         if video_lesson:
-            # Формируем описание видео
-            video_info = f"Спасибо за оценку! Уровень боли: {pain_level}\n\n"
-            
-            if video_lesson.title:
-                video_info += f"🎥 *{video_lesson.title}*\n\n"
-                
-            if video_lesson.description:
-                video_info += f"{video_lesson.description}\n\n"
-                
-            if video_lesson.duration:
-                minutes = video_lesson.duration // 60
-                seconds = video_lesson.duration % 60
-                video_info += f"⏱ Длительность: {minutes}:{seconds:02d}\n\n"
-            
-            video_info += "Вот персональный видео-урок для вас:"
-            
-            await query.edit_message_text(video_info, parse_mode='Markdown')
+            await query.edit_message_text(video_lesson.caption, parse_mode='Markdown')
             
             # Отправляем видео-урок
             await context.bot.send_video(
@@ -168,243 +164,397 @@ async def handle_pain_rating(update: Update, context: ContextTypes.DEFAULT_TYPE)
     except Exception as e:
         logger.error(f"Ошибка при обработке оценки боли: {e}")
         await query.edit_message_text("Произошла ошибка. Попробуйте позже.")
-    finally:
-        db.close()
+
+def _load_user_stats(db, user_id):
+    """Дата регистрации, агрегаты ответов и статистика за последние 7 дней"""
+    created_at = db.query(User.created_at).filter(User.telegram_id == user_id).scalar()
+    if created_at is None:
+        return None, None, None
+    
+    stats = db.get(UserStats, user_id)
+    if stats is None:
+        # Ответы, сохраненные до появления user_stats, учитываем один раз
+        stats = rebuild_user_stats(db, user_id)
+        if stats is None:
+            return created_at, None, None
+        db.commit()
+        db.refresh(stats)
+    
+    # Последние 7 дней - ограниченный запрос по (user_id, response_date)
+    seven_days_ago = datetime.utcnow() - timedelta(days=7)
+    recent = db.query(func.count(UserResponse.id), func.avg(UserResponse.pain_rating)).filter(
+        UserResponse.user_id == user_id,
+        UserResponse.response_date >= seven_days_ago
+    ).one()
+    return created_at, stats, recent
 
 async def user_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать статистику пользователя"""
     user_id = update.effective_user.id
     
-    db = SessionLocal()
-    try:
-        # Получаем данные пользователя
-        user = db.query(User).filter(User.telegram_id == user_id).first()
-        if not user:
-            await update.message.reply_text("Вы не зарегистрированы. Нажмите /start")
-            return
-        
-        # Получаем статистику ответов
-        responses = db.query(UserResponse).filter(UserResponse.user_id == user_id).all()
-        
-        if not responses:
-            await update.message.reply_text(
-                "📊 *Ваша статистика*\n\n"
-                "У вас пока нет записей о состоянии спины.\n"
-                "Нажмите /rate для первой оценки!",
-                parse_mode='Markdown'
-            )
-            return
-        
-        # Анализируем данные
-        total_responses = len(responses)
-        avg_pain = sum(r.pain_rating for r in responses) / total_responses
-        last_response = max(responses, key=lambda x: x.response_date)
-        
-        # Статистика по уровням боли
-        pain_counts = {1: 0, 2: 0, 3: 0, 4: 0, 5: 0}
-        for response in responses:
-            pain_counts[response.pain_rating] += 1
-        
-        # Последние 7 дней
-        from datetime import timedelta
-        seven_days_ago = datetime.utcnow() - timedelta(days=7)
-        recent_responses = [r for r in responses if r.response_date >= seven_days_ago]
-        
-        text = (
-            f"📊 *Ваша статистика*\n\n"
-            f"📅 Дата регистрации: {user.created_at.strftime('%d.%m.%Y')}\n"
-            f"💬 Всего оценок: {total_responses}\n"
-            f"📈 Средний уровень боли: {avg_pain:.1f}\n"
-            f"🕐 Последняя оценка: {last_response.response_date.strftime('%d.%m.%Y %H:%M')}\n"
-            f"🎯 Последний уровень: {last_response.pain_rating}\n\n"
-            f"📋 *Распределение по уровням:*\n"
+    # Оценки пользователя из буфера отложенной записи должны попасть в статистику
+    if rating_buffer.has_pending(user_id):
+        await rating_buffer.flush()
+    
+    # Получаем данные пользователя и статистику ответов
+    created_at, stats, recent = await run_db(_load_user_stats, user_id)
+    if created_at is None:
+        await update.message.reply_text("Вы не зарегистрированы. Нажмите /start")
+        return
+    
+    if stats is None:
+        await update.message.reply_text(
+            "📊 *Ваша статистика*\n\n"
+            "У вас пока нет записей о состоянии спины.\n"
+            "Нажмите /rate для первой оценки!",
+            parse_mode='Markdown'
         )
-        
-        for level, count in pain_counts.items():
-            percentage = (count / total_responses) * 100 if total_responses > 0 else 0
-            text += f"Уровень {level}: {count} раз ({percentage:.1f}%)\n"
-        
-        if recent_responses:
-            avg_recent = sum(r.pain_rating for r in recent_responses) / len(recent_responses)
-            text += f"\n📅 *За последние 7 дней:*\n"
-            text += f"Оценок: {len(recent_responses)}\n"
-            text += f"Средний уровень: {avg_recent:.1f}"
-        
-        await update.message.reply_text(text, parse_mode='Markdown')
-        
-    finally:
-        db.close()
+        return
+    
+    # Анализируем данные
+    total_responses = stats.total_count
+    avg_pain = stats.rating_sum / total_responses
+    
+    text = (
+        f"📊 *Ваша статистика*\n\n"
+        f"📅 Дата регистрации: {created_at.strftime('%d.%m.%Y')}\n"
+        f"💬 Всего оценок: {total_responses}\n"
+        f"📈 Средний уровень боли: {avg_pain:.1f}\n"
+        f"🕐 Последняя оценка: {stats.last_response_date.strftime('%d.%m.%Y %H:%M')}\n"
+        f"🎯 Последний уровень: {stats.last_rating}\n\n"
+        f"📋 *Распределение по уровням:*\n"
+    )
+    
+    # Статистика по уровням боли
+    for level, count in stats.level_counts().items():
+        percentage = (count / total_responses) * 100 if total_responses > 0 else 0
+        text += f"Уровень {level}: {count} раз ({percentage:.1f}%)\n"
+    
+    recent_count, avg_recent = recent
+    if recent_count:
+        text += f"\n📅 *За последние 7 дней:*\n"
+        text += f"Оценок: {recent_count}\n"
+        text += f"Средний уровень: {avg_recent:.1f}"
+    
+    await update.message.reply_text(text, parse_mode='Markdown')
 
 async def send_daily_reminder(context: ContextTypes.DEFAULT_TYPE):
-    """Отправка ежедневного напоминания всем активным пользователям"""
-    db = SessionLocal()
-    try:
-        active_users = db.query(User).filter(User.is_active == True).all()
-        
-        keyboard = [
-            [InlineKeyboardButton("1️⃣", callback_data="pain_1"),
-             InlineKeyboardButton("2️⃣", callback_data="pain_2"),
-             InlineKeyboardButton("3️⃣", callback_data="pain_3")],
-            [InlineKeyboardButton("4️⃣", callback_data="pain_4"),
-             InlineKeyboardButton("5️⃣", callback_data="pain_5")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        reminder_text = (
-            "🌅 *Доброе утро!*\n\n"
-            "Время проверить состояние вашей спины.\n"
-            "Как вы себя чувствуете сегодня?\n\n"
-            "Оцените уровень боли от 1 до 5:"
+    """Отправка ежедневного напоминания активным пользователям без персонального времени.
+
+    Возвращает задачу доставки (см. outbox.start_run): планировщик ее не ждет.
+    """
+    window_minutes = settings_cache.get().window_minutes
+    
+    def window_pacer(total):
+        # Растягиваем рассылку на окно, чтобы волна ответов не пришла разом
+        logger.info(f"Рассылка {total} напоминаний растянута на {window_minutes} мин")
+        return WindowPacer(total, window_minutes * 60, monitor=load_monitor)
+    
+    # Один запуск в день: повторный вызов в тот же день продолжит его, а не начнет заново
+    run_key = f"reminder:{datetime.utcnow().date().isoformat()}"
+    return await start_run(
+        context.application, run_key, 'reminder', "рассылка напоминаний",
+        pacer_factory=window_pacer if window_minutes else None
+    )
+
+# Сколько минутных корзин (включая текущую) догоняет задача за один запуск,
+# например после паузы цикла или перезапуска; более старые уже неактуальны
+MAX_MISSED_BUCKETS = 10
+
+async def send_scheduled_reminders(context: ContextTypes.DEFAULT_TYPE):
+    """Ежеминутная задача: напоминания пользователям, чье время наступило в эту минуту (UTC)"""
+    now = datetime.utcnow().replace(second=0, microsecond=0)
+    last_run = context.job.data.get('last_run')
+    context.job.data['last_run'] = now
+    
+    # Корзины после последнего запуска по текущую минуту включительно;
+    # задача могла пропустить запуски, пока шла предыдущая рассылка
+    missed = 1 if last_run is None else int((now - last_run).total_seconds() // 60)
+    due = [now - timedelta(minutes=step) for step in reversed(range(min(missed, MAX_MISSED_BUCKETS)))]
+    
+    if not due or not settings_cache.get().enabled:
+        return
+    
+    skipped = missed - len(due)
+    if skipped > 0:
+        first_skipped = last_run + timedelta(minutes=1)
+        logger.warning(
+            f"Пропущено {skipped} минутных корзин напоминаний "
+            f"({first_skipped:%Y-%m-%d %H:%M} - {due[0] - timedelta(minutes=1):%H:%M} UTC): "
+            f"догоняются только последние {MAX_MISSED_BUCKETS}"
         )
-        
-        sent_count = 0
-        for user in active_users:
-            try:
-                await context.bot.send_message(
-                    chat_id=user.telegram_id,
-                    text=reminder_text,
-                    reply_markup=reply_markup,
-                    parse_mode='Markdown'
-                )
-                sent_count += 1
-            except Exception as e:
-                logger.error(f"Ошибка отправки напоминания пользователю {user.telegram_id}: {e}")
-                # Деактивируем пользователя если бот заблокирован
-                if "blocked" in str(e).lower() or "user not found" in str(e).lower():
-                    user.is_active = False
-        
-        db.commit()
-        logger.info(f"Отправлено {sent_count} напоминаний из {len(active_users)} пользователей")
-        
-    finally:
-        db.close()
+        metrics.reminder_buckets_skipped(skipped)
+    
+    nonempty = await run_db(nonempty_reminder_buckets, [bucket_at.hour * 60 + bucket_at.minute for bucket_at in due])
+    for bucket_at in due:
+        bucket = bucket_at.hour * 60 + bucket_at.minute
+        if bucket not in nonempty:
+            continue
+        # Дата - по самой корзине: корзина 23:59, догоняемая после полуночи, относится к прошлому дню
+        await start_run(
+            context.application, f"reminder:{bucket_at.date().isoformat()}:{bucket:04d}", 'reminder',
+            f"рассылка напоминаний {bucket // 60:02d}:{bucket % 60:02d} UTC", utc_minute=bucket
+        )
+
+async def refresh_reminder_schedule(context: ContextTypes.DEFAULT_TYPE):
+    """Периодический пересчет минутных корзин при переходе на летнее/зимнее время"""
+    moved = await run_db(refresh_reminder_buckets)
+    if moved:
+        logger.info(f"Время напоминаний пересчитано для {moved} пользователей после смены смещения часового пояса")
+
+def _reminder_sender(bot, payload=None):
+    """Отправка ежедневного напоминания одному пользователю (для outbox)"""
+    keyboard = [
+        [InlineKeyboardButton("1️⃣", callback_data="pain_1"),
+         InlineKeyboardButton("2️⃣", callback_data="pain_2"),
+         InlineKeyboardButton("3️⃣", callback_data="pain_3")],
+        [InlineKeyboardButton("4️⃣", callback_data="pain_4"),
+         InlineKeyboardButton("5️⃣", callback_data="pain_5")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    reminder_text = (
+        "🌅 *Доброе утро!*\n\n"
+        "Время проверить состояние вашей спины.\n"
+        "Как вы себя чувствуете сегодня?\n\n"
+        "Оцените уровень боли от 1 до 5:"
+    )
+    
+    async def send(chat_id):
+        await bot.send_message(
+            chat_id=chat_id,
+            text=reminder_text,
+            reply_markup=reply_markup,
+            parse_mode='Markdown'
+        )
+    
+    return send
+
+register_sender('reminder', _reminder_sender)
+
+def _set_user_active(db, user_id, is_active):
+    """Включение/отключение напоминаний.
+
+    Возвращает (часовой пояс, местная минута напоминания) пользователя
+    или None, если пользователь не найден.
+    """
+    user = db.query(User).filter(User.telegram_id == user_id).first()
+    if not user:
+        return None
+    reminder_time = (user.timezone, user.reminder_minute)
+    user.is_active = is_active
+    db.commit()
+    return reminder_time
+
+def _format_reminder_time(timezone, local_minute, settings) -> str:
+    """Время напоминания пользователя для сообщений (Markdown)"""
+    if local_minute is None:
+        return f"{settings.hour}:{settings.minute:0>2}"
+    return f"{local_minute // 60}:{local_minute % 60:0>2} ({escape_markdown(timezone)})"
 
 async def stop_reminders(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Отключение ежедневных напоминаний для пользователя"""
     user_id = update.effective_user.id
     
-    db = SessionLocal()
-    try:
-        # Получаем или создаем пользователя
-        user = db.query(User).filter(User.telegram_id == user_id).first()
-        if not user:
-            await update.message.reply_text(
-                "Вы не зарегистрированы. Нажмите /start для регистрации."
-            )
-            return
-        
-        # Отключаем напоминания для пользователя
-        user.is_active = False
-        db.commit()
-        
-        text = (
-            "🔕 *Напоминания отключены*\n\n"
-            "Вы больше не будете получать ежедневные напоминания.\n\n"
-            "Вы всё ещё можете:\n"
-            "• Оценивать боль вручную через /rate\n"
-            "• Просматривать статистику через /stats\n"
-            "• Включить напоминания обратно через /resume\n\n"
-            "Берегите свою спину! 💙"
+    # Отключаем напоминания для пользователя
+    if await run_db(_set_user_active, user_id, False) is None:
+        await update.message.reply_text(
+            "Вы не зарегистрированы. Нажмите /start для регистрации."
         )
-        
-        await update.message.reply_text(text, parse_mode='Markdown')
-        logger.info(f"Пользователь {user_id} отключил напоминания")
-        
-    finally:
-        db.close()
+        return
+    
+    text = (
+        "🔕 *Напоминания отключены*\n\n"
+        "Вы больше не будете получать ежедневные напоминания.\n\n"
+        "Вы всё ещё можете:\n"
+        "• Оценивать боль вручную через /rate\n"
+        "• Просматривать статистику через /stats\n"
+        "• Включить напоминания обратно через /resume\n\n"
+        "Берегите свою спину! 💙"
+    )
+    
+    await update.message.reply_text(text, parse_mode='Markdown')
+    logger.info(f"Пользователь {user_id} отключил напоминания")
+
+def _get_user(db, user_id):
+    return db.query(User).filter(User.telegram_id == user_id).first()
 
 async def resume_reminders(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Включение ежедневных напоминаний для пользователя"""
     user_id = update.effective_user.id
     
-    db = SessionLocal()
-    try:
-        # Получаем пользователя
-        user = db.query(User).filter(User.telegram_id == user_id).first()
-        if not user:
-            await update.message.reply_text(
-                "Вы не зарегистрированы. Нажмите /start для регистрации."
-            )
-            return
-        
-        # Включаем напоминания для пользователя
-        user.is_active = True
-        db.commit()
-        
-        # Получаем настройки времени напоминаний
-        from database import BotSettings
-        hour_setting = db.query(BotSettings).filter(BotSettings.setting_name == 'reminder_hour').first()
-        minute_setting = db.query(BotSettings).filter(BotSettings.setting_name == 'reminder_minute').first()
-        enabled_setting = db.query(BotSettings).filter(BotSettings.setting_name == 'reminder_enabled').first()
-        
-        current_hour = hour_setting.setting_value if hour_setting else "10"
-        current_minute = minute_setting.setting_value if minute_setting else "0"
-        reminders_enabled = enabled_setting.setting_value == 'true' if enabled_setting else True
-        
-        if reminders_enabled:
-            text = (
-                "🔔 *Напоминания включены*\n\n"
-                f"Теперь вы снова будете получать ежедневные напоминания в {current_hour}:{current_minute:0>2}.\n\n"
-                "Регулярная забота о спине - ключ к здоровью! 🌟\n\n"
-                "Если хотите отключить напоминания, используйте /stop"
-            )
-        else:
-            text = (
-                "🔔 *Ваши напоминания включены*\n\n"
-                "⚠️ Но сейчас глобальные напоминания отключены администратором.\n"
-                "Вы получите уведомления, когда администратор их включит.\n\n"
-                "Пока можете оценивать состояние спины вручную через /rate"
-            )
-        
-        await update.message.reply_text(text, parse_mode='Markdown')
-        logger.info(f"Пользователь {user_id} включил напоминания")
-        
-    finally:
-        db.close()
+    # Включаем напоминания для пользователя
+    reminder_time = await run_db(_set_user_active, user_id, True)
+    if reminder_time is None:
+        await update.message.reply_text(
+            "Вы не зарегистрированы. Нажмите /start для регистрации."
+        )
+        return
+    
+    # Получаем настройки времени напоминаний
+    settings = settings_cache.get()
+    current_time = _format_reminder_time(*reminder_time, settings)
+    
+    if settings.enabled:
+        text = (
+            "🔔 *Напоминания включены*\n\n"
+            f"Теперь вы снова будете получать ежедневные напоминания в {current_time}.\n\n"
+            "Регулярная забота о спине - ключ к здоровью! 🌟\n\n"
+            "Если хотите отключить напоминания, используйте /stop"
+        )
+    else:
+        text = (
+            "🔔 *Ваши напоминания включены*\n\n"
+            "⚠️ Но сейчас глобальные напоминания отключены администратором.\n"
+            "Вы получите уведомления, когда администратор их включит.\n\n"
+            "Пока можете оценивать состояние спины вручную через /rate"
+        )
+    
+    await update.message.reply_text(text, parse_mode='Markdown')
+    logger.info(f"Пользователь {user_id} включил напоминания")
 
 async def reminder_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Проверка статуса напоминаний для пользователя"""
     user_id = update.effective_user.id
     
-    db = SessionLocal()
-    try:
-        user = db.query(User).filter(User.telegram_id == user_id).first()
-        if not user:
+    user = await run_db(_get_user, user_id)
+    if not user:
+        await update.message.reply_text(
+            "Вы не зарегистрированы. Нажмите /start для регистрации."
+        )
+        return
+    
+    # Получаем глобальные настройки
+    settings = settings_cache.get()
+    current_time = _format_reminder_time(user.timezone, user.reminder_minute, settings)
+    global_enabled = settings.enabled
+    
+    user_status = "🟢 Включены" if user.is_active else "🔴 Отключены"
+    global_status = "🟢 Включены" if global_enabled else "🔴 Отключены администратором"
+    
+    if user.is_active and global_enabled:
+        final_status = f"✅ Вы будете получать напоминания в {current_time}"
+    else:
+        final_status = "❌ Напоминания не будут приходить"
+    
+    text = (
+        f"📋 *Статус напоминаний*\n\n"
+        f"Ваши напоминания: {user_status}\n"
+        f"Глобальные напоминания: {global_status}\n"
+        f"Время: {current_time}\n\n"
+        f"{final_status}\n\n"
+        f"Управление:\n"
+        f"• /stop - отключить\n"
+        f"• /resume - включить\n"
+        f"• /timezone, /time - свое время напоминаний"
+    )
+    
+    await update.message.reply_text(text, parse_mode='Markdown')
+
+@lru_cache(maxsize=1)
+def _timezone_names():
+    """Названия часовых поясов IANA без учета регистра"""
+    return {name.lower(): name for name in available_timezones()}
+
+_UTC_OFFSET = re.compile(r'^(?:utc|gmt)?\s*([+-])(\d{1,2})$')
+_LOCAL_TIME = re.compile(r'^(\d{1,2})[:.](\d{2})$')
+
+def _parse_timezone(value: str):
+    """Часовой пояс IANA (Europe/Moscow) или смещение от UTC (+3, UTC-5); None если не распознан"""
+    value = value.strip()
+    if value.lower() in ('utc', 'gmt'):
+        return 'UTC'
+    offset = _UTC_OFFSET.match(value.lower())
+    if offset:
+        hours = int(offset.group(2))
+        if hours > 14:
+            return None
+        if hours == 0:
+            return 'UTC'
+        # В зонах Etc/GMT знак смещения инвертирован: Etc/GMT-3 это UTC+3
+        sign = '-' if offset.group(1) == '+' else '+'
+        return f"Etc/GMT{sign}{hours}"
+    return _timezone_names().get(value.lower())
+
+def _parse_local_time(value: str):
+    """Время ЧЧ:ММ в минуту суток; None если не распознано"""
+    match = _LOCAL_TIME.match(value.strip())
+    if not match:
+        return None
+    hour, minute = int(match.group(1)), int(match.group(2))
+    if hour > 23 or minute > 59:
+        return None
+    return hour * 60 + minute
+
+async def set_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /timezone - часовой пояс для персонального времени напоминаний"""
+    user_id = update.effective_user.id
+    
+    timezone = _parse_timezone(" ".join(context.args)) if context.args else None
+    if timezone is None:
+        await update.message.reply_text(
+            "🌍 *Часовой пояс*\n\n"
+            "Укажите часовой пояс названием или смещением от UTC, например:\n"
+            "/timezone Europe/Moscow\n"
+            "/timezone +3",
+            parse_mode='Markdown'
+        )
+        return
+    
+    saved = await run_db(set_user_reminder_time, user_id, timezone=timezone)
+    if saved is None:
+        await update.message.reply_text(
+            "Вы не зарегистрированы. Нажмите /start для регистрации."
+        )
+        return
+    
+    await update.message.reply_text(
+        f"🌍 Часовой пояс сохранен.\n"
+        f"Напоминания будут приходить в {_format_reminder_time(*saved, settings_cache.get())}.\n\n"
+        f"Изменить время: /time ЧЧ:ММ",
+        parse_mode='Markdown'
+    )
+    logger.info(f"Пользователь {user_id} установил часовой пояс {timezone}")
+
+async def set_personal_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /time - персональное время напоминаний"""
+    user_id = update.effective_user.id
+    value = " ".join(context.args).strip().lower() if context.args else ""
+    
+    if value in ('reset', 'сброс'):
+        if not await run_db(reset_user_reminder_time, user_id):
             await update.message.reply_text(
                 "Вы не зарегистрированы. Нажмите /start для регистрации."
             )
             return
-        
-        # Получаем глобальные настройки
-        from database import BotSettings
-        hour_setting = db.query(BotSettings).filter(BotSettings.setting_name == 'reminder_hour').first()
-        minute_setting = db.query(BotSettings).filter(BotSettings.setting_name == 'reminder_minute').first()
-        enabled_setting = db.query(BotSettings).filter(BotSettings.setting_name == 'reminder_enabled').first()
-        
-        current_hour = hour_setting.setting_value if hour_setting else "10"
-        current_minute = minute_setting.setting_value if minute_setting else "0"
-        global_enabled = enabled_setting.setting_value == 'true' if enabled_setting else True
-        
-        user_status = "🟢 Включены" if user.is_active else "🔴 Отключены"
-        global_status = "🟢 Включены" if global_enabled else "🔴 Отключены администратором"
-        
-        if user.is_active and global_enabled:
-            final_status = f"✅ Вы будете получать напоминания в {current_hour}:{current_minute:0>2}"
-        else:
-            final_status = "❌ Напоминания не будут приходить"
-        
-        text = (
-            f"📋 *Статус напоминаний*\n\n"
-            f"Ваши напоминания: {user_status}\n"
-            f"Глобальные напоминания: {global_status}\n"
-            f"Время: {current_hour}:{current_minute:0>2}\n\n"
-            f"{final_status}\n\n"
-            f"Управление:\n"
-            f"• /stop - отключить\n"
-            f"• /resume - включить"
+        settings = settings_cache.get()
+        await update.message.reply_text(
+            f"⏰ Персональное время сброшено. Напоминания будут приходить "
+            f"в общее время {_format_reminder_time(None, None, settings)}."
         )
-        
-        await update.message.reply_text(text, parse_mode='Markdown')
-        
-    finally:
-        db.close() 
\ No newline at end of file
+        return
+    
+    local_minute = _parse_local_time(value)
+    if local_minute is None:
+        await update.message.reply_text(
+            "⏰ *Время напоминаний*\n\n"
+            "Укажите время в формате ЧЧ:ММ, например:\n"
+            "/time 08:30\n\n"
+            "Время считается в вашем часовом поясе (/timezone, по умолчанию UTC).\n"
+            "Вернуться к общему времени: /time сброс",
+            parse_mode='Markdown'
+        )
+        return
+    
+    saved = await run_db(set_user_reminder_time, user_id, local_minute=local_minute)
+    if saved is None:
+        await update.message.reply_text(
+            "Вы не зарегистрированы. Нажмите /start для регистрации."
+        )
+        return
+    
+    await update.message.reply_text(
+        f"⏰ Напоминания будут приходить в {_format_reminder_time(*saved, settings_cache.get())}.",
+        parse_mode='Markdown'
+    )
+    logger.info(f"Пользователь {user_id} установил время напоминаний {value}")
@@ -0,0 +1,142 @@
+"""
+Режим webhook: Telegram сам присылает апдейты POST-запросами на встроенный
+HTTP сервер (http_server.py), без задержки long polling.
+
+Включается переменной окружения BOT_MODE=webhook (BOT_MODE=worker - воркер
+рассылок, см. outbox.py). Настройки:
+    WEBHOOK_URL     - публичный адрес, который Telegram будет вызывать
+                      (https://example.com); путь WEBHOOK_PATH добавляется к нему
+    WEBHOOK_LISTEN  - адрес, на котором слушает сервер (по умолчанию 0.0.0.0)
+    WEBHOOK_PORT    - порт сервера (по умолчанию 8443)
+    WEBHOOK_PATH    - путь webhook (по умолчанию /telegram)
+    WEBHOOK_SECRET  - секрет для заголовка X-Telegram-Bot-Api-Secret-Token;
+                      если не задан, генерируется при каждом запуске и
+                      регистрируется вместе с WEBHOOK_URL. Без WEBHOOK_URL
+                      (webhook регистрируется вне бота) секрет обязателен:
+                      сгенерированный секрет Telegram не узнает и все апдейты
+                      были бы отклонены
+"""
+
+import asyncio
+import hmac
+import json
+import logging
+import os
+import secrets
+import signal
+from typing import NamedTuple, Optional
+
+from telegram import Update
+
+from http_server import HTTPServer, Request, Response
+
+logger = logging.getLogger(__name__)
+
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+
+
+class WebhookConfig(NamedTuple):
+    url: Optional[str]
+    listen: str = '0.0.0.0'
+    port: int = 8443
+    path: str = '/telegram'
+    secret: str = ''
+
+    @classmethod
+    def from_env(cls) -> 'WebhookConfig':
+        path = os.getenv('WEBHOOK_PATH', '/telegram')
+        url = os.getenv('WEBHOOK_URL')
+        secret = os.getenv('WEBHOOK_SECRET')
+        if not secret:
+            if not url:
+                raise ValueError(
+                    "BOT_MODE=webhook без WEBHOOK_URL: webhook регистрируется вне бота, "
+                    "задайте WEBHOOK_SECRET, с которым он зарегистрирован"
+                )
+            secret = secrets.token_urlsafe(32)
+            logger.warning(
+                "WEBHOOK_SECRET не задан: сгенерирован новый секрет, webhook будет перерегистрирован с ним; "
+                "webhook, зарегистрированный с другим секретом, перестанет получать апдейты"
+            )
+        return cls(
+            url=url,
+            listen=os.getenv('WEBHOOK_LISTEN', '0.0.0.0'),
+            port=int(os.getenv('WEBHOOK_PORT', '8443')),
+            path=path if path.startswith('/') else f'/{path}',
+            secret=secret,
+        )
+
+    @property
+    def webhook_url(self) -> Optional[str]:
+        if not self.url:
+            return None
+        return self.url.rstrip('/') + self.path
+
+
+def webhook_handler(application, secret: str):
+    """Обработчик POST с апдейтом: проверка секрета и передача в очередь приложения"""
+
+    async def handle(request: Request) -> Response:
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), secret):
+            logger.warning("Webhook: запрос с неверным секретом отклонен")
+            return Response(403, b"Forbidden")
+        try:
+            update = Update.de_json(json.loads(request.body), application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning(f"Webhook: некорректный апдейт: {e}")
+            return Response(400, b"Bad Request")
+
+        # Отвечаем Telegram сразу, обработка идет в обычном цикле приложения
+        await application.update_queue.put(update)
+        return Response(200, b"OK")
+
+    return handle
+
+
+async def serve_webhook(application, config: WebhookConfig, allowed_updates=None, stop_event: asyncio.Event = None):
+    """Запустить приложение с webhook-сервером и работать до stop_event (или SIGINT/SIGTERM)"""
+    server = HTTPServer(config.listen, config.port)
+    server.route('POST', config.path, webhook_handler(application, config.secret))
+
+    if stop_event is None:
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop_event.set)
+            except NotImplementedError:
+                # Windows: остановка по KeyboardInterrupt
+                pass
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await server.start()
+        await application.start()
+
+        if config.webhook_url:
+            await application.bot.set_webhook(
+                url=config.webhook_url,
+                secret_token=config.secret,
+                allowed_updates=allowed_updates,
+            )
+            logger.info(f"Webhook установлен: {config.webhook_url}")
+        else:
+            logger.warning(
+                f"WEBHOOK_URL не задан: бот не регистрирует webhook. Он должен быть зарегистрирован "
+                f"на путь {config.path} с секретом WEBHOOK_SECRET, иначе апдейты отклоняются (403)"
+            )
+
+        await stop_event.wait()
+    finally:
+        await server.stop()
+        if application.running:
+            await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
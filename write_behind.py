@@ -0,0 +1,207 @@
+"""
+Отложенная пакетная запись оценок боли (write-behind).
+
+Во время утренней волны ответов каждая оценка отдельной транзакцией
+упирается в единственную блокировку записи SQLite. Буфер копит оценки
+в памяти и записывает их пачкой через save_pain_ratings не реже чем раз
+в RATING_FLUSH_MS миллисекунд или при накоплении RATING_FLUSH_ROWS оценок.
+
+Гарантия сохранности: при аварийном завершении процесса теряются только
+оценки, пришедшие за последний интервал сброса. При штатной остановке
+буфер сбрасывается полностью.
+
+Если база недоступна, пачка возвращается в буфер, но буфер ограничен:
+оценок не больше RATING_BUFFER_MAX_ROWS и не старше RATING_BUFFER_MAX_AGE
+секунд, остальные отбрасываются. После RATING_MAX_FAILED_FLUSHES неудачных
+сбросов подряд буфер пишет оценки по одной, чтобы одна плохая строка не
+держала всю пачку, а обработчики ждут записи своей оценки (write_through)
+вместо того, чтобы копить новые. Отброшенные оценки пишутся в журнал и
+считаются метрикой spina_ratings_dropped_total.
+
+Включается переменной окружения RATING_WRITE_BEHIND=true.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+import metrics
+from database import run_db, save_pain_ratings
+from load_monitor import load_monitor
+
+logger = logging.getLogger(__name__)
+
+RATING_WRITE_BEHIND = os.getenv('RATING_WRITE_BEHIND', 'false').lower() == 'true'
+RATING_FLUSH_MS = int(os.getenv('RATING_FLUSH_MS', '200'))
+RATING_FLUSH_ROWS = int(os.getenv('RATING_FLUSH_ROWS', '500'))
+RATING_BUFFER_MAX_ROWS = int(os.getenv('RATING_BUFFER_MAX_ROWS', '10000'))
+RATING_BUFFER_MAX_AGE = float(os.getenv('RATING_BUFFER_MAX_AGE', '600'))  # секунд
+RATING_MAX_FAILED_FLUSHES = int(os.getenv('RATING_MAX_FAILED_FLUSHES', '3'))
+
+
+def save_pain_ratings_each(db, ratings):
+    """Записать оценки по одной транзакции на оценку; оценки, которые записать не удалось"""
+    failed = []
+    for rating in ratings:
+        try:
+            save_pain_ratings(db, [rating])
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Ошибка записи оценки {rating[1]} пользователя {rating[0]}: {e}")
+            failed.append(rating)
+    return failed
+
+
+class RatingWriteBuffer:
+    """Буфер оценок с периодическим пакетным сбросом в базу"""
+
+    def __init__(self, flush_interval_ms: int = RATING_FLUSH_MS, max_rows: int = RATING_FLUSH_ROWS,
+                 enabled: bool = RATING_WRITE_BEHIND, max_buffered_rows: int = RATING_BUFFER_MAX_ROWS,
+                 max_age: float = RATING_BUFFER_MAX_AGE, max_failed_flushes: int = RATING_MAX_FAILED_FLUSHES):
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_rows = max_rows
+        self.enabled = enabled
+        self.max_buffered_rows = max_buffered_rows
+        self.max_age = timedelta(seconds=max_age)
+        self.max_failed_flushes = max_failed_flushes
+        self.failed_flushes = 0
+        self._pending = []
+        self._pending_users = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_requested = asyncio.Event()
+        self._task = None
+        self._stopping = False
+
+    @property
+    def degraded(self) -> bool:
+        """Сбросы подряд не удаются: оценки пишутся по одной, обработчики ждут записи"""
+        return self.failed_flushes >= self.max_failed_flushes
+
+    def add(self, telegram_id: int, pain_level: int):
+        """Поставить оценку в очередь на запись"""
+        self._pending.append((telegram_id, pain_level, datetime.utcnow()))
+        self._pending_users[telegram_id] = self._pending_users.get(telegram_id, 0) + 1
+        self._trim()
+        if len(self._pending) >= self.max_rows:
+            self._flush_requested.set()
+
+    async def write_through(self, telegram_id: int, pain_level: int):
+        """Поставить оценку в очередь и дождаться сброса (обратное давление при сбоях базы).
+
+        Оценка идет через буфер, а не мимо него, чтобы более старые оценки
+        пользователя не записались после нее.
+        """
+        self.add(telegram_id, pain_level)
+        await self.flush()
+
+    def has_pending(self, telegram_id: int) -> bool:
+        """Есть ли у пользователя еще не записанные оценки"""
+        return telegram_id in self._pending_users
+
+    def _forget(self, rows):
+        for telegram_id, _, _ in rows:
+            left = self._pending_users[telegram_id] - 1
+            if left:
+                self._pending_users[telegram_id] = left
+            else:
+                del self._pending_users[telegram_id]
+
+    def _discard(self, rows, reason: str):
+        """Учесть оценки, уже убранные из очереди без записи в базу"""
+        self._forget(rows)
+        metrics.ratings_dropped(reason, len(rows))
+        for telegram_id, pain_level, rated_at in rows:
+            logger.error(
+                f"Оценка {pain_level} пользователя {telegram_id} от {rated_at:%Y-%m-%d %H:%M:%S} "
+                f"не записана и отброшена ({reason})"
+            )
+
+    def _trim(self):
+        """Отбросить самые старые оценки сверх max_buffered_rows"""
+        if len(self._pending) > self.max_buffered_rows:
+            overflow = self._pending[:-self.max_buffered_rows]
+            self._pending = self._pending[-self.max_buffered_rows:]
+            self._discard(overflow, 'overflow')
+
+    def _expire(self):
+        """Отбросить оценки, которые ждут записи дольше max_age"""
+        oldest = datetime.utcnow() - self.max_age
+        expired = [row for row in self._pending if row[2] < oldest]
+        if expired:
+            self._pending = [row for row in self._pending if row[2] >= oldest]
+            self._discard(expired, 'expired')
+        self._trim()
+
+    async def flush(self):
+        """Записать все накопленные оценки одной транзакцией (после сбоев - по одной)"""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, []
+            per_row = self.degraded
+            started = time.monotonic()
+            try:
+                if per_row:
+                    failed = await run_db(save_pain_ratings_each, batch)
+                else:
+                    await run_db(save_pain_ratings, batch)
+                    failed = []
+            except Exception as e:
+                logger.error(f"Ошибка записи {len(batch)} оценок, повтор при следующем сбросе: {e}")
+                failed = batch
+            else:
+                load_monitor.record_db_write(time.monotonic() - started)
+
+            failed_ids = set(map(id, failed))
+            self._forget([row for row in batch if id(row) not in failed_ids])
+            if failed and len(failed) < len(batch):
+                # Остальные оценки записались: база доступна, а эти не запишутся и при повторе
+                self._discard(failed, 'rejected')
+                failed = []
+
+            if failed:
+                # Возвращаем пачку в начало очереди и повторим при следующем сбросе
+                self._pending = failed + self._pending
+                self.failed_flushes += 1
+                if self.failed_flushes == self.max_failed_flushes:
+                    logger.error(
+                        f"{self.failed_flushes} сбросов оценок подряд не удались: "
+                        f"оценки пишутся по одной, обработчики ждут записи"
+                    )
+                self._expire()
+            elif self.failed_flushes:
+                logger.info(f"Запись оценок восстановлена после {self.failed_flushes} неудачных сбросов")
+                self.failed_flushes = 0
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            await self.flush()
+
+    async def start(self):
+        """Запустить фоновый сброс (вызывается из post_init приложения)"""
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info(
+                f"Отложенная запись оценок включена: сброс каждые {self.flush_interval * 1000:.0f} мс "
+                f"или по {self.max_rows} оценок"
+            )
+
+    async def stop(self):
+        """Остановить фоновый сброс и записать остаток"""
+        if self._task is not None:
+            # Не отменяем задачу посреди записи, а даем ей завершить текущий сброс
+            self._stopping = True
+            self._flush_requested.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+
+rating_buffer = RatingWriteBuffer()